@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of agora-election.
+# Copyright (C) 2014  Eduardo Robles Elvira <edulix AT agoravoting DOT com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Adaptive ordering of the checkers of a pipeline that commute.
+
+A pipeline declares a group of checkers that can run in any order with
+checks.commuting_group (see settings.py for an example). Each process keeps,
+per group and checker, a moving average of its cost (wall time, which is
+mostly database round trips) and of its rejection rate, and runs the checkers
+of the group by ascending cost / rejection rate: cheap checkers that reject
+often go first, so that most rejected requests are turned away with the
+least database work. Checkers that never reject go last, cheapest first.
+
+Until each checker of a group has ADAPTIVE_PIPELINE_MIN_SAMPLES samples, the
+declared order is used. With probability ADAPTIVE_PIPELINE_EXPLORE_RATE a
+random order is used, so that the stats of the checkers that usually run
+last stay up to date. The order in use is logged when it changes and shown in
+GET /api/v1/admin/config/.
+'''
+
+import time
+import random
+import logging
+import threading
+
+class CheckerStats(object):
+    '''
+    Moving averages of the cost and rejection rate of a checker in a group
+    '''
+    def __init__(self, checker_path):
+        self.checker_path = checker_path
+        self.samples = 0
+        self.cost = 0.0
+        self.reject_rate = 0.0
+
+    def add(self, cost, rejected, alpha):
+        self.samples += 1
+        # plain mean for the first samples, moving average afterwards
+        weight = max(alpha, 1.0 / self.samples)
+        self.cost += (cost - self.cost) * weight
+        self.reject_rate += ((1.0 if rejected else 0.0) - self.reject_rate) *\
+            weight
+
+    def rank(self):
+        '''
+        Expected cost per rejection, lower runs first
+        '''
+        if self.reject_rate <= 0:
+            return (1, self.cost)
+        return (0, self.cost / self.reject_rate)
+
+    def to_dict(self):
+        return dict(checker=self.checker_path,
+                    samples=self.samples,
+                    cost_ms=round(self.cost * 1000, 3),
+                    reject_rate=round(self.reject_rate, 4))
+
+
+class CommutingGroup(object):
+    '''
+    Stats and current order of a group of commuting checkers
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        # checker key -> CheckerStats
+        self.stats = dict()
+        self.order = []
+
+    def get_stats(self, key, checker_path):
+        stats = self.stats.get(key, None)
+        if stats is None:
+            with self.lock:
+                stats = self.stats.setdefault(key, CheckerStats(checker_path))
+        return stats
+
+    def choose_order(self, steps, min_samples, explore_rate):
+        '''
+        Returns the indexes of steps, a list of (key, checker_path, kwargs),
+        in the order they should run
+        '''
+        indexes = list(range(len(steps)))
+        all_stats = [self.get_stats(key, path) for key, path, kwargs in steps]
+        if any(s.samples < min_samples for s in all_stats):
+            return indexes
+        if explore_rate > 0 and random.random() < explore_rate:
+            random.shuffle(indexes)
+            return indexes
+
+        indexes.sort(key=lambda i: all_stats[i].rank())
+        order = [steps[i][0] for i in indexes]
+        if order != self.order:
+            self.order = order
+            logging.info("pipeline group %s order: %s" % (
+                self.name, ", ".join(steps[i][1] for i in indexes)))
+        return indexes
+
+    def add_sample(self, key, checker_path, cost, rejected, alpha):
+        stats = self.get_stats(key, checker_path)
+        with self.lock:
+            stats.add(cost, rejected, alpha)
+
+    def to_dict(self):
+        order = self.order or list(self.stats.keys())
+        return [self.stats[key].to_dict() for key in order
+                if key in self.stats]
+
+# group name -> CommutingGroup
+_groups = dict()
+_groups_lock = threading.Lock()
+
+def get_group(name):
+    group = _groups.get(name, None)
+    if group is None:
+        with _groups_lock:
+            group = _groups.setdefault(name, CommutingGroup(name))
+    return group
+
+def checker_key(checker_path, kwargs):
+    '''
+    Identifies a checker with its arguments within a group
+    '''
+    if not kwargs:
+        return checker_path
+    return "%s(%s)" % (checker_path, ", ".join(
+        "%s=%r" % (key, kwargs[key]) for key in sorted(kwargs.keys())))
+
+def run_group(name, pipeline, run_checker, continue_value, config):
+    '''
+    Runs the checkers of the pipeline in the adaptive order of the group.
+    run_checker(checker_path, kwargs) runs a checker and returns its result.
+    Returns the first result different from continue_value, or
+    continue_value if all the checkers passed.
+    '''
+    min_samples = config.get('ADAPTIVE_PIPELINE_MIN_SAMPLES', 50)
+    explore_rate = config.get('ADAPTIVE_PIPELINE_EXPLORE_RATE', 0.02)
+    alpha = config.get('ADAPTIVE_PIPELINE_ALPHA', 0.01)
+
+    group = get_group(name)
+    steps = [(checker_key(checker_path, kwargs), checker_path, kwargs)
+             for checker_path, kwargs in pipeline]
+    for i in group.choose_order(steps, min_samples, explore_rate):
+        key, checker_path, kwargs = steps[i]
+        start = time.time()
+        ret = run_checker(checker_path, kwargs)
+        rejected = ret != continue_value and\
+            getattr(ret, 'status_code', 200) >= 400
+        group.add_sample(key, checker_path, time.time() - start, rejected,
+                         alpha)
+        if ret != continue_value:
+            return ret
+    return continue_value
+
+def report():
+    '''
+    Returns the stats of each group in the current order
+    '''
+    return dict((name, group.to_dict()) for name, group in _groups.items())
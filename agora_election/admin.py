@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of agora-election.
+# Copyright (C) 2014  Eduardo Robles Elvira <edulix AT agoravoting DOT com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Read-only admin API over voters, messages, colorlists and the active config.
+
+Listings are paginated by primary key in descending order (newest first)
+using keyset pagination: each page returns a next_cursor that encodes the
+last id returned, and the next page is requested with ?cursor=<next_cursor>.
+Unlike offsets, cursors are stable while new rows are inserted and every page
+is served by an index seek. Filters use indexed columns only.
+
+All requests must include the ADMIN_API_KEY in the "Authorization" header and
+come from ADMIN_ALLOWED_IPS (if set). The API is disabled if ADMIN_API_KEY is
+empty.
+'''
+
+import json
+import base64
+import binascii
+from datetime import datetime
+from functools import wraps
+
+from flask import (Blueprint, Response, request, current_app,
+                   stream_with_context)
+
+from checks import error
+from crypto import constant_time_compare
+from elections import get_config
+from toolbox import get_ip, get_read_session
+
+admin = Blueprint('admin', __name__)
+
+class InvalidParam(Exception):
+    def __init__(self, field):
+        super(InvalidParam, self).__init__(field)
+        self.field = field
+
+def admin_required(func):
+    '''
+    Decorator that checks that the request is authorized to use the admin API
+    '''
+    @wraps(func)
+    def wrap(*args, **kwargs):
+        config = current_app.config
+        api_key = config.get('ADMIN_API_KEY', '')
+        if not api_key:
+            return error("Admin API disabled", status=404,
+                         error_codename="not_found")
+        allowed_ips = config.get('ADMIN_ALLOWED_IPS', [])
+        if allowed_ips and get_ip(request) not in allowed_ips:
+            return error("Forbidden", status=403, error_codename="forbidden")
+        if not constant_time_compare(
+                request.headers.get('Authorization', ''), api_key):
+            return error("Unauthorized", status=401,
+                         error_codename="unauthorized")
+        return func(*args, **kwargs)
+    return wrap
+
+def encode_cursor(last_id):
+    return base64.urlsafe_b64encode(
+        json.dumps(dict(id=last_id)).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        return int(json.loads(base64.urlsafe_b64decode(
+            cursor.encode('ascii')).decode('utf-8'))['id'])
+    except (ValueError, KeyError, TypeError, binascii.Error):
+        raise InvalidParam('cursor')
+
+def parse_int_list(field):
+    '''
+    Parses a comma separated list of ints from the query string
+    '''
+    try:
+        return [int(value) for value in request.args[field].split(',')]
+    except ValueError:
+        raise InvalidParam(field)
+
+def parse_date(field):
+    value = request.args[field]
+    for fmt in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise InvalidParam(field)
+
+def get_filters(model, exact_fields, int_fields):
+    '''
+    Returns the list of filter clauses of the request for the given model:
+    exact matches for exact_fields, comma separated int lists for int_fields,
+    and created_after/created_before time ranges
+    '''
+    filters = []
+    for field in exact_fields:
+        if field in request.args:
+            filters.append(getattr(model, field) == request.args[field])
+    for field in int_fields:
+        if field in request.args:
+            filters.append(getattr(model, field).in_(parse_int_list(field)))
+    if 'created_after' in request.args:
+        filters.append(model.created >= parse_date('created_after'))
+    if 'created_before' in request.args:
+        filters.append(model.created < parse_date('created_before'))
+    return filters
+
+def serialize(item, fields):
+    ret = dict()
+    for field in fields:
+        value = getattr(item, field)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        ret[field] = value
+    return ret
+
+def keyset_page(model, filters, fields):
+    '''
+    Streams a page of the model rows matching filters as json:
+
+    {"items": [...], "next_cursor": "<cursor or null>"}
+    '''
+    max_limit = current_app.config.get('ADMIN_API_MAX_LIMIT', 1000)
+    try:
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        raise InvalidParam('limit')
+    if limit <= 0 or limit > max_limit:
+        raise InvalidParam('limit')
+
+    query = get_read_session().query(model).filter(*filters)
+    if 'cursor' in request.args:
+        query = query.filter(model.id < decode_cursor(request.args['cursor']))
+    # one more row than needed tells us if there's a next page
+    query = query.order_by(model.id.desc()).limit(limit + 1)\
+        .yield_per(min(limit + 1, 500))
+
+    def generate():
+        yield '{"items": ['
+        last_id = None
+        count = 0
+        has_more = False
+        for item in query:
+            if count == limit:
+                has_more = True
+                break
+            yield (',' if count > 0 else '') +\
+                json.dumps(serialize(item, fields))
+            last_id = item.id
+            count += 1
+        next_cursor = encode_cursor(last_id) if has_more else None
+        yield '], "next_cursor": %s}' % json.dumps(next_cursor)
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+def admin_listing(func):
+    '''
+    Decorator for the listings, turning InvalidParam into a 400 error
+    '''
+    @wraps(func)
+    def wrap(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except InvalidParam as e:
+            return error("Invalid parameter '%s'" % e.field, field=e.field,
+                         error_codename="invalid_param")
+    return wrap
+
+VOTER_FIELDS = ('id', 'election_id', 'created', 'modified', 'ip', 'tlf',
+                'first_name', 'last_name', 'email', 'dni', 'postal_code',
+                'lang_code', 'receive_mail_updates', 'token_guesses',
+                'message_id', 'is_active', 'status', 'error_codename',
+                'correlation_id')
+
+MESSAGE_FIELDS = ('id', 'created', 'modified', 'tlf', 'ip', 'authenticated',
+                  'lang_code', 'status', 'sms_status', 'sms_provider',
+                  'sms_routing', 'attempts', 'last_error', 'correlation_id')
+
+COLORLIST_FIELDS = ('id', 'action', 'key', 'value', 'created', 'modified')
+
+@admin.route('/voters/', methods=['GET'])
+@admin_required
+@admin_listing
+def list_voters():
+    '''
+    Lists the voters of the current election (or of ?election_id=<id>).
+
+    Filters: tlf, ip, dni, status (comma separated), is_active (true/false),
+    created_after, created_before (ISO dates). Pagination: limit, cursor.
+    '''
+    from models import Voter
+
+    if 'election_id' in request.args:
+        election_ids = parse_int_list('election_id')
+    else:
+        election_ids = [get_config("CURRENT_ELECTION_ID", 0)]
+    filters = [Voter.election_id.in_(election_ids)]
+    filters += get_filters(Voter, ('tlf', 'ip', 'dni'), ('status',))
+    if 'is_active' in request.args:
+        filters.append(Voter.is_active == (request.args['is_active'] == 'true'))
+    return keyset_page(Voter, filters, VOTER_FIELDS)
+
+@admin.route('/messages/', methods=['GET'])
+@admin_required
+@admin_listing
+def list_messages():
+    '''
+    Lists the sms messages. Tokens and contents are never returned.
+
+    Filters: tlf, ip, status (comma separated), created_after, created_before
+    (ISO dates). Pagination: limit, cursor.
+    '''
+    from models import Message
+    filters = get_filters(Message, ('tlf', 'ip'), ('status',))
+    return keyset_page(Message, filters, MESSAGE_FIELDS)
+
+@admin.route('/colorlists/', methods=['GET'])
+@admin_required
+@admin_listing
+def list_colorlists():
+    '''
+    Lists the white and black list entries.
+
+    Filters: value, action (comma separated), key (comma separated),
+    created_after, created_before (ISO dates). Pagination: limit, cursor.
+    '''
+    from models import ColorList
+    filters = get_filters(ColorList, ('value',), ('action', 'key'))
+    return keyset_page(ColorList, filters, COLORLIST_FIELDS)
+
+@admin.route('/config/', methods=['GET'])
+@admin_required
+def get_config_version():
+    '''
+    Returns the version of the settings in use by this process, when they were
+    loaded, the errors of the last failed reload (see hotreload.py), the
+    checkers of the pipelines of the current election and the order and stats
+    of the commuting groups of checkers (see adaptive.py).
+    '''
+    from adaptive import report
+    config = current_app.config
+    pipelines = dict()
+    for key in ('REGISTER_CHECKS_PIPELINE', 'NOTIFY_VOTE_PIPELINE'):
+        pipelines[key] = [checker_path for checker_path, kwargs in
+                          get_config(key, [])]
+    return Response(json.dumps(dict(
+            version=config.get('CONFIG_VERSION', None),
+            loaded=config.get('CONFIG_LOADED', None),
+            errors=config.get('CONFIG_ERRORS', []),
+            pipelines=pipelines,
+            commuting_groups=report())),
+        mimetype='application/json')
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of agora-election.
+# Copyright (C) 2014  Eduardo Robles Elvira <edulix AT agoravoting DOT com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Admission control for the critical paths.
+
+Limits the number of critical sections executing concurrently, both per
+worker process (ADMISSION_MAX_CONCURRENT) and for all the worker processes of
+the host (ADMISSION_GLOBAL_MAX_CONCURRENT, using lock files in
+ADMISSION_LOCK_DIR). Requests wait in a bounded queue (ADMISSION_MAX_QUEUE)
+for at most ADMISSION_QUEUE_TIMEOUT_SECS, and when overloaded they are
+rejected fast with a 503 and a Retry-After header, before getting a database
+connection.
+'''
+
+import os
+import time
+import fcntl
+import random
+import logging
+import threading
+from functools import wraps
+
+from flask import current_app
+
+class AdmissionController(object):
+    '''
+    Bounded queue in front of the critical sections
+    '''
+
+    def __init__(self, max_concurrent, max_queue, timeout,
+                 global_max_concurrent=None, lock_dir=None):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.global_max_concurrent = global_max_concurrent
+        self.lock_dir = lock_dir
+        self.cond = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+
+        if global_max_concurrent and lock_dir:
+            from toolbox import ensure_private_dir
+            # other users could take the slots and block every request
+            ensure_private_dir(lock_dir)
+
+    def acquire_local(self, deadline):
+        with self.cond:
+            if self.active < self.max_concurrent:
+                self.active += 1
+                return True
+            if self.waiting >= self.max_queue:
+                return False
+
+            self.waiting += 1
+            try:
+                while self.active >= self.max_concurrent:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.cond.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release_local(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    def acquire_global(self, deadline):
+        '''
+        Takes one of the global_max_concurrent slot lock files. Returns the
+        open file of the slot, or None on timeout.
+        '''
+        slots = list(range(self.global_max_concurrent))
+        while True:
+            # start at a random slot to spread contention
+            random.shuffle(slots)
+            for slot in slots:
+                path = os.path.join(self.lock_dir, "slot-%d.lock" % slot)
+                f = open(path, 'a')
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return f
+                except OSError:
+                    f.close()
+            if time.time() >= deadline:
+                return None
+            time.sleep(0.005)
+
+    def release_global(self, slot_file):
+        fcntl.flock(slot_file, fcntl.LOCK_UN)
+        slot_file.close()
+
+    def acquire(self):
+        '''
+        Waits for a free slot. Returns a token to be passed to release(), or
+        None if the request should be rejected.
+        '''
+        deadline = time.time() + self.timeout
+        if not self.acquire_local(deadline):
+            return None
+        if not self.global_max_concurrent or not self.lock_dir:
+            return True
+
+        slot_file = self.acquire_global(deadline)
+        if slot_file is None:
+            self.release_local()
+            return None
+        return slot_file
+
+    def release(self, token):
+        if token is not True:
+            self.release_global(token)
+        self.release_local()
+
+_controller = None
+_controller_lock = threading.Lock()
+
+def get_admission_controller():
+    '''
+    Returns the admission controller of this process, created from the app
+    config the first time
+    '''
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            config = current_app.config
+            _controller = AdmissionController(
+                max_concurrent=config.get('ADMISSION_MAX_CONCURRENT', 8),
+                max_queue=config.get('ADMISSION_MAX_QUEUE', 32),
+                timeout=config.get('ADMISSION_QUEUE_TIMEOUT_SECS', 2),
+                global_max_concurrent=config.get(
+                    'ADMISSION_GLOBAL_MAX_CONCURRENT', None),
+                lock_dir=config.get('ADMISSION_LOCK_DIR', None))
+        return _controller
+
+def admission_controlled(func):
+    '''
+    Decorator that executes func only when the admission controller admits
+    it, returning a 503 "overloaded" error otherwise.
+    '''
+    @wraps(func)
+    def wrap(*args, **kwargs):
+        from checks import error
+
+        if not current_app.config.get('ADMISSION_CONTROL', True):
+            return func(*args, **kwargs)
+
+        controller = get_admission_controller()
+        token = controller.acquire()
+        if token is None:
+            logging.warn("admission control: rejecting request, overloaded")
+            ret = error("Server overloaded, please try again", status=503,
+                        error_codename="overloaded")
+            ret.headers['Retry-After'] = str(current_app.config.get(
+                'ADMISSION_RETRY_AFTER_SECS', 2))
+            return ret
+        try:
+            return func(*args, **kwargs)
+        finally:
+            controller.release(token)
+    return wrap
@@ -22,10 +22,8 @@ import logging
 import argparse
 import json
 
-from prettytable import PrettyTable
 from celery import Celery
 
-from jinja2 import Markup
 from sqlalchemy import or_
 
 from flask import Flask
@@ -34,7 +32,6 @@ from flask.ext.babel import Babel
 from flask.ext.mail import Mail
 from flask.ext.captcha import Captcha
 from flask.ext.captcha.views import captcha_blueprint
-from raven.contrib.flask import Sentry
 
 class App(Flask):
     db = None
@@ -56,13 +53,35 @@ app_captcha = Captcha()
 from tasks import *
 from models import *
 from views import api, index
-
+from admin import admin
+from health import health, mark_warmed_up
+from elections import (ElectionDispatcher, load_all_election_data,
+                       reset_election_data, set_request_election, get_config,
+                       pin_config)
+import invalidation
+import hotreload
+import tracing
+from toolbox import remove_read_sessions
+
+app_flask.wsgi_app = ElectionDispatcher(app_flask, app_flask.wsgi_app)
+app_flask.before_request(tracing.start_request)
+app_flask.after_request(tracing.add_response_header)
+app_flask.teardown_request(tracing.clear_correlation_id)
+app_flask.teardown_appcontext(remove_read_sessions)
+app_flask.before_request(pin_config)
+app_flask.before_request(set_request_election)
+app_flask.before_request(invalidation.ensure_listener)
 app_flask.register_blueprint(api, url_prefix='/api/v1')
 app_flask.register_blueprint(index, url_prefix='/')
+app_flask.register_blueprint(admin, url_prefix='/api/v1/admin')
+app_flask.register_blueprint(health)
 app_flask.register_blueprint(captcha_blueprint, url_prefix='/captcha')
 
 def config():
-    logging.basicConfig(level=logging.DEBUG)
+    tracing.install_log_record_factory()
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(levelname)s:%(name)s:[%(correlation_id)s] %(message)s")
     # load captcha defaults
     app_flask.config.from_object("flask.ext.captcha.settings")
 
@@ -78,36 +97,91 @@ def config():
                       "= %s" % os.environ['AGORA_ELECTION_SETTINGS'])
         app_flask.config.from_envvar('AGORA_ELECTION_SETTINGS', silent=False)
 
-    # an optimization
-    election_url = app_flask.config['AGORA_ELECTION_DATA_URL']
-
-    if election_url.startswith("http"):
-        import requests
-        bauth = app_flask.config.get('AGORA_ELECTION_DATA_BASIC_AUTH', None)
-        election_json = requests.get(election_url, verify=False, auth=bauth).json()
-        extra_data_json =  requests.get(election_url + "extra_data/",
-                                        verify=False, auth=bauth).json()
-    else:
-        with open(election_url, 'r', encoding="utf-8") as f:
-            election_json = json.loads(f.read())
-            # NOTE: do not support extra_data in this mode
-            extra_data_json = dict()
-
-    edata = app_flask.config.get('AGORA_ELECTION_DATA', {})
-    edata['election'] = election_json
-    edata['election_extra_data'] = extra_data_json
-    app_flask.config['AGORA_ELECTION_DATA_STR'] = Markup(json.dumps(
-        app_flask.config.get('AGORA_ELECTION_DATA', {})))
+    # election data is fetched lazily the first time it's needed, so that
+    # celery workers and most CLI commands don't do any network I/O
+    reset_election_data()
+    hotreload.set_version(app_flask.config, hotreload.settings_version())
+
+    if app_flask.config.get('SPANS_LOG_FILE', None):
+        tracing.configure_spans_log(app_flask.config['SPANS_LOG_FILE'])
 
     # config captcha
     app_captcha.init_app(app_flask)
     app_mail.init_app(app_flask)
-    sentry = Sentry()
-    sentry.init_app(app=app_flask)
+    if app_flask.config.get('SENTRY_DSN', None) or\
+            os.environ.get('SENTRY_DSN', None):
+        from raven.contrib.flask import Sentry
+        sentry = Sentry()
+        sentry.init_app(app=app_flask)
     app_captcha.init_app(app_flask)
 
+def invalidate_election_data(topic):
+    '''
+    Forgets the election data and the caches derived from it, so that they
+    are loaded again the next time they are needed
+    '''
+    import results
+    import views
+    reset_election_data()
+    results._results_cache.clear()
+    views._stats_cache.clear()
+
+def invalidate_sms_providers(topic):
+    import sms
+    sms._status_cache.clear()
+
+invalidation.subscribe(invalidation.TOPIC_ELECTION_DATA,
+                       invalidate_election_data)
+invalidation.subscribe(invalidation.TOPIC_SMS_PROVIDERS,
+                       invalidate_sms_providers)
+invalidation.subscribe(invalidation.TOPIC_SETTINGS,
+                       hotreload.on_settings_invalidated)
+
+def warmup():
+    '''
+    Does the expensive startup work once, so that it's shared by all the
+    workers forked by the --serve mode: fetches the election data, resolves
+    the checkers of the pipelines, loads the census and checks the database
+    connection.
+    '''
+    from checks import resolve_pipeline
+    load_all_election_data(app_flask)
+    with app_flask.app_context():
+        elections = [None] + list(app_flask.config.get('ELECTIONS', {}).keys())
+        for election_key in elections:
+            for name in ('REGISTER_CHECKS_PIPELINE', 'NOTIFY_VOTE_PIPELINE'):
+                resolve_pipeline(get_config(name, [], election_key))
+            census = get_config('CSV_CENSUS', None, election_key)
+            if census is not None:
+                logging.info("census for election '%s' loaded with %d "
+                             "entries" % (election_key, len(census)))
+
+        # check the db connection, then close the pool so that the forked
+        # workers do not share the connections
+        db.engine.connect().close()
+        db.engine.dispose()
+    mark_warmed_up()
+
+def reload_config():
+    '''
+    Reloads the settings and the election data, and tells the other processes
+    about it
+    '''
+    import sys
+    import importlib
+    if 'custom_settings' in sys.modules:
+        importlib.reload(sys.modules['custom_settings'])
+    importlib.reload(sys.modules['settings'])
+    config()
+    try:
+        with app_flask.app_context():
+            invalidation.publish(invalidation.TOPIC_SETTINGS)
+            db.session.commit()
+    except Exception:
+        logging.exception("could not publish the settings reload")
+
 def main():
-    from toolbox import format_print_table_output
+    from toolbox import format_print_table_output, get_read_session
     with app_flask.app_context():
         parser = argparse.ArgumentParser()
         parser.add_argument("-d", "--createdb", help="create the database",
@@ -132,12 +206,44 @@ def main():
                             help="remove all colors", action="store_true")
         parser.add_argument("-lm", "--list-messages",
                             help="list messages", action="store_true")
+        parser.add_argument("--archive", help="move stale voters and expired "
+                            "messages to the archive tables",
+                            action="store_true")
+        parser.add_argument("--rebuild-counters", help="rebuild the voter "
+                            "status counters used for stats from the voter "
+                            "table", action="store_true")
+        parser.add_argument("--rollups", help="list the per-minute rollups "
+                            "(filter them with -f, e.g. minute>=-1h)",
+                            action="store_true")
+        parser.add_argument("--update-rollups", help="roll up all the closed "
+                            "minutes since the last run", action="store_true")
+        parser.add_argument("--reconcile-sms", help="dead-letter the sms "
+                            "messages whose delivery was lost, so that their "
+                            "voters can request a new token",
+                            action="store_true")
+        parser.add_argument("--sms-status", help="check now the credit and "
+                            "health of the sms providers in use and print it",
+                            action="store_true")
+        parser.add_argument("--archived", help="list archived voters or "
+                            "messages instead of live ones",
+                            action="store_true")
+        parser.add_argument("--import-colorlist", default=None,
+                            help="with --whitelist or --blacklist, import the "
+                            "items of a TSV file with one 'ip<TAB>value' or "
+                            "'tlf<TAB>value' per line (extra columns are "
+                            "ignored), like the one written by "
+                            "tools/fraud_clusters.py")
         parser.add_argument("-r", "--remove",
                             help="remove item from black or white list",
                             action="store_true")
         parser.add_argument("-t", "--tlf", help="telephone number")
         parser.add_argument("-f", "--filters", nargs='+', default=[],
-                            help="key==value(s) filters for queries")
+                            help="filters for listings, like tlf==+34666.. "
+                            "status=in=0,1 created>=-2h or tlf^=+3466. See "
+                            "queryfilters.py for details")
+        parser.add_argument("--explain", action="store_true",
+                            help="print the query plan of a listing instead "
+                            "of its results")
         parser.add_argument("-gc", "--gen-captchas", help="gen captchas",
                             action="store_true")
         parser.add_argument("-cc", "--clear-captchas", help="clear captchas",
@@ -153,12 +259,47 @@ def main():
                             "reasonable default.")
         parser.add_argument("-a", "--audio-message", action="store_true",
                             help="when sending a message, mark it as audio")
+        parser.add_argument("--reload-settings", action="store_true",
+                            help="validate the settings and make all the web "
+                            "and celery workers reload them without "
+                            "restarting. See hotreload.py")
+        parser.add_argument("--refresh-election-data", action="store_true",
+                            help="fetch again the election data from "
+                            "AGORA_ELECTION_DATA_URL and make all the web and "
+                            "celery workers reload it")
         parser.add_argument("-pe", "--print-election", action="store_true",
                             help="gets election data from "
                             "AGORA_ELECTION_DATA_URL settings and prints it in"
                             "json. Useful to retrieve it and tune/modify it")
+        parser.add_argument("--serve", action="store_true",
+                            help="launch the production pre-fork server")
+        parser.add_argument("--workers", type=int, default=None,
+                            help="number of worker processes in --serve mode. "
+                            "By default, SERVER_WORKERS setting")
+        parser.add_argument("-e", "--election", default=None,
+                            help="key of the election in ELECTIONS settings "
+                            "to use, when serving multiple elections")
         pargs = parser.parse_args()
 
+        from flask import g
+        if pargs.election is not None and\
+                pargs.election not in app_flask.config.get('ELECTIONS', {}):
+            logging.error("Unknown election '%s'" % pargs.election)
+            exit(1)
+        g.election_key = pargs.election
+
+        def message_election_clause(model, election_id):
+            '''
+            Messages have no election: they belong to the election of the
+            voters (live or archived) that reference them
+            '''
+            from sqlalchemy import and_, exists
+            return or_(
+                exists().where(and_(Voter.message_id == model.id,
+                                    Voter.election_id == election_id)),
+                exists().where(and_(VoterArchive.message_id == model.id,
+                                    VoterArchive.election_id == election_id)))
+
         def row_getter(row, fields_format, fields):
             '''
             Given a row, return it as a list for the fields given and using the
@@ -192,7 +333,8 @@ def main():
         if pargs.createdb:
             logging.info("creating the database: %s" % app_flask.config.get(
                 'SQLALCHEMY_DATABASE_URI', ''))
-            db.create_all()
+            # only the primary: the read replica has no tables of its own
+            db.create_all(bind=None)
             return
         if pargs.resetdb:
             logging.info("reset the database: %s" % app_flask.config.get(
@@ -201,8 +343,8 @@ def main():
             if d != "YES":
                 print("You didn't confirm, NOT reseting the database..")
                 exit(1)
-            db.drop_all()
-            db.create_all()
+            db.drop_all(bind=None)
+            db.create_all(bind=None)
             return
         elif pargs.console:
             import ipdb; ipdb.set_trace()
@@ -222,12 +364,12 @@ def main():
             from views import token_generator
             msg = Message(
                 tlf=tlf,
-                lang_code=app_flask.config.get("BABEL_DEFAULT_LOCALE", "en"),
+                lang_code=get_config("BABEL_DEFAULT_LOCALE", "en"),
                 token=pargs.message,
                 status=Message.STATUS_QUEUED
             )
             voter = Voter(
-                election_id=app_flask.config.get("CURRENT_ELECTION_ID", 0),
+                election_id=get_config("CURRENT_ELECTION_ID", 0),
                 ip="127.0.0.1",
                 first_name="local",
                 last_name="local",
@@ -245,9 +387,9 @@ def main():
             db.session.add(voter)
             db.session.commit()
 
-            send_sms.apply_async(kwargs=dict(msg_id=msg.id,
-                    token=pargs.message, is_audio=pargs.audio_message),
-                expires=app_flask.config.get('SMS_EXPIRE_SECS', 120))
+            from delivery import enqueue_message
+            enqueue_message(msg, pargs.message, pargs.audio_message,
+                            election_key=pargs.election)
             return
         elif pargs.remove_colors:
             if pargs.whitelist:
@@ -257,6 +399,7 @@ def main():
 
             for item in db.session.query(ColorList).all():
                 db.session.delete(item)
+            invalidation.publish(invalidation.TOPIC_COLORLIST)
             db.session.commit()
             return
         elif pargs.list_colors:
@@ -276,16 +419,17 @@ def main():
             elif pargs.blacklist:
                 action = ColorList.ACTION_BLACKLIST
 
+            read_session = get_read_session()
             if action is None and key is None:
-                items = db.session.query(ColorList)
+                items = read_session.query(ColorList)
             elif key is not None:
-                items  = db.session.query(ColorList)\
+                items  = read_session.query(ColorList)\
                     .filter(ColorList.key == key, ColorList.value == value)
             elif action is not None:
-                items = db.session.query(ColorList)\
+                items = read_session.query(ColorList)\
                     .filter(ColorList.action == action)
             else:
-                items = db.session.query(ColorList)\
+                items = read_session.query(ColorList)\
                     .filter(ColorList.key == key,
                             ColorList.action == action,
                             ColorList.value == value)
@@ -330,16 +474,96 @@ def main():
                 row_getter=lambda r: row_getter(r, fields_formatting, fields))
             return
 
+        elif pargs.archive:
+            from archive import archive_all
+            n_voters, n_messages = archive_all()
+            print("archived %d voters and %d messages" % (n_voters, n_messages))
+            return
+
+        elif pargs.update_rollups:
+            from rollups import update_all_rollups
+            update_all_rollups()
+            return
+
+        elif pargs.rollups:
+            from queryfilters import compile_filters, FilterError
+            try:
+                filters = compile_filters(RollupMinute, pargs.filters)
+            except FilterError as e:
+                logging.error(str(e))
+                exit(1)
+            items = get_read_session().query(RollupMinute).filter(*filters)\
+                .order_by(RollupMinute.minute)
+            fields = ['minute', 'election_id', 'transition', 'error_codename',
+                      'count']
+            format_print_table_output(
+                output_format=pargs.output_format,
+                table_header=fields,
+                items=items,
+                row_getter=lambda r: row_getter(r, dict(
+                    minute=lambda r: r.minute.isoformat()), fields))
+            return
+
+        elif pargs.reconcile_sms:
+            from delivery import reconcile_deliveries
+            print("dead-lettered %d messages" % reconcile_deliveries())
+            return
+
+        elif pargs.sms_status:
+            from sms import check_providers
+            fields = ['provider', 'checked', 'credit', 'healthy', 'low_credit',
+                      'error']
+            format_print_table_output(
+                output_format=pargs.output_format,
+                table_header=fields,
+                items=check_providers(),
+                row_getter=lambda r: row_getter(r, dict(), fields))
+            return
+
+        elif pargs.rebuild_counters:
+            # counters are cumulative, so a voter counts in its current status
+            # and in all the previous ones of the sms flow
+            from sqlalchemy import func
+            flow = [Voter.STATUS_REQUESTED, Voter.STATUS_CREATED,
+                    Voter.STATUS_SENT, Voter.STATUS_AUTHENTICATED,
+                    Voter.STATUS_VOTED]
+            counts = dict()
+            rows = db.session.query(Voter.election_id, Voter.status,
+                                    func.count(Voter.id))\
+                .group_by(Voter.election_id, Voter.status)
+            for election_id, status, count in rows:
+                if status not in flow:
+                    continue
+                for reached in flow[:flow.index(status) + 1]:
+                    key = (election_id, reached)
+                    counts[key] = counts.get(key, 0) + count
+
+            db.session.query(VoterStatusCounter).delete()
+            for (election_id, status), count in counts.items():
+                db.session.add(VoterStatusCounter(
+                    election_id=election_id, status=status, shard=0,
+                    count=count))
+            db.session.commit()
+            print("rebuilt %d counters" % len(counts))
+            return
+
         elif pargs.list_voters:
+            from queryfilters import compile_filters, explain_query, FilterError
+            model = VoterArchive if pargs.archived else Voter
             filters=[]
-            for filter in pargs.filters:
-                key, value = filter.split("==")
-                filters.append(getattr(Voter, key).__eq__(value))
+            if pargs.election is not None:
+                filters.append(model.election_id == get_config(
+                    "CURRENT_ELECTION_ID", 0))
+            try:
+                filters += compile_filters(model, pargs.filters)
+            except FilterError as e:
+                logging.error(str(e))
+                exit(1)
 
-            if filters:
-                items = db.session.query(Voter).filter(*filters)
-            else:
-                items = db.session.query(Voter)
+            items = get_read_session().query(model).filter(*filters)
+            if pargs.explain:
+                print("\n".join(explain_query(get_read_session(), items)))
+                return
 
             def str_status(i):
                 if i.status == Voter.STATUS_REQUESTED_IGNORE:
@@ -375,15 +599,22 @@ def main():
             return
 
         elif pargs.list_messages:
+            from queryfilters import compile_filters, explain_query, FilterError
+            model = MessageArchive if pargs.archived else Message
             filters=[]
-            for filter in pargs.filters:
-                key, value = filter.split("==")
-                filters.append(getattr(Message, key).__eq__(value))
+            if pargs.election is not None:
+                filters.append(message_election_clause(
+                    model, get_config("CURRENT_ELECTION_ID", 0)))
+            try:
+                filters += compile_filters(model, pargs.filters)
+            except FilterError as e:
+                logging.error(str(e))
+                exit(1)
 
-            if filters:
-                items = db.session.query(Message).filter(*filters)
-            else:
-                items = db.session.query(Message)
+            items = get_read_session().query(model).filter(*filters)
+            if pargs.explain:
+                print("\n".join(explain_query(get_read_session(), items)))
+                return
 
             def str_status(i):
                 if i.status == Message.STATUS_QUEUED:
@@ -392,6 +623,10 @@ def main():
                     ret = "sent"
                 elif i.status == Message.STATUS_IGNORE:
                     ret = "ignore"
+                elif i.status == Message.STATUS_SENDING:
+                    ret = "sending"
+                elif i.status == Message.STATUS_FAILED:
+                    ret = "failed"
                 return "%s,%d" % (ret, i.status)
 
             if pargs.output_fields is "":
@@ -435,14 +670,20 @@ def main():
             for item in items:
                 db.session.delete(item)
 
-            # when removing a blacklist, reset counters:
+            # when removing a blacklist, reset counters (only those of the
+            # given --election, if any):
             if pargs.blacklist:
+                election_id = get_config("CURRENT_ELECTION_ID", 0)
+
                 # reset message counters
                 if pargs.ip:
                     clause = getattr(Message, "ip").__eq__(pargs.ip)
                 else:
                     clause = getattr(Message, "tlf").__eq__(pargs.tlf)
                 items = db.session.query(Message).filter(clause)
+                if pargs.election is not None:
+                    items = items.filter(
+                        message_election_clause(Message, election_id))
                 for item in items:
                     item.status = Message.STATUS_IGNORE
                     db.session.add(item)
@@ -454,13 +695,41 @@ def main():
                     clause = getattr(Voter, "tlf").__eq__(pargs.tlf)
                 items = db.session.query(Voter).filter(
                     clause, Voter.status == Voter.STATUS_REQUESTED)
+                if pargs.election is not None:
+                    items = items.filter(Voter.election_id == election_id)
                 for item in items:
                     item.status = Voter.STATUS_REQUESTED_IGNORE
                     item.is_active = False
                     db.session.add(item)
+            invalidation.publish(invalidation.TOPIC_COLORLIST)
             db.session.commit()
             return
 
+        elif pargs.import_colorlist:
+            if not pargs.whitelist and not pargs.blacklist:
+                logging.error("You need to provide --whitelist or --blacklist!")
+                exit(1)
+            action = ColorList.ACTION_WHITELIST if pargs.whitelist else\
+                    ColorList.ACTION_BLACKLIST
+            keys = dict(ip=ColorList.KEY_IP, tlf=ColorList.KEY_TLF)
+            items = set()
+            with open(pargs.import_colorlist, 'r', encoding="utf-8") as f:
+                for line in f:
+                    cols = line.strip().split('\t')
+                    if len(cols) < 2 or cols[0] not in keys:
+                        continue
+                    items.add((keys[cols[0]], cols[1]))
+
+            existing = set(db.session.query(ColorList.key, ColorList.value)\
+                .filter(ColorList.action == action))
+            new_items = items - existing
+            for key, value in new_items:
+                db.session.add(ColorList(key=key, action=action, value=value))
+            invalidation.publish(invalidation.TOPIC_COLORLIST)
+            db.session.commit()
+            print("imported %d items, %d were already listed" % (
+                len(new_items), len(items) - len(new_items)))
+            return
         elif pargs.whitelist or pargs.blacklist:
             action = ColorList.ACTION_WHITELIST if pargs.whitelist else\
                     ColorList.ACTION_BLACKLIST
@@ -484,6 +753,7 @@ def main():
 
             cl = ColorList(key=key, action=action, value=value)
             db.session.add(cl)
+            invalidation.publish(invalidation.TOPIC_COLORLIST)
             db.session.commit()
             return
         elif pargs.clear_captchas:
@@ -501,16 +771,59 @@ def main():
             return
         elif pargs.count_captchas:
             from flask.ext.captcha.models import CaptchaStore
-            print("%d pregenerated captchas left" % db.session.query(CaptchaStore).count())
+            print("%d pregenerated captchas left" %
+                  get_read_session().query(CaptchaStore).count())
+            return
+        elif pargs.reload_settings:
+            errors = hotreload.reload_settings(app_flask, force=True,
+                                               publish=True)
+            if errors:
+                print("invalid settings, not reloaded:\n%s" % "\n".join(errors))
+                exit(1)
+            print("settings reloaded, config version %s" % app_flask.config[
+                'CONFIG_VERSION'])
+            return
+        elif pargs.refresh_election_data:
+            # remove the snapshots so that the data is fetched from agora,
+            # both here and in the workers
+            snapshot_dir = app_flask.config.get('ELECTION_SNAPSHOT_DIR', None)
+            if snapshot_dir and os.path.isdir(snapshot_dir):
+                for name in os.listdir(snapshot_dir):
+                    if name.endswith(".json"):
+                        os.remove(os.path.join(snapshot_dir, name))
+            reset_election_data()
+            load_all_election_data(app_flask)
+            invalidation.publish(invalidation.TOPIC_ELECTION_DATA)
+            db.session.commit()
+            print("election data refreshed")
             return
         elif pargs.print_election:
             print(json.dumps(
-                app_flask.config.get('AGORA_ELECTION_DATA', {})['election'], indent=4))
+                get_config('AGORA_ELECTION_DATA', {})['election'], indent=4))
             return
 
         logging.info("using provider = %s" % app_flask.config.get(
             'SMS_PROVIDER', None))
         port = app_flask.config.get('SERVER_PORT', None)
+        if pargs.serve:
+            from server import PreforkServer
+            workers = pargs.workers
+            if workers is None:
+                workers = app_flask.config.get('SERVER_WORKERS', 4)
+            server = PreforkServer(
+                app=app_flask,
+                host=app_flask.config.get('SERVER_HOST', "0.0.0.0"),
+                port=port or 5000,
+                num_workers=workers,
+                warmup=warmup,
+                reload_config=reload_config,
+                hot_reload=lambda: hotreload.reload_settings(app_flask),
+                watch_files=[os.environ.get('AGORA_ELECTION_SETTINGS', None)])
+            server.run()
+            return
+        load_all_election_data(app_flask)
+        mark_warmed_up()
+        hotreload.install_signal_handler(app_flask)
         app_flask.run(threaded=True, use_reloader=False, port=port, host="0.0.0.0")
 
 # needs to be called in celery too
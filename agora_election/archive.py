@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of agora-election.
+# Copyright (C) 2014  Eduardo Robles Elvira <edulix AT agoravoting DOT com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, and_, not_, exists, select
+
+from app import db, app_flask
+from models import Voter, Message, VoterArchive, MessageArchive
+
+# columns copied from the live tables to the archive tables
+VOTER_COLUMNS = ('id', 'election_id', 'created', 'modified', 'ip', 'tlf',
+                 'first_name', 'last_name', 'email', 'dni', 'postal_code',
+                 'lang_code', 'receive_mail_updates', 'token_guesses',
+                 'message_id', 'is_active', 'status', 'error_codename',
+                 'correlation_id')
+
+MESSAGE_COLUMNS = ('id', 'created', 'modified', 'tlf', 'ip', 'content',
+                   'token', 'authenticated', 'lang_code', 'status',
+                   'sms_status', 'sms_response', 'sms_provider',
+                   'sms_routing', 'idempotency_key', 'attempts', 'last_error',
+                   'correlation_id')
+
+def move_in_batches(model, archive_model, columns, clause, batch_size):
+    '''
+    Moves the rows of model matching clause to archive_model, in batches of
+    batch_size rows ordered by primary key (keyset pagination). Each batch is
+    committed in its own short transaction, so that no long locks are held.
+
+    Returns the number of rows moved.
+    '''
+    total = 0
+    last_id = 0
+    while True:
+        ids = [row[0] for row in db.session.query(model.id)\
+            .filter(clause, model.id > last_id)\
+            .order_by(model.id)\
+            .limit(batch_size)]
+        if not ids:
+            break
+
+        src_cols = [getattr(model, col) for col in columns]
+        dst_cols = [getattr(archive_model, col) for col in columns]
+        sel = select(src_cols).where(model.id.in_(ids))
+        db.session.execute(
+            archive_model.__table__.insert().from_select(dst_cols, sel))
+        db.session.query(model).filter(model.id.in_(ids))\
+            .delete(synchronize_session=False)
+        db.session.commit()
+
+        total += len(ids)
+        last_id = ids[-1]
+        if len(ids) < batch_size:
+            break
+
+    return total
+
+def open_election_ids():
+    '''
+    Returns the CURRENT_ELECTION_ID of the configured elections whose voting
+    period has not ended. If the data of an election can't be loaded, it's
+    considered open.
+    '''
+    from elections import ensure_election_data, get_config
+
+    ret = set()
+    for election_key in [None] + list(app_flask.config.get('ELECTIONS', {})):
+        election_id = get_config("CURRENT_ELECTION_ID", 0, election_key)
+        try:
+            ensure_election_data(app_flask, election_key)
+            election = get_config('AGORA_ELECTION_DATA', {},
+                                  election_key)['election']
+            if election['voting_ends_at_date'] is not None:
+                continue
+        except Exception as e:
+            logging.warn("archive: could not get the data of election %s, "
+                         "considering it open: %s" % (election_key, e))
+        ret.add(election_id)
+    return ret
+
+def archive_stale_voters(max_age_secs=None, batch_size=None):
+    '''
+    Archives voters that are older than max_age_secs and either in requested
+    status (STATUS_REQUESTED, STATUS_REQUESTED_IGNORE) or inactive. Voters
+    that have authenticated or voted are never archived.
+
+    STATUS_REQUESTED voters of open elections are not archived until the
+    election ends, because they are counted by
+    check_ip_total_unconfirmed_requests_max.
+    '''
+    if max_age_secs is None:
+        max_age_secs = app_flask.config.get('ARCHIVE_VOTERS_AGE_SECS',
+                                            60*60*24*7)
+    if batch_size is None:
+        batch_size = app_flask.config.get('ARCHIVE_BATCH_SIZE', 500)
+
+    cutoff = datetime.utcnow() - timedelta(seconds=max_age_secs)
+    clause = and_(
+        Voter.created < cutoff,
+        Voter.status.notin_([Voter.STATUS_AUTHENTICATED, Voter.STATUS_VOTED]),
+        or_(Voter.status.in_([Voter.STATUS_REQUESTED,
+                              Voter.STATUS_REQUESTED_IGNORE]),
+            Voter.is_active == False))
+    open_ids = open_election_ids()
+    if open_ids:
+        clause = and_(clause, or_(Voter.status != Voter.STATUS_REQUESTED,
+                                  Voter.election_id.notin_(open_ids)))
+    n = move_in_batches(Voter, VoterArchive, VOTER_COLUMNS, clause, batch_size)
+    logging.info("archived %d stale voters" % n)
+    return n
+
+def archive_expired_messages(max_age_secs=None, batch_size=None):
+    '''
+    Archives messages last modified more than max_age_secs ago that are not
+    referenced anymore by any voter in the voter table.
+
+    Sent and not authenticated messages are counted by check_tlf_total_max
+    and check_ip_total_max, which are not scoped by election, so they are not
+    archived while any election is open.
+    '''
+    if max_age_secs is None:
+        max_age_secs = app_flask.config.get('ARCHIVE_MESSAGES_AGE_SECS',
+                                            60*60*24*7)
+    if batch_size is None:
+        batch_size = app_flask.config.get('ARCHIVE_BATCH_SIZE', 500)
+
+    cutoff = datetime.utcnow() - timedelta(seconds=max_age_secs)
+    clause = and_(
+        Message.modified < cutoff,
+        not_(exists().where(Voter.message_id == Message.id)))
+    if open_election_ids():
+        clause = and_(clause, not_(and_(Message.status == Message.STATUS_SENT,
+                                        Message.authenticated == False)))
+    n = move_in_batches(Message, MessageArchive, MESSAGE_COLUMNS, clause,
+                        batch_size)
+    logging.info("archived %d expired messages" % n)
+    return n
+
+def archive_all():
+    '''
+    Archives stale voters and then expired messages (voters first, because
+    messages referenced by voters are not archived)
+    '''
+    return archive_stale_voters(), archive_expired_messages()
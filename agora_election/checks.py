@@ -24,6 +24,9 @@ from datetime import datetime, timedelta
 from flask import Blueprint, request, make_response
 from flask import current_app
 
+from elections import get_config, get_election_key
+from tracing import get_correlation_id
+
 RET_PIPE_CONTINUE = 0
 EMAIL_RX = re.compile(
     r"(^[-!#$%&'*+/=?^_`{}|~0-9A-Z]+(\.[-!#$%&'*+/=?^_`{}|~0-9A-Z]+)*"  # dot-atom
@@ -126,21 +129,29 @@ def int_constraint(val, min_val=None, max_val=None):
         return False
     return True
 
-def register_request(data):
+def register_request(data, write_behind=False):
     '''
     register the request in the Voter database with STATUS_REQUESTED
 
     You can move this pipe before or after check_*_blacklisted in the pipeline,
     depending on if you get too many blacklisted requests to avoid too many
     writes on the database
+
+    The voter is not written now, but at the end of the pipeline (see
+    finish_requested_voter), so that a rejected request is written with its
+    error_codename in a single insert, unless a checker (like send_sms_pipe)
+    has already written it. The checkers that count the requested voters
+    take into account the current one meanwhile.
+
+    If write_behind is True, when the request is rejected the voter is
+    buffered and bulk inserted in background (see writebehind.py) instead.
     '''
-    from app import db
     from models import Voter
 
     ip_addr = data['ip_addr']
 
     # disable older registration attempts for this tlf
-    curr_eid = current_app.config.get("CURRENT_ELECTION_ID", 0)
+    curr_eid = get_config("CURRENT_ELECTION_ID", 0)
 
     # create voter and send sms
     voter = Voter(
@@ -152,17 +163,126 @@ def register_request(data):
         tlf=data.get("tlf", ""),
         postal_code=data.get("postal_code", ""),
         receive_mail_updates=data["receive_updates"],
-        lang_code=current_app.config.get("BABEL_DEFAULT_LOCALE", "en"),
+        lang_code=get_config("BABEL_DEFAULT_LOCALE", "en"),
         status=Voter.STATUS_REQUESTED,
         message=None,
         is_active=True,
         dni=data["dni"].upper(),
+        created=datetime.utcnow(),
+        modified=datetime.utcnow(),
+        token_guesses=0,
+        correlation_id=get_correlation_id(),
     )
 
+    data['requested_voter'] = voter
+    data['requested_voter_pending'] = True
+    data['requested_voter_write_behind'] = write_behind
+    return RET_PIPE_CONTINUE
+
+def save_requested_voter(data):
+    '''
+    Writes synchronously the requested voter registered by register_request,
+    if it has not been written yet. The caller is responsible of committing.
+    '''
+    from app import db
+    from models import Voter, VoterStatusCounter
+
+    if not data.pop('requested_voter_pending', False):
+        return
+    voter = data['requested_voter']
     db.session.add(voter)
+    db.session.flush()
+    VoterStatusCounter.increment(voter.election_id, Voter.STATUS_REQUESTED)
+
+def finish_requested_voter(data, rejected, error_codename=None):
+    '''
+    Called at the end of the pipeline to write the voter registered by
+    register_request, if it has not been written yet. If the request was
+    rejected, the error codename is recorded in the voter (used by the
+    rollups, see rollups.py) and, with write_behind=True, the voter is
+    buffered instead of written now.
+    '''
+    from app import db
+    from writebehind import get_buffer
+
+    voter = data.get('requested_voter', None)
+    if voter is None or not data.get('requested_voter_pending', False):
+        return
+    if rejected:
+        voter.error_codename = error_codename
+        if data.get('requested_voter_write_behind', False):
+            data.pop('requested_voter_pending')
+            get_buffer().add(voter)
+            return
+    save_requested_voter(data)
     db.session.commit()
 
-    data['requested_voter'] = voter
+def precheck_snapshot(data):
+    '''
+    Optional stage that reads in a single round trip all the facts used by
+    the checkers that follow it, and stores them in data['precheck']:
+    tlf_voted, dni_voted, tlf_whitelisted, tlf_blacklisted, ip_whitelisted,
+    ip_blacklisted and ip_unconfirmed_requests. When present, the checkers
+    use them instead of doing their own queries.
+
+    Place it right after register_request, so that the unconfirmed requests
+    count includes the current request, as it does without it. The tlf and
+    dni facts are only read if the request has a tlf or a dni.
+    '''
+    from app import db
+    from models import ColorList, Voter
+
+    ip_addr = data['ip_addr']
+    curr_eid = get_config("CURRENT_ELECTION_ID", 0)
+
+    def voted(clause):
+        return db.session.query(Voter)\
+            .filter(Voter.election_id == curr_eid,
+                    clause,
+                    Voter.status == Voter.STATUS_VOTED,
+                    Voter.is_active == True).exists()
+
+    def listed(key, action, value):
+        return db.session.query(ColorList)\
+            .filter(ColorList.key == key,
+                    ColorList.action == action,
+                    ColorList.value == value).exists()
+
+    facts = [
+        ('ip_whitelisted', listed(ColorList.KEY_IP,
+                                  ColorList.ACTION_WHITELIST, ip_addr)),
+        ('ip_blacklisted', listed(ColorList.KEY_IP,
+                                  ColorList.ACTION_BLACKLIST, ip_addr)),
+        ('ip_unconfirmed_requests', db.session.query(db.func.count(Voter.id))\
+            .filter(Voter.election_id == curr_eid,
+                    Voter.ip == ip_addr,
+                    Voter.status == Voter.STATUS_REQUESTED).as_scalar()),
+    ]
+    if data.get('tlf', None):
+        facts += [
+            ('tlf_voted', voted(Voter.tlf == data['tlf'])),
+            ('tlf_whitelisted', listed(ColorList.KEY_TLF,
+                                       ColorList.ACTION_WHITELIST,
+                                       data['tlf'])),
+            ('tlf_blacklisted', listed(ColorList.KEY_TLF,
+                                       ColorList.ACTION_BLACKLIST,
+                                       data['tlf'])),
+        ]
+    if data.get('dni', None):
+        facts.append(('dni_voted', voted(Voter.dni == data['dni'].upper())))
+
+    row = db.session.query(
+        *[clause.label(name) for name, clause in facts]).one()
+    precheck = dict()
+    for (name, clause), value in zip(facts, row):
+        precheck[name] = value if name == 'ip_unconfirmed_requests'\
+            else bool(value)
+    data['precheck'] = precheck
+
+    # used by check_ip_blacklisted and check_tlf_blacklisted
+    data['ip_blacklisted'] = precheck['ip_blacklisted']
+    if 'tlf_blacklisted' in precheck:
+        data['tlf_blacklisted'] = precheck['tlf_blacklisted']
     return RET_PIPE_CONTINUE
 
 def check_tlf_has_not_voted(data):
@@ -173,14 +293,18 @@ def check_tlf_has_not_voted(data):
     from models import Voter
 
     ip_addr = data['ip_addr']
-    curr_eid = current_app.config.get("CURRENT_ELECTION_ID", 0)
+    curr_eid = get_config("CURRENT_ELECTION_ID", 0)
 
-    voter = db.session.query(Voter)\
-        .filter(Voter.election_id == curr_eid,
-                Voter.tlf == data["tlf"],
-                Voter.status == Voter.STATUS_VOTED,
-                Voter.is_active == True).first()
-    if voter is not None:
+    precheck = data.get('precheck', {})
+    if 'tlf_voted' in precheck:
+        voted = precheck['tlf_voted']
+    else:
+        voted = db.session.query(Voter)\
+            .filter(Voter.election_id == curr_eid,
+                    Voter.tlf == data["tlf"],
+                    Voter.status == Voter.STATUS_VOTED,
+                    Voter.is_active == True).first() is not None
+    if voted:
         return error("Voter already voted", field="tlf",
                      error_codename="already_voted")
     return RET_PIPE_CONTINUE
@@ -194,14 +318,18 @@ def check_dni_has_not_voted(data):
     from models import Voter
 
     ip_addr = data['ip_addr']
-    curr_eid = current_app.config.get("CURRENT_ELECTION_ID", 0)
+    curr_eid = get_config("CURRENT_ELECTION_ID", 0)
 
-    voter = db.session.query(Voter)\
-        .filter(Voter.election_id == curr_eid,
-                Voter.dni == data["dni"].upper(),
-                Voter.status == Voter.STATUS_VOTED,
-                Voter.is_active == True).first()
-    if voter is not None:
+    precheck = data.get('precheck', {})
+    if 'dni_voted' in precheck:
+        voted = precheck['dni_voted']
+    else:
+        voted = db.session.query(Voter)\
+            .filter(Voter.election_id == curr_eid,
+                    Voter.dni == data["dni"].upper(),
+                    Voter.status == Voter.STATUS_VOTED,
+                    Voter.is_active == True).first() is not None
+    if voted:
         return error("Voter already voted", field="dni",
                      error_codename="already_voted")
 
@@ -215,6 +343,14 @@ def check_tlf_whitelisted(data):
     from models import ColorList
 
     ip_addr = data['ip_addr']
+    precheck = data.get('precheck', {})
+    if 'tlf_whitelisted' in precheck:
+        if precheck['tlf_whitelisted']:
+            data['whitelisted'] = True
+        else:
+            data["tlf_blacklisted"] = precheck['tlf_blacklisted']
+        return RET_PIPE_CONTINUE
+
     item = db.session.query(ColorList)\
         .filter(ColorList.key == ColorList.KEY_TLF,
                 ColorList.value == data["tlf"]).first()
@@ -238,6 +374,12 @@ def check_ip_whitelisted(data):
         return RET_PIPE_CONTINUE
 
     ip_addr = data['ip_addr']
+    precheck = data.get('precheck', {})
+    if 'ip_whitelisted' in precheck:
+        if precheck['ip_whitelisted']:
+            data['whitelisted'] = True
+        return RET_PIPE_CONTINUE
+
     items = db.session.query(ColorList)\
         .filter(ColorList.key == ColorList.KEY_IP,
                 ColorList.value == ip_addr)
@@ -376,7 +518,8 @@ def check_tlf_hour_max(data, hour_max):
 
 def check_tlf_expire_max(data):
     '''
-    if tlf has been sent an sms in < SMS_EXPIRE_SECS, error
+    if tlf has been sent an sms (or it's pending delivery) in < SMS_EXPIRE_SECS,
+    error
     '''
     from app import db
     from models import Message
@@ -385,11 +528,13 @@ def check_tlf_expire_max(data):
         return RET_PIPE_CONTINUE
 
     ip_addr = data['ip_addr']
-    secs = current_app.config.get('SMS_EXPIRE_SECS', 120)
+    secs = get_config('SMS_EXPIRE_SECS', 120)
     item = db.session.query(Message)\
         .filter(Message.tlf == data["tlf"],
                 Message.authenticated == False,
-                Message.status == Message.STATUS_SENT,
+                Message.status.in_([Message.STATUS_QUEUED,
+                                    Message.STATUS_SENDING,
+                                    Message.STATUS_SENT]),
                 Message.modified >= (datetime.utcnow() - timedelta(seconds=secs))
                 ).first()
     if item is not None:
@@ -434,7 +579,9 @@ def check_ip_total_max_voters(data, total_max):
         return RET_PIPE_CONTINUE
 
     ip_addr = data['ip_addr']
+    curr_eid = get_config("CURRENT_ELECTION_ID", 0)
     item = db.session.query(Voter).filter(
+        Voter.election_id == curr_eid,
         Voter.ip == ip_addr,
         Voter.status == Voter.STATUS_VOTED).count()
     if item >= total_max:
@@ -454,14 +601,28 @@ def check_ip_total_unconfirmed_requests_max(data, total_max):
     '''
     from app import db
     from models import ColorList, Voter
+    from writebehind import pending_requested_count
 
     if data.get('whitelisted', False) == True:
         return RET_PIPE_CONTINUE
 
     ip_addr = data['ip_addr']
-    item = db.session.query(Voter).filter(
-        Voter.ip == ip_addr,
-        Voter.status == Voter.STATUS_REQUESTED).count()
+    curr_eid = get_config("CURRENT_ELECTION_ID", 0)
+    precheck = data.get('precheck', {})
+    if 'ip_unconfirmed_requests' in precheck:
+        item = precheck['ip_unconfirmed_requests']
+    else:
+        item = db.session.query(Voter).filter(
+            Voter.election_id == curr_eid,
+            Voter.ip == ip_addr,
+            Voter.status == Voter.STATUS_REQUESTED).count()
+
+    # count also the requests buffered by register_request with write_behind
+    # in this process (the buffers of the other processes are not visible
+    # until flushed), including this one if it has not been written yet
+    item += pending_requested_count(curr_eid, ip_addr)
+    if data.get('requested_voter_pending', False):
+        item += 1
     if item >= total_max:
         logging.warn("check_ip_total_max: blacklisting")
         cl = ColorList(action=ColorList.ACTION_BLACKLIST,
@@ -502,14 +663,15 @@ def send_sms_pipe(data):
     NOTE: Requires that the pipeline has executed generate_token or similar.
     '''
     from app import db
-    from models import Voter, Message
+    from models import Voter, Message, VoterStatusCounter
     from toolbox import hash_token
-    from tasks import send_sms
+    from delivery import enqueue_message
 
     ip_addr = data['ip_addr']
 
     # disable older registration attempts for this tlf
-    curr_eid = current_app.config.get("CURRENT_ELECTION_ID", 0)
+    curr_eid = get_config("CURRENT_ELECTION_ID", 0)
+    save_requested_voter(data)
     voter = data['requested_voter']
     old_voters = db.session.query(Voter)\
         .filter(Voter.election_id == curr_eid,
@@ -525,9 +687,10 @@ def send_sms_pipe(data):
     msg = Message(
         tlf=data["tlf"],
         ip=ip_addr,
-        lang_code=current_app.config.get("BABEL_DEFAULT_LOCALE", "en"),
+        lang_code=get_config("BABEL_DEFAULT_LOCALE", "en"),
         token=token_hash,
         status=Message.STATUS_QUEUED,
+        correlation_id=get_correlation_id(),
     )
 
     # set voter to created and send SMS
@@ -536,12 +699,12 @@ def send_sms_pipe(data):
 
     db.session.add(voter)
     db.session.add(msg)
+    VoterStatusCounter.increment(curr_eid, Voter.STATUS_CREATED)
     db.session.commit()
 
-    send_sms.apply_async(kwargs=dict(
-        msg_id=msg.id, token=data['token'], is_audio=data['is_audio']),
-        countdown=current_app.config.get('SMS_DELAY', 1),
-        expires=current_app.config.get('SMS_EXPIRE_SECS', 120),)
+    enqueue_message(msg, data['token'], data['is_audio'],
+                    election_key=get_election_key(),
+                    countdown=get_config('SMS_DELAY', 1))
 
     return make_response("", 200)
 
@@ -553,7 +716,7 @@ def check_minshu_census(data, **kwargs):
     from crypto import hash_str
 
     dni = data["dni"].upper()
-    curr_eid = current_app.config.get("CURRENT_ELECTION_ID", 0)
+    curr_eid = get_config("CURRENT_ELECTION_ID", 0)
 
     url = "%(base_url)s/api/v1/voter/%(id)s" % dict(
         base_url= kwargs["base_url"],
@@ -584,7 +747,7 @@ def check_id_in_csv_census(data):
     CSV_CENSUS = read_csv_to_dicts("census.csv")
     '''
     voter_id = data["dni"].upper()
-    if data["dni"].upper() not in current_app.config["CSV_CENSUS"]:
+    if data["dni"].upper() not in get_config("CSV_CENSUS"):
         return error("Voter not in census", field="dni",
                      error_codename="not_in_census")
     return RET_PIPE_CONTINUE
@@ -596,13 +759,13 @@ def return_vote_hmac(data):
     '''
     from crypto import salted_hmac, get_random_string
     from app import db
-    from models import Voter
+    from models import Voter, VoterStatusCounter
     from crypto import hash_str
 
     dni = data["dni"].upper()
     ip_addr = data['ip_addr']
 
-    curr_eid = current_app.config.get("CURRENT_ELECTION_ID", 0)
+    curr_eid = get_config("CURRENT_ELECTION_ID", 0)
     # create voter
     voter = Voter(
         election_id=curr_eid,
@@ -613,15 +776,17 @@ def return_vote_hmac(data):
         tlf="-",
         postal_code=data.get("postal_code", ""),
         receive_mail_updates=data["receive_updates"],
-        lang_code=current_app.config.get("BABEL_DEFAULT_LOCALE", "en"),
+        lang_code=get_config("BABEL_DEFAULT_LOCALE", "en"),
         status=Voter.STATUS_AUTHENTICATED,
         modified = datetime.utcnow(),
         message=None,
         is_active=True,
         dni=hash_str(dni),
+        correlation_id=get_correlation_id(),
     )
 
     db.session.add(voter)
+    VoterStatusCounter.increment(curr_eid, Voter.STATUS_AUTHENTICATED)
     db.session.commit()
 
     data['identifier'] = voter.id
@@ -630,7 +795,7 @@ def return_vote_hmac(data):
         int(datetime.utcnow().timestamp()),
         voter.id
     )
-    key = current_app.config.get("AGORA_SHARED_SECRET_KEY", "")
+    key = get_config("AGORA_SHARED_SECRET_KEY", "")
 
     ret_data = dict(
         message=message,
@@ -645,7 +810,7 @@ def check_id_auth(data):
     from models import Voter
     from crypto import salted_hmac, constant_time_compare
 
-    curr_eid = current_app.config.get("CURRENT_ELECTION_ID", 0)
+    curr_eid = get_config("CURRENT_ELECTION_ID", 0)
     voters = db.session.query(Voter)\
         .filter(Voter.election_id == curr_eid,
                 Voter.status == Voter.STATUS_AUTHENTICATED,
@@ -655,12 +820,12 @@ def check_id_auth(data):
         return error("Invalid identifier", error_codename="invalid_id")
 
     # check token
-    key = current_app.config.get("AGORA_SHARED_SECRET_KEY", "")
+    key = get_config("AGORA_SHARED_SECRET_KEY", "")
     hmac = salted_hmac(key, data['identifier'], "").hexdigest()
     if not constant_time_compare(data["sha1_hmac"], hmac):
         return error("Invalid hmac", error_codename="invalid_hmac")
 
-    is_rowlock = (current_app.config.get("SERIALIZATION_MODE",
+    is_rowlock = (get_config("SERIALIZATION_MODE",
         "SERIALIZED") == "ROWLOCK")
     if is_rowlock:
         voters = voters.with_lockmode("update").all()
@@ -697,17 +862,88 @@ def mark_voted_in_minshu(data, **kwargs):
 
 def mark_id_authenticated(data):
     from app import db
-    from models import Voter
+    from models import Voter, VoterStatusCounter
 
     voter = data['voter']
 
     voter.status = Voter.STATUS_VOTED
     voter.modified = datetime.utcnow()
     db.session.add(voter)
+    VoterStatusCounter.increment(voter.election_id, Voter.STATUS_VOTED)
     db.session.commit()
 
     return make_response("", 200)
 
+# cache of checker functions, by checker path
+_checkers = dict()
+
+def resolve_checker(checker_path):
+    '''
+    Returns the checker function given its path, for example
+    "checks.check_ip_blacklisted". Functions are imported only once.
+    '''
+    func = _checkers.get(checker_path, None)
+    if func is None:
+        func_name = checker_path.split(".")[-1]
+        module = __import__(
+            ".".join(checker_path.split(".")[:-1]), globals(), locals(),
+            [func_name], 0)
+        func = _checkers[checker_path] = getattr(module, func_name)
+    return func
+
+def resolve_pipeline(pipeline):
+    '''
+    Imports all the checkers of a pipeline, so that it fails early if any of
+    them does not exist
+    '''
+    for checker_path, kwargs in pipeline:
+        func = resolve_checker(checker_path)
+        if getattr(func, 'is_group', False):
+            resolve_pipeline(kwargs['pipeline'])
+
+def run_checker(data, checker_path, kwargs):
+    '''
+    Calls a checker of a pipeline with the data and its extra parameters
+    '''
+    fargs = dict(data=data)
+    if kwargs is not None:
+        fargs.update(kwargs)
+    return resolve_checker(checker_path)(**fargs)
+
+def commuting_group(data, pipeline, name=None):
+    '''
+    Runs a sub-pipeline of checkers that commute, i.e. that can run in any
+    order with the same result, in the order that rejects requests with the
+    least work according to the stats of this process. See adaptive.py.
+
+    name identifies the group in the stats, by default its checker paths.
+    Example:
+
+    ("checks.commuting_group", dict(name="limits", pipeline=(
+        ("checks.check_tlf_day_max", dict(day_max=5)),
+        ("checks.check_tlf_hour_max", dict(hour_max=3)),
+    )))
+    '''
+    from adaptive import run_group
+
+    if name is None:
+        name = ",".join(checker_path for checker_path, kwargs in pipeline)
+    return run_group(
+        name, pipeline,
+        lambda checker_path, kwargs: run_checker(data, checker_path, kwargs),
+        RET_PIPE_CONTINUE, current_app.config)
+commuting_group.is_group = True
+
+def get_error_codename(response):
+    '''
+    Returns the error_codename of a response returned by error(), or None
+    '''
+    try:
+        return json.loads(response.get_data(as_text=True))\
+            .get('error_codename', None)
+    except (AttributeError, ValueError):
+        return None
+
 def execute_pipeline(data, pipeline = None):
     '''
     Executes a pipeline of functions.
@@ -731,21 +967,16 @@ def execute_pipeline(data, pipeline = None):
       stops and returns that value.
     '''
     if pipeline is None:
-        pipeline = current_app.config.get('REGISTER_CHECKS_PIPELINE', [])
+        pipeline = get_config('REGISTER_CHECKS_PIPELINE', [])
 
     for checker_path, kwargs in pipeline:
-        # get access to the function
-        func_name = checker_path.split(".")[-1]
-        module = __import__(
-            ".".join(checker_path.split(".")[:-1]), globals(), locals(),
-            [func_name], 0)
-        fargs = dict(data=data)
-        if kwargs is not None:
-            fargs.update(kwargs)
-        ret = getattr(module, func_name)(**fargs)
+        ret = run_checker(data, checker_path, kwargs)
         if ret == RET_PIPE_CONTINUE:
             continue
         else:
+            rejected = getattr(ret, 'status_code', 200) >= 400
+            finish_requested_voter(data, rejected, get_error_codename(ret))
             return ret
 
+    finish_requested_voter(data, False)
     return True
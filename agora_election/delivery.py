@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of agora-election.
+# Copyright (C) 2014  Eduardo Robles Elvira <edulix AT agoravoting DOT com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Reliable delivery of the sms messages.
+
+Each message is sent by a send_sms task whose celery task id is the
+idempotency key of the message. The task claims the message (QUEUED ->
+SENDING) with a conditional update before calling the provider, so a message
+is never sent twice even if its task is delivered more than once. Failed
+attempts are retried with exponential backoff up to SMS_MAX_ATTEMPTS times
+and while the token is still valid. Messages that fail permanently are moved
+to the message_dead_letter table and their voters are deactivated, so that
+they can request a new token right away.
+
+reconcile_deliveries (a periodic task, see CELERYBEAT_SCHEDULE) dead-letters
+the messages whose task was lost: still queued after the token expired, or
+stuck sending for more than SMS_SENDING_TIMEOUT_SECS (in that case the sms
+might have been delivered, but it's not retried so that it's not sent twice).
+Messages stuck sending that the provider accepted (their sms_status is
+recorded right after the provider call) are marked as sent instead, keeping
+their voters active.
+'''
+
+import random
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, and_
+
+from app import db, app_flask
+from models import Voter, Message, MessageDeadLetter
+
+# dead letter reasons
+REASON_EXPIRED = "expired"
+REASON_MAX_ATTEMPTS = "max_attempts"
+REASON_STUCK_QUEUED = "stuck_queued"
+REASON_STUCK_SENDING = "stuck_sending"
+
+def enqueue_message(msg, token, is_audio, election_key=None, countdown=None):
+    '''
+    Enqueues the send_sms task of a committed message, using its idempotency
+    key as the task id and passing the current correlation id in its headers
+    '''
+    from tasks import send_sms
+    from tracing import task_headers, log_request_span
+    send_sms.apply_async(
+        kwargs=dict(msg_id=msg.id, token=token, is_audio=is_audio,
+                    election_key=election_key,
+                    idempotency_key=msg.idempotency_key),
+        task_id=msg.idempotency_key,
+        countdown=countdown,
+        headers=task_headers(countdown))
+    log_request_span("request_to_enqueue", message_id=msg.id)
+
+def backoff_secs(attempts, base_secs=None, max_secs=None):
+    '''
+    Returns the number of seconds to wait before the next attempt, doubling
+    after each failed attempt, with some jitter so that retries of messages
+    that failed at the same time are spread
+    '''
+    if base_secs is None:
+        base_secs = app_flask.config.get('SMS_RETRY_BACKOFF_SECS', 5)
+    if max_secs is None:
+        max_secs = app_flask.config.get('SMS_RETRY_BACKOFF_MAX_SECS', 120)
+    secs = min(base_secs * (2 ** max(attempts - 1, 0)), max_secs)
+    return secs * random.uniform(0.8, 1.2)
+
+def claim_message(msg_id, idempotency_key):
+    '''
+    Atomically marks the message as being sent if it's queued. Returns True if
+    this call claimed it, or False if it was already claimed or processed.
+    The caller is responsible of committing.
+    '''
+    claimed = db.session.query(Message)\
+        .filter(Message.id == msg_id,
+                Message.idempotency_key == idempotency_key,
+                Message.status == Message.STATUS_QUEUED)\
+        .update({Message.status: Message.STATUS_SENDING,
+                 Message.modified: datetime.utcnow()},
+                synchronize_session=False)
+    return claimed == 1
+
+def dead_letter(messages, reason):
+    '''
+    Moves the given messages to the dead letter table, marks them as failed
+    and deactivates their voters so that they can request a new token right
+    away. The caller is responsible of committing.
+    '''
+    if not messages:
+        return
+    ids = [msg.id for msg in messages]
+    for msg in messages:
+        logging.warn("dead-lettering message %d (%s): %s" % (
+            msg.id, reason, msg.last_error))
+        db.session.add(MessageDeadLetter(
+            message_id=msg.id,
+            message_created=msg.created,
+            idempotency_key=msg.idempotency_key,
+            tlf=msg.tlf,
+            ip=msg.ip,
+            attempts=msg.attempts,
+            reason=reason,
+            last_error=msg.last_error,
+            correlation_id=msg.correlation_id))
+
+    now = datetime.utcnow()
+    db.session.query(Message).filter(Message.id.in_(ids))\
+        .update({Message.status: Message.STATUS_FAILED,
+                 Message.modified: now},
+                synchronize_session=False)
+    db.session.query(Voter)\
+        .filter(Voter.message_id.in_(ids),
+                Voter.status.in_([Voter.STATUS_CREATED, Voter.STATUS_SENT]))\
+        .update({Voter.is_active: False, Voter.modified: now},
+                synchronize_session=False)
+
+def mark_sent(messages):
+    '''
+    Completes the status update of messages that the provider accepted but
+    that were left sending. The caller is responsible of committing.
+    '''
+    from models import VoterStatusCounter
+
+    if not messages:
+        return
+    ids = [msg.id for msg in messages]
+    now = datetime.utcnow()
+    logging.warn("marking as sent the messages accepted by the provider: %r" %
+                 ids)
+    db.session.query(Message).filter(Message.id.in_(ids))\
+        .update({Message.status: Message.STATUS_SENT,
+                 Message.next_attempt: None,
+                 Message.modified: now},
+                synchronize_session=False)
+    voters = db.session.query(Voter)\
+        .filter(Voter.message_id.in_(ids),
+                Voter.status == Voter.STATUS_CREATED).all()
+    for voter in voters:
+        voter.status = Voter.STATUS_SENT
+        voter.modified = now
+        db.session.add(voter)
+        VoterStatusCounter.increment(voter.election_id, Voter.STATUS_SENT)
+
+def reconcile_deliveries(batch_size=None):
+    '''
+    Dead-letters in batches the messages whose send_sms task was lost. Returns
+    the number of messages dead-lettered.
+    '''
+    if batch_size is None:
+        batch_size = app_flask.config.get('SMS_RECONCILE_BATCH_SIZE', 500)
+    now = datetime.utcnow()
+    queued_cutoff = now - timedelta(
+        seconds=app_flask.config.get('SMS_TOKEN_EXPIRE_SECS', 60*10))
+    sending_cutoff = now - timedelta(
+        seconds=app_flask.config.get('SMS_SENDING_TIMEOUT_SECS', 60*5))
+    clause = or_(
+        and_(Message.status == Message.STATUS_QUEUED,
+             Message.created < queued_cutoff),
+        and_(Message.status == Message.STATUS_SENDING,
+             Message.modified < sending_cutoff))
+
+    total = 0
+    last_id = 0
+    while True:
+        messages = db.session.query(Message)\
+            .filter(clause, Message.id > last_id)\
+            .order_by(Message.id)\
+            .limit(batch_size).all()
+        if not messages:
+            break
+
+        accepted = [msg for msg in messages
+                    if msg.status == Message.STATUS_SENDING and
+                    msg.sms_status == "sent"]
+        mark_sent(accepted)
+        for reason, status in [(REASON_STUCK_QUEUED, Message.STATUS_QUEUED),
+                               (REASON_STUCK_SENDING, Message.STATUS_SENDING)]:
+            dead_letter([msg for msg in messages if msg.status == status and
+                         msg not in accepted], reason)
+        db.session.commit()
+
+        total += len(messages)
+        last_id = messages[-1].id
+        if len(messages) < batch_size:
+            break
+
+    logging.info("reconciled %d lost sms deliveries" % total)
+    return total
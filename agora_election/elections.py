@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of agora-election.
+# Copyright (C) 2014  Eduardo Robles Elvira <edulix AT agoravoting DOT com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Support for serving multiple elections from one deployment.
+
+The ELECTIONS setting maps an election key to a dictionary of settings that
+override the global ones for that election (CURRENT_ELECTION_ID,
+AGORA_ELECTION_DATA_URL, REGISTER_CHECKS_PIPELINE, THEME, etc). Requests are
+routed to an election by host (HOSTS) or by path prefix (PATH_PREFIX) by the
+ElectionDispatcher wsgi middleware. When ELECTIONS is empty, everything works
+as in single election mode using the global settings.
+'''
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from copy import deepcopy
+
+from flask import current_app, g, has_app_context
+from jinja2 import Markup
+
+# key used to store the election key in the wsgi environ
+ENVIRON_KEY = 'agora_election.election_key'
+
+# settings that are loaded lazily by load_election_data
+ELECTION_DATA_KEYS = ('AGORA_ELECTION_DATA', 'AGORA_ELECTION_DATA_STR',
+                      'AGORA_ELECTION_DATA_VERSION')
+
+# keys of the elections whose data has already been loaded (None is the
+# global election)
+_loaded_elections = set()
+_load_lock = threading.Lock()
+
+def get_election_key():
+    '''
+    Returns the key of the election of the current request, or None if we are
+    in single election mode or outside of a request
+    '''
+    if not has_app_context():
+        return None
+    return getattr(g, 'election_key', None)
+
+def get_config(key, default=None, election_key=None):
+    '''
+    Returns a setting value for the given election (by default, the election
+    of the current request), falling back to the global settings.
+
+    The election data settings (ELECTION_DATA_KEYS) are loaded lazily the
+    first time they are accessed. Other settings are read from the config
+    pinned by the current request, if any (see pin_config).
+    '''
+    if election_key is None:
+        election_key = get_election_key()
+    app = current_app._get_current_object() if has_app_context() else None
+    if app is None:
+        from app import app_flask as app
+
+    config = app.config
+    if key not in ELECTION_DATA_KEYS and has_app_context():
+        config = getattr(g, 'pinned_config', None) or app.config
+
+    election = None
+    if election_key is not None:
+        election = config.get('ELECTIONS', {}).get(election_key, None)
+        if election is None:
+            election_key = None
+
+    if key in ELECTION_DATA_KEYS and election_key not in _loaded_elections:
+        ensure_election_data(app, election_key)
+
+    if election_key is not None and key in election:
+        return election[key]
+    return config.get(key, default)
+
+def read_snapshot(path, election_url, max_age):
+    '''
+    Returns the (election, extra_data) stored in the snapshot file if it
+    exists, it's fresh and it's from the same url, or None otherwise
+    '''
+    from toolbox import ensure_private_dir
+    try:
+        # never trust a snapshot that others could have written
+        ensure_private_dir(os.path.dirname(path))
+        if time.time() - os.stat(path).st_mtime > max_age:
+            return None
+        with open(path, 'r', encoding="utf-8") as f:
+            snapshot = json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+    if snapshot.get('url', None) != election_url:
+        return None
+    return snapshot['election'], snapshot['extra_data']
+
+def write_snapshot(path, election_url, election_json, extra_data_json):
+    '''
+    Writes atomically the election data to the snapshot file
+    '''
+    from toolbox import ensure_private_dir
+    try:
+        # only the app user can write the snapshots
+        ensure_private_dir(os.path.dirname(path))
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, 'w', encoding="utf-8") as f:
+            f.write(json.dumps(dict(url=election_url, election=election_json,
+                                    extra_data=extra_data_json)))
+        os.rename(tmp_path, path)
+    except OSError as e:
+        logging.warn("could not write election snapshot %s: %s" % (path, e))
+
+def fetch_election_data(election_url, bauth=None, snapshot_path=None,
+                        snapshot_max_age=0):
+    '''
+    Fetches the election and its extra data from agora, or from a local file
+    if election_url is not an http url.
+
+    If snapshot_path is set, http fetches are cached on disk there and reused
+    while they are newer than snapshot_max_age seconds.
+    '''
+    if election_url.startswith("http"):
+        if snapshot_path is not None:
+            ret = read_snapshot(snapshot_path, election_url, snapshot_max_age)
+            if ret is not None:
+                logging.debug("using election snapshot %s" % snapshot_path)
+                return ret
+
+        import requests
+        election_json = requests.get(election_url, verify=False,
+                                     auth=bauth).json()
+        extra_data_json =  requests.get(election_url + "extra_data/",
+                                        verify=False, auth=bauth).json()
+    else:
+        with open(election_url, 'r', encoding="utf-8") as f:
+            election_json = json.loads(f.read())
+            # NOTE: do not support extra_data in this mode
+            extra_data_json = dict()
+        return election_json, extra_data_json
+
+    if snapshot_path is not None:
+        write_snapshot(snapshot_path, election_url, election_json,
+                       extra_data_json)
+    return election_json, extra_data_json
+
+def load_election_data(app, election_key=None):
+    '''
+    Fetches the election data for the given election (or the global one if
+    election_key is None) and caches it in the settings of that election as
+    AGORA_ELECTION_DATA, AGORA_ELECTION_DATA_STR (embedded in the index page)
+    and AGORA_ELECTION_DATA_VERSION (a hash of the data).
+    '''
+    if election_key is None:
+        settings = app.config
+        edata = settings.get('AGORA_ELECTION_DATA', {})
+    else:
+        settings = app.config['ELECTIONS'][election_key]
+        # per election data is built on top of the global data
+        edata = deepcopy(app.config.get('AGORA_ELECTION_DATA', {}))
+        edata.update(settings.get('AGORA_ELECTION_DATA', {}))
+        if 'ALLOWED_TLF_NUMS_RX' in settings:
+            edata['tlf_no_rx'] = settings['ALLOWED_TLF_NUMS_RX']
+        if 'AUTH_METHOD' in settings:
+            edata['auth_method'] = settings['AUTH_METHOD']
+
+    election_url = settings.get('AGORA_ELECTION_DATA_URL',
+                                app.config['AGORA_ELECTION_DATA_URL'])
+    bauth = settings.get('AGORA_ELECTION_DATA_BASIC_AUTH',
+                         app.config.get('AGORA_ELECTION_DATA_BASIC_AUTH', None))
+    logging.debug("loading election data for election '%s' from %s" % (
+        election_key, election_url))
+    snapshot_dir = app.config.get('ELECTION_SNAPSHOT_DIR', None)
+    snapshot_path = None
+    if snapshot_dir:
+        snapshot_path = os.path.join(snapshot_dir, "%s.json" % (
+            election_key or "default"))
+    election_json, extra_data_json = fetch_election_data(
+        election_url, bauth, snapshot_path,
+        app.config.get('ELECTION_SNAPSHOT_MAX_AGE_SECS', 300))
+
+    edata['election'] = election_json
+    edata['election_extra_data'] = extra_data_json
+    settings['AGORA_ELECTION_DATA'] = edata
+
+    # the tally log is not embedded in the index page, results are served
+    # precomputed in GET /api/v1/results/
+    embedded = dict(edata)
+    embedded['election_extra_data'] = dict(
+        (key, value) for key, value in extra_data_json.items()
+        if key != 'tally_log')
+    data_str = json.dumps(edata, sort_keys=True)
+    settings['AGORA_ELECTION_DATA_VERSION'] = hashlib.sha1(
+        data_str.encode('utf-8')).hexdigest()
+    settings['AGORA_ELECTION_DATA_STR'] = Markup(json.dumps(embedded))
+    settings['AGORA_ELECTION_DATA_LOADED'] = time.time()
+
+def ensure_election_data(app, election_key=None):
+    '''
+    Loads the data of the given election if it has not been loaded yet
+    '''
+    with _load_lock:
+        if election_key not in _loaded_elections:
+            load_election_data(app, election_key)
+            _loaded_elections.add(election_key)
+
+def refresh_election_data(app, election_key=None):
+    '''
+    Fetches again the data of the given election without blocking the
+    requests meanwhile. The data is loaded into a copy of the settings, and
+    it's only stored if the config of the app was not replaced (see
+    replace_config) nor the data invalidated (see reset_election_data) while
+    it was being fetched. Returns True if it was stored.
+    '''
+    from types import SimpleNamespace
+
+    config = app.config
+    scratch = dict(config)
+    scratch['AGORA_ELECTION_DATA'] = deepcopy(
+        config.get('AGORA_ELECTION_DATA', {}))
+    scratch['ELECTIONS'] = dict(
+        (key, dict(settings))
+        for key, settings in config.get('ELECTIONS', {}).items())
+    holder = SimpleNamespace(config=scratch)
+    load_election_data(holder, election_key)
+
+    if election_key is None:
+        settings, loaded = config, scratch
+    else:
+        settings = config['ELECTIONS'][election_key]
+        loaded = scratch['ELECTIONS'][election_key]
+    with _load_lock:
+        if app.config is not config or election_key not in _loaded_elections:
+            return False
+        for key in ELECTION_DATA_KEYS + ('AGORA_ELECTION_DATA_LOADED',):
+            settings[key] = loaded[key]
+    return True
+
+def election_data_age(app, election_key=None):
+    '''
+    Returns the seconds since the data of the given election was loaded, or
+    None if it's not loaded
+    '''
+    if election_key not in _loaded_elections:
+        return None
+    if election_key is None:
+        settings = app.config
+    else:
+        settings = app.config['ELECTIONS'].get(election_key, {})
+    loaded = settings.get('AGORA_ELECTION_DATA_LOADED', None)
+    if loaded is None:
+        return None
+    return time.time() - loaded
+
+def reset_election_data():
+    '''
+    Marks the data of all elections as not loaded, so that it's loaded again
+    the next time it's needed
+    '''
+    with _load_lock:
+        _loaded_elections.clear()
+
+def replace_config(app, config, loaded_elections):
+    '''
+    Replaces atomically the config of the app with a new one, whose election
+    data has already been loaded for the given election keys
+    '''
+    with _load_lock:
+        app.config = config
+        _loaded_elections.clear()
+        _loaded_elections.update(loaded_elections)
+
+def pin_config():
+    '''
+    before_request hook that pins the config for the whole request, so that
+    if the settings are reloaded meanwhile (see hotreload.py), get_config
+    keeps returning the settings the request started with
+    '''
+    g.pinned_config = current_app.config
+
+def load_all_election_data(app):
+    '''
+    Loads the data of the global election and of each election in ELECTIONS
+    '''
+    ensure_election_data(app)
+    for election_key in app.config.get('ELECTIONS', {}):
+        ensure_election_data(app, election_key)
+
+def set_request_election():
+    '''
+    before_request hook that sets the election key of the current request, as
+    set by the ElectionDispatcher middleware
+    '''
+    from flask import request
+    g.election_key = request.environ.get(ENVIRON_KEY, None)
+
+class ElectionDispatcher(object):
+    '''
+    WSGI middleware that selects the election of each request by host or by
+    path prefix, using the HOSTS and PATH_PREFIX settings of each election in
+    ELECTIONS. The path prefix is moved from PATH_INFO to SCRIPT_NAME so that
+    the application routes and url_for work unchanged.
+    '''
+
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+
+    def match(self, environ):
+        '''
+        Returns the (election_key, path_prefix) for the given request environ,
+        or (None, None) if no election matches
+        '''
+        host = environ.get('HTTP_HOST', '').split(':')[0]
+        path = environ.get('PATH_INFO', '')
+        for election_key, settings in self.app.config.get('ELECTIONS', {}).items():
+            if host in settings.get('HOSTS', []):
+                return election_key, None
+            prefix = settings.get('PATH_PREFIX', None)
+            if prefix and (path == prefix or path.startswith(prefix + '/')):
+                return election_key, prefix
+        return None, None
+
+    def __call__(self, environ, start_response):
+        election_key, prefix = self.match(environ)
+        environ[ENVIRON_KEY] = election_key
+        if prefix is not None:
+            environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + prefix
+            environ['PATH_INFO'] = environ['PATH_INFO'][len(prefix):] or '/'
+        return self.wsgi_app(environ, start_response)
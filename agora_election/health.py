@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of agora-election.
+# Copyright (C) 2014  Eduardo Robles Elvira <edulix AT agoravoting DOT com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Liveness and readiness probes for load balancers and orchestrators.
+
+GET /healthz answers 200 while the process is able to serve requests, without
+doing any I/O.
+
+GET /readyz answers 200 if the worker is ready to receive traffic and 503
+otherwise. A worker is not ready until its warmup is done (see app.warmup),
+nor if any of the READYZ_CRITICAL_CHECKS fails:
+
+  * db: a connection is checked out of the pool and answers "SELECT 1" in
+    less than READYZ_DB_MAX_LATENCY_MS
+  * broker: the celery broker accepts a connection within
+    READYZ_BROKER_TIMEOUT_SECS (skipped with CELERY_ALWAYS_EAGER)
+  * election_data: the data of all the elections is loaded. Data older than
+    READYZ_ELECTION_DATA_MAX_AGE_SECS (if set) is reported as stale and
+    refreshed in background, but it does not make the worker not ready: all
+    the workers would drop out at the same time
+  * captcha: there are at least READYZ_CAPTCHA_MIN pregenerated captchas, if
+    any election shows captchas in the registration
+  * sms_providers: at least one of the sms providers in use was healthy in
+    the last check (see sms.check_providers)
+
+The results of all the checks are returned in both cases. They are computed
+at most once every READYZ_CACHE_SECS per process, so that frequent probes
+stay cheap.
+'''
+
+import json
+import time
+import logging
+import threading
+
+from flask import Blueprint, make_response, current_app
+
+health = Blueprint('health', __name__)
+
+_warmed_up = False
+
+# last readiness result: 'time' -> timestamp, 'result' -> (ready, checks)
+_ready_cache = dict()
+_ready_lock = threading.Lock()
+
+# held while stale election data is being refreshed
+_refresh_lock = threading.Lock()
+
+def mark_warmed_up():
+    '''
+    Called when the warmup of the process is done. Forked workers inherit it.
+    '''
+    global _warmed_up
+    _warmed_up = True
+
+def check_db(config):
+    from app import db
+
+    max_latency_ms = config.get('READYZ_DB_MAX_LATENCY_MS', 500)
+    start = time.time()
+    conn = db.engine.connect()
+    try:
+        conn.execute("SELECT 1").scalar()
+    finally:
+        conn.close()
+    latency_ms = (time.time() - start) * 1000
+    return dict(ok=latency_ms <= max_latency_ms,
+                latency_ms=round(latency_ms, 1))
+
+def check_broker(config):
+    from app import app as celery_app
+
+    if config.get('CELERY_ALWAYS_EAGER', False):
+        return dict(ok=True, skipped=True)
+    timeout = config.get('READYZ_BROKER_TIMEOUT_SECS', 1)
+    start = time.time()
+    conn = celery_app.connection(connect_timeout=timeout)
+    try:
+        conn.ensure_connection(max_retries=1)
+    finally:
+        conn.release()
+    return dict(ok=True, latency_ms=round((time.time() - start) * 1000, 1))
+
+def refresh_election_data(app, election_keys):
+    '''
+    Reloads the data of the given elections in a background thread, unless a
+    refresh is already running
+    '''
+    from elections import refresh_election_data as refresh_data
+
+    if not _refresh_lock.acquire(False):
+        return
+
+    def refresh():
+        try:
+            for election_key in election_keys:
+                try:
+                    refresh_data(app, election_key)
+                except Exception:
+                    logging.exception("could not refresh the data of "
+                                      "election %s" % election_key)
+        finally:
+            _refresh_lock.release()
+
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+
+def check_election_data(config):
+    from elections import ensure_election_data, election_data_age
+
+    app = current_app._get_current_object()
+    max_age = config.get('READYZ_ELECTION_DATA_MAX_AGE_SECS', None)
+    ages = dict()
+    stale = []
+    ok = True
+    for election_key in [None] + list(config.get('ELECTIONS', {}).keys()):
+        # loads it if it was invalidated, otherwise the worker would never
+        # become ready again
+        ensure_election_data(app, election_key)
+        age = election_data_age(app, election_key)
+        ages[election_key or "default"] = round(age) if age is not None\
+            else None
+        if age is None:
+            ok = False
+        elif max_age is not None and age > max_age:
+            stale.append(election_key)
+    if stale:
+        refresh_election_data(app, stale)
+    return dict(ok=ok, age_secs=ages,
+                stale=[election_key or "default" for election_key in stale])
+
+def check_captcha(config):
+    from flask.ext.captcha.models import CaptchaStore
+    from toolbox import get_read_session
+
+    elections = [config] + list(config.get('ELECTIONS', {}).values())
+    if not any(e.get('REGISTER_SHOWS_CAPTCHA', None) for e in elections):
+        return dict(ok=True, skipped=True)
+    min_count = config.get('READYZ_CAPTCHA_MIN', 10)
+    count = get_read_session().query(CaptchaStore).count()
+    return dict(ok=count >= min_count, count=count)
+
+def check_sms_providers(config):
+    from sms import get_monitored_providers, get_providers_status
+
+    names = [p.provider_name for p in get_monitored_providers()]
+    status = get_providers_status()
+    checked = [status[name] for name in names if name in status]
+    if not checked:
+        # not checked yet
+        return dict(ok=True, providers=dict())
+    return dict(ok=any(s['healthy'] for s in checked),
+                providers=dict((s['provider'], s['healthy'])
+                               for s in checked))
+
+CHECKS = (
+    ('db', check_db),
+    ('broker', check_broker),
+    ('election_data', check_election_data),
+    ('captcha', check_captcha),
+    ('sms_providers', check_sms_providers),
+)
+
+def run_checks(config):
+    '''
+    Runs all the checks, returning (ready, dict of check name -> result)
+    '''
+    critical = config.get('READYZ_CRITICAL_CHECKS',
+                          ['db', 'broker', 'election_data'])
+    results = dict()
+    ready = True
+    for name, check in CHECKS:
+        try:
+            result = check(config)
+        except Exception as e:
+            logging.warn("readiness check %s failed: %s" % (name, e))
+            result = dict(ok=False, error=str(e))
+        result['critical'] = name in critical
+        results[name] = result
+        if not result['ok'] and result['critical']:
+            ready = False
+    return ready, results
+
+def get_readiness(config):
+    '''
+    Returns the cached (ready, checks), running the checks again if they are
+    older than READYZ_CACHE_SECS. Concurrent probes wait for the same run.
+    '''
+    cache_secs = config.get('READYZ_CACHE_SECS', 2)
+    with _ready_lock:
+        now = time.time()
+        if 'time' not in _ready_cache or\
+                now - _ready_cache['time'] >= cache_secs:
+            _ready_cache['result'] = run_checks(config)
+            _ready_cache['time'] = time.time()
+        return _ready_cache['result']
+
+def json_response(data, status):
+    response = make_response(json.dumps(data), status)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@health.route('/healthz', methods=['GET'])
+def healthz():
+    '''
+    Liveness probe
+    '''
+    return json_response(dict(alive=True), 200)
+
+@health.route('/readyz', methods=['GET'])
+def readyz():
+    '''
+    Readiness probe. Example response:
+
+    {
+        "ready": true,
+        "version": "3f2a6c0d9e1b",
+        "checks": {
+            "db": {"ok": true, "latency_ms": 1.3, "critical": true},
+            ...
+        }
+    }
+    '''
+    config = current_app.config
+    if not _warmed_up:
+        return json_response(dict(ready=False, warmup=False,
+                                  version=config.get('CONFIG_VERSION', None),
+                                  checks=dict()), 503)
+
+    ready, checks = get_readiness(config)
+    return json_response(dict(ready=ready, warmup=True,
+                              version=config.get('CONFIG_VERSION', None),
+                              checks=checks), 200 if ready else 503)
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of agora-election.
+# Copyright (C) 2014  Eduardo Robles Elvira <edulix AT agoravoting DOT com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Hot reload of the settings, without restarting the processes.
+
+The settings (settings.py, custom_settings.py and the AGORA_ELECTION_SETTINGS
+file) are read again into a new config, which is validated before it's used:
+the checkers of all the *_PIPELINE settings are imported and their arguments
+checked, the *_RX regular expressions are compiled and the election data is
+loaded. If anything fails, the current config is kept. Otherwise the new
+config replaces the current one atomically, and the requests that already
+started keep using the config they started with (see elections.pin_config).
+
+A reload is triggered:
+
+  * in all the web and celery worker processes, with
+    "./app.py --reload-settings", which validates the settings and publishes
+    the "settings" invalidation topic (see invalidation.py)
+  * in the --serve server and in the development server, with SIGUSR2 or
+    when the AGORA_ELECTION_SETTINGS file changes
+
+Settings used only at startup (database, broker, mail, captcha, server) still
+need a restart (SIGHUP with --serve). The version of the active config is a
+hash of the settings files, CONFIG_VERSION, shown in GET /api/v1/admin/config/.
+'''
+
+import os
+import re
+import sys
+import signal
+import hashlib
+import inspect
+import logging
+import importlib
+import threading
+from types import SimpleNamespace
+from datetime import datetime
+
+from flask import Config, current_app, has_app_context
+
+_reload_lock = threading.Lock()
+
+def settings_version():
+    '''
+    Returns a hash of the contents of the settings files, so that all the
+    processes using the same files report the same version
+    '''
+    import settings
+    settings_dir = os.path.dirname(os.path.abspath(settings.__file__))
+    paths = [os.path.join(settings_dir, "settings.py"),
+             os.path.join(settings_dir, "custom_settings.py"),
+             os.environ.get('AGORA_ELECTION_SETTINGS', None)]
+    digest = hashlib.sha1()
+    for path in paths:
+        if path and os.path.isfile(path):
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+def read_config(app):
+    '''
+    Reads the settings into a new config. It starts as a copy of the current
+    one, so that the defaults set by the extensions at startup are kept.
+    '''
+    if 'custom_settings' in sys.modules:
+        importlib.reload(sys.modules['custom_settings'])
+    importlib.reload(sys.modules['settings'])
+
+    config = Config(app.root_path, app.config)
+    config.from_object(sys.modules['settings'])
+    if os.environ.get('AGORA_ELECTION_SETTINGS', None) is not None:
+        config.from_envvar('AGORA_ELECTION_SETTINGS', silent=False)
+    return config
+
+def validate_pipeline(name, pipeline):
+    '''
+    Returns the list of errors of a pipeline: checkers that can't be imported
+    or that don't accept the given arguments
+    '''
+    from checks import resolve_checker
+
+    errors = []
+    try:
+        steps = list(pipeline)
+    except TypeError:
+        return ["%s: not a list of (checker, kwargs) pairs" % name]
+
+    for i, step in enumerate(steps):
+        try:
+            checker_path, kwargs = step
+        except (TypeError, ValueError):
+            errors.append("%s[%d]: not a (checker, kwargs) pair" % (name, i))
+            continue
+        if kwargs is not None and not isinstance(kwargs, dict):
+            errors.append("%s[%d] %s: kwargs is not a dict" % (
+                name, i, checker_path))
+            continue
+        try:
+            func = resolve_checker(checker_path)
+            inspect.signature(func).bind(data=None, **(kwargs or {}))
+        except Exception as e:
+            errors.append("%s[%d] %s: %s" % (name, i, checker_path, e))
+            continue
+        if getattr(func, 'is_group', False):
+            errors += validate_pipeline("%s[%d].pipeline" % (name, i),
+                                        kwargs['pipeline'])
+    return errors
+
+def validate_config(config):
+    '''
+    Returns the list of errors found in the pipelines and regular expressions
+    of the global settings and of each election
+    '''
+    errors = []
+    scopes = [(None, config)] + list(config.get('ELECTIONS', {}).items())
+    for election_key, settings in scopes:
+        for key, value in settings.items():
+            name = key if election_key is None else\
+                "ELECTIONS[%s].%s" % (election_key, key)
+            if key.endswith('_PIPELINE'):
+                errors += validate_pipeline(name, value)
+            elif key.endswith('_RX') and isinstance(value, str):
+                try:
+                    re.compile(value)
+                except re.error as e:
+                    errors.append("%s: %s" % (name, e))
+    return errors
+
+def load_election_data_into(config):
+    '''
+    Loads the data of all the elections into the config, before it's used.
+    Returns the keys of the loaded elections.
+    '''
+    from elections import load_election_data
+
+    holder = SimpleNamespace(config=config)
+    election_keys = [None] + list(config.get('ELECTIONS', {}).keys())
+    for election_key in election_keys:
+        load_election_data(holder, election_key)
+    return election_keys
+
+def set_version(config, version):
+    config['CONFIG_VERSION'] = version
+    config['CONFIG_LOADED'] = datetime.utcnow().isoformat()
+    config['CONFIG_ERRORS'] = []
+
+def reload_settings(app=None, force=False, publish=False):
+    '''
+    Reads, validates and applies the settings of the app (by default, the
+    current one). Unless force is set, nothing is done if the settings files
+    did not change. If publish is set, the other processes are told to reload
+    them too.
+
+    Returns the list of errors found, in which case the current config is
+    kept.
+    '''
+    from app import db
+    from elections import replace_config
+
+    if app is None:
+        app = current_app._get_current_object() if has_app_context() else None
+    if app is None:
+        from app import app_flask as app
+
+    with _reload_lock:
+        version = settings_version()
+        if not force and version == app.config.get('CONFIG_VERSION'):
+            return []
+
+        try:
+            config = read_config(app)
+            errors = validate_config(config)
+            if not errors:
+                election_keys = load_election_data_into(config)
+        except Exception as e:
+            logging.exception("settings reload: could not read the settings")
+            errors = [str(e)]
+
+        if errors:
+            for e in errors:
+                logging.error("settings reload: %s" % e)
+            app.config['CONFIG_ERRORS'] = errors
+            return errors
+
+        set_version(config, version)
+        replace_config(app, config, election_keys)
+        logging.info("settings reloaded, config version %s" % version)
+
+    if publish:
+        from invalidation import publish as publish_topic, TOPIC_SETTINGS
+        with app.app_context():
+            publish_topic(TOPIC_SETTINGS)
+            db.session.commit()
+    return []
+
+def on_settings_invalidated(topic):
+    reload_settings()
+
+def install_signal_handler(app):
+    '''
+    Reloads the settings of the app when the process receives SIGUSR2
+    '''
+    def on_signal(signum, frame):
+        # not in the signal handler, which would block the main thread
+        threading.Thread(target=reload_settings, args=(app,)).start()
+
+    signal.signal(signal.SIGUSR2, on_signal)
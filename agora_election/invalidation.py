@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of agora-election.
+# Copyright (C) 2014  Eduardo Robles Elvira <edulix AT agoravoting DOT com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Cross-process cache invalidation bus.
+
+In-process cache owners subscribe a callback to a named topic, and the code
+that changes the cached data publishes to that topic in the same transaction
+as the change. When the transaction commits, the callbacks are called in
+every web and celery worker process, in a background listener thread.
+
+Publishing bumps the version of the topic in the cache_version table and,
+with postgresql, sends a NOTIFY, so that the listeners (using LISTEN) get it
+within milliseconds. Without postgresql (e.g. sqlite), the listeners poll
+the cache_version table every INVALIDATION_POLL_SECS. Listeners also compare
+the versions after (re)connecting, so no invalidation is lost.
+
+INVALIDATION_BACKEND is "auto" (notify with postgresql, poll otherwise),
+"notify", "poll" or None to disable the listeners.
+'''
+
+import os
+import time
+import select
+import logging
+import threading
+
+# NOTE: nothing subscribes to colorlist yet, so it's only published by the
+# admin commands and not by the checkers that blacklist automatically, to
+# keep the cache_version row out of the register transactions
+TOPIC_COLORLIST = "colorlist"
+TOPIC_ELECTION_DATA = "election_data"
+TOPIC_SETTINGS = "settings"
+TOPIC_SMS_PROVIDERS = "sms_providers"
+
+TOPICS = (TOPIC_COLORLIST, TOPIC_ELECTION_DATA, TOPIC_SETTINGS,
+          TOPIC_SMS_PROVIDERS)
+
+# topic -> list of callbacks
+_subscribers = dict()
+_lock = threading.Lock()
+_listener = None
+
+def channel_name(topic):
+    return "aelection_%s" % topic
+
+def subscribe(topic, callback):
+    '''
+    Subscribes a callback, called with the topic as argument when the topic
+    is published. Callbacks are called from the listener thread.
+    '''
+    if topic not in TOPICS:
+        raise Exception("unknown invalidation topic '%s'" % topic)
+    with _lock:
+        _subscribers.setdefault(topic, []).append(callback)
+
+def dispatch(topic):
+    with _lock:
+        callbacks = list(_subscribers.get(topic, []))
+    for callback in callbacks:
+        try:
+            callback(topic)
+        except Exception:
+            logging.exception("invalidation: error in callback for '%s'" % topic)
+
+def publish(topic, session=None):
+    '''
+    Publishes an invalidation of the topic, delivered to the subscribers of
+    all processes when the current transaction of the session commits. The
+    caller is responsible of committing.
+    '''
+    from app import db
+    from models import CacheVersion
+
+    if session is None:
+        session = db.session
+    cls = CacheVersion
+    updated = session.query(cls).filter(cls.topic == topic)\
+        .update({cls.version: cls.version + 1}, synchronize_session=False)
+    if updated == 0:
+        session.add(cls(topic=topic, version=1))
+    if session.bind is not None and\
+            session.bind.dialect.name == 'postgresql':
+        session.execute("SELECT pg_notify(:channel, :payload)",
+                        dict(channel=channel_name(topic),
+                             payload=str(os.getpid())))
+
+
+class InvalidationListener(threading.Thread):
+    '''
+    Background thread that receives the invalidations and dispatches them
+    '''
+
+    def __init__(self, app, backend, poll_secs):
+        super(InvalidationListener, self).__init__()
+        self.daemon = True
+        self.app = app
+        self.backend = backend
+        self.poll_secs = poll_secs
+        self.pid = os.getpid()
+        self.versions = None
+
+    def get_engine(self):
+        from app import db
+        return db.get_engine(self.app)
+
+    def dispatch(self, topic):
+        with self.app.app_context():
+            dispatch(topic)
+
+    def check_versions(self):
+        '''
+        Dispatches the topics whose version changed since the last check. The
+        first time, it only takes note of the current versions.
+        '''
+        from models import CacheVersion
+        table = CacheVersion.__table__
+        with self.get_engine().connect() as conn:
+            versions = dict((row[table.c.topic], row[table.c.version])
+                            for row in conn.execute(table.select()))
+        if self.versions is not None:
+            for topic, version in versions.items():
+                if self.versions.get(topic, None) != version:
+                    self.dispatch(topic)
+        self.versions = versions
+
+    def poll(self):
+        while True:
+            self.check_versions()
+            time.sleep(self.poll_secs)
+
+    def listen(self):
+        raw_conn = self.get_engine().raw_connection()
+        # the connection is switched to autocommit and kept open while
+        # listening: take it out of the pool, so that it's never reused
+        raw_conn.detach()
+        conn = raw_conn.connection
+        try:
+            conn.set_isolation_level(0)  # autocommit
+            cursor = conn.cursor()
+            for topic in TOPICS:
+                cursor.execute('LISTEN "%s"' % channel_name(topic))
+            # catch up with what was published while not listening
+            self.check_versions()
+
+            channels = dict((channel_name(topic), topic) for topic in TOPICS)
+            while True:
+                ready = select.select([conn], [], [], self.poll_secs)
+                if ready == ([], [], []):
+                    continue
+                conn.poll()
+                topics = set()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    if notify.channel in channels:
+                        topics.add(channels[notify.channel])
+                for topic in topics:
+                    self.dispatch(topic)
+        finally:
+            conn.close()
+
+    def run(self):
+        while True:
+            try:
+                if self.backend == "notify":
+                    self.listen()
+                else:
+                    self.poll()
+            except Exception:
+                logging.exception("invalidation: listener error, retrying")
+                time.sleep(self.poll_secs)
+
+def ensure_listener():
+    '''
+    Starts the listener thread of this process if it's not running. It's
+    safe to call it often (e.g. before each request): forked processes do not
+    inherit the thread of their parent, so it's started again in them.
+    '''
+    global _listener
+    if _listener is not None and _listener.pid == os.getpid():
+        return
+    from flask import current_app, has_app_context
+    from app import db
+    if has_app_context():
+        app_flask = current_app._get_current_object()
+    else:
+        from app import app_flask
+
+    backend = app_flask.config.get('INVALIDATION_BACKEND', 'auto')
+    if backend is None:
+        return
+    with _lock:
+        if _listener is not None and _listener.pid == os.getpid():
+            return
+        if backend == "auto":
+            is_postgres = db.get_engine(app_flask).dialect.name == 'postgresql'
+            backend = "notify" if is_postgres else "poll"
+        _listener = InvalidationListener(
+            app_flask, backend,
+            app_flask.config.get('INVALIDATION_POLL_SECS', 1))
+        _listener.start()
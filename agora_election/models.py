@@ -16,8 +16,11 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import uuid
 from app import db
 from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 
 class Voter(db.Model):
     '''
@@ -25,6 +28,19 @@ class Voter(db.Model):
     '''
     __tablename__ = 'voter'
 
+    # composite indexes leading with election_id, as all the voter queries in
+    # the critical paths are scoped by election
+    __table_args__ = (
+        db.Index('ix_voter_election_tlf_status', 'election_id', 'tlf',
+                 'status'),
+        db.Index('ix_voter_election_dni_status', 'election_id', 'dni',
+                 'status'),
+        db.Index('ix_voter_election_ip_status', 'election_id', 'ip',
+                 'status'),
+        # keyset pagination of the voters of an election (admin API)
+        db.Index('ix_voter_election_id', 'election_id', 'id'),
+    )
+
     # Everytime an user request to identify, we register it in the database with
     # this status, even if it fails for whatever reason (for example if it's
     # in the blacklist)
@@ -60,7 +76,7 @@ class Voter(db.Model):
 
     created = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
-    modified = db.Column(db.DateTime, default=datetime.utcnow)
+    modified = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
     ip = db.Column(db.String(45), index=True)
 
@@ -92,6 +108,12 @@ class Voter(db.Model):
     # created|sms-sent|authenticated|voted
     status = db.Column(db.Integer, index=True)
 
+    # error_codename of the response, if the registration request was rejected
+    error_codename = db.Column(db.String(40), nullable=True)
+
+    # correlation id of the request that created it (see tracing.py)
+    correlation_id = db.Column(db.String(64), nullable=True)
+
     def __init__(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
@@ -143,11 +165,17 @@ class Message(db.Model):
     STATUS_SENT = 1
     STATUS_IGNORE =  2
 
+    # claimed by a send_sms task, being sent to the provider
+    STATUS_SENDING = 3
+
+    # delivery failed permanently, moved to the dead letter table
+    STATUS_FAILED = 4
+
     id = db.Column(db.Integer, db.Sequence('message_id_seq'), primary_key=True)
 
     created = db.Column(db.DateTime, default=datetime.utcnow)
 
-    modified = db.Column(db.DateTime, default=datetime.utcnow)
+    modified = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
     tlf = db.Column(db.String(20), index=True)
 
@@ -168,9 +196,406 @@ class Message(db.Model):
 
     sms_response = db.Column(db.String(400), default="")
 
+    # provider that sent the message, and the providers tried when routing
+    # (see RoutingSMSProvider)
+    sms_provider = db.Column(db.String(20), default="")
+
+    sms_routing = db.Column(db.String(400), default="")
+
+    # unique key of the delivery, used as the celery task id so that the
+    # message is never sent twice
+    idempotency_key = db.Column(db.String(64), unique=True, index=True,
+                                default=lambda: uuid.uuid4().hex)
+
+    # number of failed delivery attempts
+    attempts = db.Column(db.Integer, default=0)
+
+    next_attempt = db.Column(db.DateTime, nullable=True)
+
+    last_error = db.Column(db.String(400), default="")
+
+    # correlation id of the request that created it (see tracing.py)
+    correlation_id = db.Column(db.String(64), nullable=True)
+
     def __init__(self, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
 
     def __repr__(self):
         return '<Message %r>' % self.id
+
+
+class VoterArchive(db.Model):
+    '''
+    Stale voters moved out of the voter table by the archival job (see
+    archive.py). Same columns as Voter, plus the archival date. message_id is
+    not a foreign key so that messages can be archived independently.
+    '''
+    __tablename__ = 'voter_archive'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    election_id = db.Column(db.Integer, index=True)
+
+    created = db.Column(db.DateTime, index=True)
+
+    modified = db.Column(db.DateTime)
+
+    ip = db.Column(db.String(45), index=True)
+
+    tlf = db.Column(db.String(20), index=True)
+
+    first_name = db.Column(db.String(60))
+
+    last_name = db.Column(db.String(100))
+
+    email = db.Column(db.String(140))
+
+    dni = db.Column(db.String(512))
+
+    postal_code = db.Column(db.String(140))
+
+    lang_code = db.Column(db.String(6))
+
+    receive_mail_updates = db.Column(db.Boolean)
+
+    token_guesses = db.Column(db.Integer, default=0)
+
+    message_id = db.Column(db.Integer, index=True)
+
+    is_active = db.Column(db.Boolean)
+
+    status = db.Column(db.Integer, index=True)
+
+    error_codename = db.Column(db.String(40), nullable=True)
+
+    correlation_id = db.Column(db.String(64), nullable=True)
+
+    archived = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return '<VoterArchive %r>' % self.id
+
+
+class MessageArchive(db.Model):
+    '''
+    Expired messages moved out of the message table by the archival job (see
+    archive.py). Same columns as Message, plus the archival date.
+    '''
+    __tablename__ = 'message_archive'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    created = db.Column(db.DateTime)
+
+    modified = db.Column(db.DateTime)
+
+    tlf = db.Column(db.String(20), index=True)
+
+    ip = db.Column(db.String(45), index=True)
+
+    content = db.Column(db.String(160))
+
+    token = db.Column(db.String(256))
+
+    authenticated = db.Column(db.Boolean, default=False)
+
+    lang_code = db.Column(db.String(6))
+
+    status = db.Column(db.Integer, index=True)
+
+    sms_status = db.Column(db.String(20), default="")
+
+    sms_response = db.Column(db.String(400), default="")
+
+    sms_provider = db.Column(db.String(20), default="")
+
+    sms_routing = db.Column(db.String(400), default="")
+
+    idempotency_key = db.Column(db.String(64), index=True)
+
+    attempts = db.Column(db.Integer, default=0)
+
+    last_error = db.Column(db.String(400), default="")
+
+    correlation_id = db.Column(db.String(64), nullable=True)
+
+    archived = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return '<MessageArchive %r>' % self.id
+
+
+class VoterStatusCounter(db.Model):
+    '''
+    Incrementally maintained counter of the number of voters that have
+    reached each status in an election, so that stats can be served without
+    scanning the voter table.
+
+    Each counter is split in VOTER_STATUS_COUNTER_SHARDS rows, summed on read
+    (see sum_counts), and the increments are applied right after the commit of
+    the transaction that made the status transitions, in their own short
+    transaction. This way the counters are not hot rows inside the
+    serializable critical paths, and the increments of rolled back (e.g.
+    retried) transactions are discarded.
+    '''
+    __tablename__ = 'voter_status_counter'
+
+    election_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    status = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    shard = db.Column(db.Integer, primary_key=True, autoincrement=False,
+                      default=0)
+
+    count = db.Column(db.Integer, default=0, nullable=False)
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return '<VoterStatusCounter %r,%r,%r>' % (self.election_id,
+                                                  self.status, self.shard)
+
+    @staticmethod
+    def increment(election_id, status, amount=1, session=None):
+        '''
+        Increments the counter for the given election and status when the
+        current transaction of the session commits. The caller is responsible
+        of committing.
+        '''
+        if session is None:
+            session = db.session
+        pending = session.info.setdefault('voter_status_counter', dict())
+        key = (election_id, status)
+        pending[key] = pending.get(key, 0) + amount
+
+    @staticmethod
+    def apply_increments(engine, increments, num_shards):
+        '''
+        Adds the increments, a dict of (election_id, status) -> amount, each
+        one to a random shard of its counter, in short read committed
+        transactions.
+        '''
+        import random
+        from sqlalchemy import and_
+        from sqlalchemy.exc import IntegrityError
+
+        table = VoterStatusCounter.__table__
+        for (election_id, status), amount in increments.items():
+            shard = random.randrange(max(num_shards, 1))
+            where = and_(table.c.election_id == election_id,
+                         table.c.status == status,
+                         table.c.shard == shard)
+            for attempt in range(3):
+                try:
+                    with engine.connect() as conn:
+                        if engine.dialect.name == 'postgresql':
+                            conn = conn.execution_options(
+                                isolation_level="READ COMMITTED")
+                        with conn.begin():
+                            updated = conn.execute(table.update().where(where)
+                                .values(count=table.c.count + amount)).rowcount
+                            if updated == 0:
+                                conn.execute(table.insert().values(
+                                    election_id=election_id, status=status,
+                                    shard=shard, count=amount))
+                    break
+                except IntegrityError:
+                    # a concurrent first increment created the row, update it
+                    continue
+
+    @staticmethod
+    def sum_counts(session, election_id):
+        '''
+        Returns a dict of status -> count for the election, summing the shards
+        '''
+        from sqlalchemy import func
+        cls = VoterStatusCounter
+        rows = session.query(cls.status, func.sum(cls.count))\
+            .filter(cls.election_id == election_id)\
+            .group_by(cls.status)
+        return dict((status, int(count or 0)) for status, count in rows)
+
+
+def _apply_voter_status_counters(session):
+    import logging
+    from flask import current_app, has_app_context
+
+    increments = session.info.pop('voter_status_counter', None)
+    if not increments:
+        return
+    num_shards = 16
+    if has_app_context():
+        num_shards = current_app.config.get('VOTER_STATUS_COUNTER_SHARDS', 16)
+    try:
+        VoterStatusCounter.apply_increments(
+            session.get_bind(mapper=VoterStatusCounter.__mapper__),
+            increments, num_shards)
+    except Exception:
+        # the transitions are already committed, --rebuild-counters fixes it
+        logging.exception("could not update the voter status counters: %r" %
+                          increments)
+
+def _discard_voter_status_counters(session):
+    session.info.pop('voter_status_counter', None)
+
+event.listen(Session, 'after_commit', _apply_voter_status_counters)
+event.listen(Session, 'after_rollback', _discard_voter_status_counters)
+
+
+class MessageDeadLetter(db.Model):
+    '''
+    Messages whose delivery failed permanently (see delivery.py). The voters
+    of these messages are deactivated so that they can request a new token
+    right away.
+    '''
+    __tablename__ = 'message_dead_letter'
+
+    id = db.Column(db.Integer, db.Sequence('message_dead_letter_id_seq'),
+                   primary_key=True)
+
+    created = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # not a foreign key so that messages can be archived independently
+    message_id = db.Column(db.Integer, index=True)
+
+    message_created = db.Column(db.DateTime)
+
+    idempotency_key = db.Column(db.String(64), index=True)
+
+    tlf = db.Column(db.String(20), index=True)
+
+    ip = db.Column(db.String(45))
+
+    attempts = db.Column(db.Integer, default=0)
+
+    # expired, max_attempts, stuck_queued, stuck_sending
+    reason = db.Column(db.String(20))
+
+    last_error = db.Column(db.String(400), default="")
+
+    correlation_id = db.Column(db.String(64), nullable=True)
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return '<MessageDeadLetter %r>' % self.message_id
+
+
+class SMSProviderStatus(db.Model):
+    '''
+    Last credit and health check of each sms provider, updated periodically
+    by the check_sms_providers task (see sms.check_providers)
+    '''
+    __tablename__ = 'sms_provider_status'
+
+    provider = db.Column(db.String(20), primary_key=True)
+
+    checked = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # remaining credit, in the units of the provider, or None if the provider
+    # does not report it
+    credit = db.Column(db.Float, nullable=True)
+
+    # whether the provider answered the last check successfully
+    healthy = db.Column(db.Boolean, default=True)
+
+    # whether the credit is below SMS_CREDIT_MIN
+    low_credit = db.Column(db.Boolean, default=False)
+
+    error = db.Column(db.String(400), default="")
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return '<SMSProviderStatus %r>' % self.provider
+
+    def to_dict(self):
+        return dict(
+            provider=self.provider,
+            checked=self.checked.isoformat() if self.checked else None,
+            credit=self.credit,
+            healthy=self.healthy,
+            low_credit=self.low_credit,
+            error=self.error)
+
+
+class RollupMinute(db.Model):
+    '''
+    Number of events per minute, election, transition and error codename,
+    filled incrementally by the rollup job (see rollups.py) so that traffic
+    charts don't need to scan the voter and message tables.
+    '''
+    __tablename__ = 'rollup_minute'
+
+    minute = db.Column(db.DateTime, primary_key=True)
+
+    election_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    # requested, sms_sent, sms_failed, authenticated, voted
+    transition = db.Column(db.String(20), primary_key=True)
+
+    # error codename of rejected registration requests, "" otherwise
+    error_codename = db.Column(db.String(40), primary_key=True, default="")
+
+    count = db.Column(db.Integer, default=0, nullable=False)
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return '<RollupMinute %r,%r,%r,%r>' % (
+            self.minute, self.election_id, self.transition,
+            self.error_codename)
+
+
+class RollupHighWater(db.Model):
+    '''
+    Time up to which the rollups have been computed
+    '''
+    __tablename__ = 'rollup_high_water'
+
+    name = db.Column(db.String(20), primary_key=True)
+
+    high_water = db.Column(db.DateTime)
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return '<RollupHighWater %r>' % self.name
+
+
+class CacheVersion(db.Model):
+    '''
+    Version of each cache invalidation topic, bumped when it's published (see
+    invalidation.py)
+    '''
+    __tablename__ = 'cache_version'
+
+    topic = db.Column(db.String(40), primary_key=True)
+
+    version = db.Column(db.Integer, default=0, nullable=False)
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return '<CacheVersion %r,%r>' % (self.topic, self.version)
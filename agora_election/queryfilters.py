@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of agora-election.
+# Copyright (C) 2014  Eduardo Robles Elvira <edulix AT agoravoting DOT com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Filter expressions for the command line listings (--filters).
+
+Each expression is "<column><operator><value>", with these operators:
+
+    ==      equal                           tlf==+34666666666
+    !=      not equal                       status!=-1
+    >= <=   greater/less than or equal      created>=2014-05-01
+    > <     greater/less than               id>1000
+    =in=    in a comma separated list       status=in=1,2
+    ^=      starts with (prefix)            tlf^=+34666
+
+Values are converted to the type of the column. Dates can be given in ISO
+format (2014-05-01, 2014-05-01T10:00:00) or relative to now as -<n><unit>
+where unit is s, m, h or d (created>=-2h). Booleans are true/false.
+
+Expressions are compiled into plain comparisons on the column, so that they
+can be served by its indexes. Prefix matching compiles to LIKE 'prefix%',
+which uses btree indexes in postgres when the column collation is C or the
+index uses text_pattern_ops.
+'''
+
+import re
+from datetime import datetime, timedelta
+
+from sqlalchemy import types
+from sqlalchemy.sql.expression import Executable, ClauseElement
+from sqlalchemy.ext.compiler import compiles
+
+# operators in matching order: longer operators must go first
+OPERATORS = ('=in=', '==', '!=', '>=', '<=', '^=', '>', '<')
+
+RELATIVE_DATE_RX = re.compile(r"^-(\d+)([smhd])$")
+
+RELATIVE_DATE_UNITS = dict(s='seconds', m='minutes', h='hours', d='days')
+
+DATE_FORMATS = ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S",
+                "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d")
+
+class FilterError(Exception):
+    pass
+
+def parse_expression(expression):
+    '''
+    Splits a filter expression into (column name, operator, value)
+    '''
+    best = None
+    for op in OPERATORS:
+        pos = expression.find(op)
+        if pos > 0 and (best is None or pos < best[0]):
+            best = (pos, op)
+    if best is None:
+        raise FilterError("invalid filter '%s': no valid operator found, use "
+                          "one of %s" % (expression, " ".join(OPERATORS)))
+    pos, op = best
+    return expression[:pos], op, expression[pos + len(op):]
+
+def coerce_date(value):
+    match = RELATIVE_DATE_RX.match(value)
+    if match:
+        amount, unit = match.groups()
+        return datetime.utcnow() - timedelta(
+            **{RELATIVE_DATE_UNITS[unit]: int(amount)})
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError("invalid date '%s'" % value)
+
+def coerce_value(column, value):
+    '''
+    Converts a string value to the python type of the column
+    '''
+    col_type = column.type
+    if isinstance(col_type, types.Boolean):
+        if value.lower() in ('true', '1'):
+            return True
+        if value.lower() in ('false', '0'):
+            return False
+        raise ValueError("invalid boolean '%s'" % value)
+    if isinstance(col_type, types.Integer):
+        return int(value)
+    if isinstance(col_type, types.Float):
+        return float(value)
+    if isinstance(col_type, types.DateTime):
+        return coerce_date(value)
+    return value
+
+def compile_filter(model, expression):
+    '''
+    Compiles a filter expression into an sqlalchemy clause for the given model
+    '''
+    name, op, value = parse_expression(expression)
+    column = model.__table__.columns.get(name, None)
+    if column is None:
+        raise FilterError("invalid filter '%s': unknown column '%s'" % (
+            expression, name))
+    attr = getattr(model, name)
+
+    try:
+        if op == '=in=':
+            return attr.in_([coerce_value(column, v) for v in value.split(',')])
+        if op == '^=':
+            if not isinstance(column.type, types.String):
+                raise FilterError("invalid filter '%s': prefix matching only "
+                                  "works on text columns" % expression)
+            escaped = value.replace('\\', '\\\\').replace('%', '\\%')\
+                .replace('_', '\\_')
+            return attr.like(escaped + '%', escape='\\')
+
+        value = coerce_value(column, value)
+    except ValueError as e:
+        raise FilterError("invalid filter '%s': %s" % (expression, e))
+
+    if op == '==':
+        return attr == value
+    if op == '!=':
+        return attr != value
+    if op == '>=':
+        return attr >= value
+    if op == '<=':
+        return attr <= value
+    if op == '>':
+        return attr > value
+    return attr < value
+
+def compile_filters(model, expressions):
+    '''
+    Compiles a list of filter expressions into a list of clauses (to be and-ed)
+    '''
+    return [compile_filter(model, expression) for expression in expressions]
+
+
+class Explain(Executable, ClauseElement):
+    '''
+    EXPLAIN of a select statement
+    '''
+    def __init__(self, statement):
+        self.statement = statement
+
+@compiles(Explain)
+def compile_explain(element, compiler, **kwargs):
+    if compiler.dialect.name == 'sqlite':
+        prefix = "EXPLAIN QUERY PLAN "
+    else:
+        prefix = "EXPLAIN "
+    return prefix + compiler.process(element.statement, **kwargs)
+
+def explain_query(session, query):
+    '''
+    Returns the query plan of a query, as a list of strings
+    '''
+    rows = session.execute(Explain(query.statement))
+    return [" ".join([str(col) for col in row]) for row in rows]
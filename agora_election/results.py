@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of agora-election.
+# Copyright (C) 2014  Eduardo Robles Elvira <edulix AT agoravoting DOT com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Server side computation of the released election results, served in
+GET /api/v1/results/ so that the browser doesn't need the whole tally log.
+'''
+
+import json
+
+# cached results, by election key: election_key -> (version, json string)
+_results_cache = dict()
+
+def approval_results(question):
+    '''
+    Returns the results of an APPROVAL or ONE_CHOICE question, with the
+    answers sorted by number of votes
+    '''
+    answers = sorted(question['answers'], key=lambda a: -a['total_count'])
+    return dict(
+        tally_type=question['tally_type'],
+        question=question['question'],
+        total_votes=question.get('total_votes', 0),
+        blank_votes=question.get('blank_votes', 0),
+        invalid_votes=question.get('invalid_votes', 0),
+        winners=question.get('winners', []),
+        answers=[dict(value=a['value'], total_count=a['total_count'])
+                 for a in answers]
+    )
+
+def stv_results(question, tally_log):
+    '''
+    Returns the results of a MEEK-STV question, with the count and status of
+    each answer in each round. Answers keep the order of the tally log.
+    '''
+    iterations = []
+    for iteration in tally_log.get('iterations', []):
+        iterations.append(dict(
+            round_stage=iteration['round_stage'],
+            candidates=[dict(count=c['count'], status=c['status'])
+                        for c in iteration['candidates']]
+        ))
+    return dict(
+        tally_type=question['tally_type'],
+        question=question['question'],
+        winners=tally_log.get('winners', question.get('winners', [])),
+        answers=[dict(value=a['value']) for a in question['answers']],
+        iterations=iterations
+    )
+
+def compute_results(edata):
+    '''
+    Computes the results of each question of the election, given the
+    AGORA_ELECTION_DATA dictionary. Returns None if the tally has not been
+    released yet.
+    '''
+    election = edata['election']
+    if election.get('tally_released_at_date', None) is None:
+        return None
+
+    tally_logs = edata.get('election_extra_data', {}).get('tally_log', [])
+    ret = []
+    for i, question in enumerate(election['result']['counts']):
+        if question['tally_type'] == "MEEK-STV" and i < len(tally_logs):
+            ret.append(stv_results(question, tally_logs[i]))
+        elif question['tally_type'] in ("APPROVAL", "ONE_CHOICE"):
+            ret.append(approval_results(question))
+    return ret
+
+def get_results_json(election_key, edata, version):
+    '''
+    Returns the results of the election as a json string, computing them only
+    once per election data version
+    '''
+    cached = _results_cache.get(election_key, None)
+    if cached is None or cached[0] != version:
+        cached = (version, json.dumps(compute_results(edata)))
+        _results_cache[election_key] = cached
+    return cached[1]
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of agora-election.
+# Copyright (C) 2014  Eduardo Robles Elvira <edulix AT agoravoting DOT com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Per-minute rollups of registrations, sms and votes for traffic charts.
+
+The update_rollups periodic task (see CELERYBEAT_SCHEDULE) reads only the
+rows created or modified since the last high water mark (using the indexes
+on voter.created, voter.modified and message.modified), aggregates them per
+minute, election, transition and error codename, and adds them to the
+rollup_minute table in the same transaction that advances the high water
+mark. Only minutes older than ROLLUP_LAG_SECS are rolled up, so that rows
+committed late are not missed.
+
+Transitions:
+
+  * requested: registration requests, by voter.created. Rejected ones have
+    the error codename of the response.
+  * sms_sent, sms_failed: messages sent or dead-lettered, by message.modified
+  * authenticated, voted: voters in these statuses, by voter.modified. A
+    voter that authenticates and votes within the same rollup window only
+    counts as voted.
+'''
+
+import logging
+from datetime import datetime, timedelta
+
+from app import db, app_flask
+from models import Voter, Message, RollupMinute, RollupHighWater
+
+HIGH_WATER_NAME = "minute"
+
+def truncate_minute(dt):
+    return dt.replace(second=0, microsecond=0)
+
+def get_high_water():
+    '''
+    Returns the high water mark, initializing it the first time to the
+    minute of the oldest voter (or now, if there are none)
+    '''
+    hw = db.session.query(RollupHighWater)\
+        .filter(RollupHighWater.name == HIGH_WATER_NAME)\
+        .with_lockmode("update").first()
+    if hw is None:
+        oldest = db.session.query(db.func.min(Voter.created)).scalar()
+        hw = RollupHighWater(name=HIGH_WATER_NAME,
+                             high_water=truncate_minute(
+                                 oldest or datetime.utcnow()))
+        db.session.add(hw)
+    return hw
+
+def aggregate(counts, rows, transition):
+    '''
+    Adds the (timestamp, election_id[, error_codename]) rows to counts
+    '''
+    for row in rows:
+        error_codename = row[2] if len(row) > 2 else None
+        key = (truncate_minute(row[0]), row[1], transition,
+               error_codename or "")
+        counts[key] = counts.get(key, 0) + 1
+
+def collect_counts(start, end, batch_size):
+    '''
+    Returns the counts per (minute, election_id, transition, error_codename)
+    of the events in [start, end)
+    '''
+    counts = dict()
+    aggregate(counts, db.session.query(
+            Voter.created, Voter.election_id, Voter.error_codename)\
+        .filter(Voter.created >= start, Voter.created < end)\
+        .yield_per(batch_size), "requested")
+
+    for transition, status in [("authenticated", Voter.STATUS_AUTHENTICATED),
+                               ("voted", Voter.STATUS_VOTED)]:
+        aggregate(counts, db.session.query(
+                Voter.modified, Voter.election_id)\
+            .filter(Voter.modified >= start, Voter.modified < end,
+                    Voter.status == status)\
+            .yield_per(batch_size), transition)
+
+    for transition, status in [("sms_sent", Message.STATUS_SENT),
+                               ("sms_failed", Message.STATUS_FAILED)]:
+        aggregate(counts, db.session.query(
+                Message.modified, Voter.election_id)\
+            .join(Voter, Voter.message_id == Message.id)\
+            .filter(Message.modified >= start, Message.modified < end,
+                    Message.status == status)\
+            .yield_per(batch_size), transition)
+    return counts
+
+def add_counts(counts):
+    '''
+    Adds the counts to the rollup table. The caller is responsible of
+    committing.
+    '''
+    cls = RollupMinute
+    for (minute, election_id, transition, error_codename), count in\
+            counts.items():
+        updated = db.session.query(cls)\
+            .filter(cls.minute == minute,
+                    cls.election_id == election_id,
+                    cls.transition == transition,
+                    cls.error_codename == error_codename)\
+            .update({cls.count: cls.count + count},
+                    synchronize_session=False)
+        if updated == 0:
+            db.session.add(cls(minute=minute, election_id=election_id,
+                               transition=transition,
+                               error_codename=error_codename, count=count))
+
+def update_rollups(max_window_secs=None, lag_secs=None, batch_size=None):
+    '''
+    Rolls up the next window of at most max_window_secs after the high water
+    mark. Returns True if there are more closed minutes left to roll up.
+    '''
+    config = app_flask.config
+    if max_window_secs is None:
+        max_window_secs = config.get('ROLLUP_MAX_WINDOW_SECS', 60*60)
+    if lag_secs is None:
+        lag_secs = config.get('ROLLUP_LAG_SECS', 60)
+    if batch_size is None:
+        batch_size = config.get('ROLLUP_BATCH_SIZE', 5000)
+
+    hw = get_high_water()
+    start = hw.high_water
+    closed = truncate_minute(datetime.utcnow() - timedelta(seconds=lag_secs))
+    end = min(closed, start + timedelta(seconds=max_window_secs))
+    if end <= start:
+        db.session.commit()
+        return False
+
+    counts = collect_counts(start, end, batch_size)
+    add_counts(counts)
+    hw.high_water = end
+    db.session.add(hw)
+    db.session.commit()
+    logging.debug("rolled up %s - %s: %d rows" % (start, end, len(counts)))
+    return end < closed
+
+def update_all_rollups():
+    '''
+    Rolls up all the closed minutes after the high water mark
+    '''
+    while update_rollups():
+        pass
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of agora-election.
+# Copyright (C) 2014  Eduardo Robles Elvira <edulix AT agoravoting DOT com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Production pre-fork server, used with "./app.py --serve".
+
+The master process does the expensive startup work once (see
+app.warmup), binds the listening socket and forks the workers, which inherit
+both. Each worker serves requests with a threaded wsgi server.
+
+On SIGUSR2 or when the AGORA_ELECTION_SETTINGS file changes, the master and
+the workers reload the settings in place (see hotreload.py). On SIGHUP, the
+master reloads the config and replaces the workers one by one, letting the
+old ones finish their in-flight requests.
+'''
+
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+import logging
+import threading
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    '''
+    Threaded wsgi server that serves on an already bound listening socket
+    '''
+    daemon_threads = False
+    block_on_close = True
+
+    def __init__(self, listen_socket, app):
+        WSGIServer.__init__(self, listen_socket.getsockname(),
+                            WSGIRequestHandler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = listen_socket
+        host, port = listen_socket.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+        self.set_app(app)
+
+
+class PreforkServer(object):
+    '''
+    Master process of the pre-fork server
+    '''
+
+    def __init__(self, app, host, port, num_workers, warmup, reload_config,
+                 hot_reload=None, watch_files=None, check_interval=1):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.num_workers = num_workers
+        self.warmup = warmup
+        self.reload_config = reload_config
+        self.hot_reload = hot_reload
+        self.watch_files = [f for f in (watch_files or []) if f]
+        self.check_interval = check_interval
+        self.workers = set()
+        self.socket = None
+        self.stopping = False
+        self.reload_requested = False
+        self.hot_reload_requested = False
+
+    def get_mtimes(self):
+        mtimes = dict()
+        for path in self.watch_files:
+            try:
+                mtimes[path] = os.stat(path).st_mtime
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid != 0:
+            self.workers.add(pid)
+            return pid
+
+        # worker process
+        for sig in (signal.SIGHUP, signal.SIGINT):
+            signal.signal(sig, signal.SIG_IGN)
+        server = ThreadingWSGIServer(self.socket, self.app)
+
+        def stop(signum, frame):
+            # shutdown() blocks until serve_forever returns, so it must be
+            # called from another thread
+            threading.Thread(target=server.shutdown).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        if self.hot_reload is not None:
+            def on_hot_reload(signum, frame):
+                threading.Thread(target=self.hot_reload).start()
+            signal.signal(signal.SIGUSR2, on_hot_reload)
+        else:
+            signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+        status = 0
+        try:
+            server.serve_forever()
+            server.server_close()
+        except Exception:
+            logging.exception("worker %d failed" % os.getpid())
+            status = 1
+        os._exit(status)
+
+    def stop_worker(self, pid, wait=True):
+        try:
+            os.kill(pid, signal.SIGTERM)
+            if wait:
+                os.waitpid(pid, 0)
+        except OSError as e:
+            if e.errno not in (errno.ESRCH, errno.ECHILD):
+                raise
+        self.workers.discard(pid)
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            if pid in self.workers:
+                self.workers.discard(pid)
+                if not self.stopping:
+                    logging.warn("worker %d died, respawning" % pid)
+
+    def reload(self):
+        '''
+        Reloads the config in the master and replaces the workers one by one
+        '''
+        logging.info("reloading config and restarting workers")
+        try:
+            self.reload_config()
+            self.warmup()
+        except Exception:
+            logging.exception("config reload failed, keeping old workers")
+            return
+        for pid in list(self.workers):
+            self.spawn_worker()
+            self.stop_worker(pid)
+
+    def reload_in_place(self):
+        '''
+        Reloads the settings in the master and in the workers, without
+        restarting them
+        '''
+        errors = self.hot_reload()
+        if errors:
+            logging.error("invalid settings, keeping the current ones")
+            return
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGUSR2)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def run(self):
+        self.warmup()
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(128)
+        logging.info("serving on %s:%d with %d workers" % (
+            self.host, self.port, self.num_workers))
+
+        def on_stop(signum, frame):
+            self.stopping = True
+
+        def on_reload(signum, frame):
+            self.reload_requested = True
+
+        def on_hot_reload(signum, frame):
+            self.hot_reload_requested = True
+
+        signal.signal(signal.SIGTERM, on_stop)
+        signal.signal(signal.SIGINT, on_stop)
+        signal.signal(signal.SIGHUP, on_reload)
+        signal.signal(signal.SIGUSR2, on_hot_reload)
+
+        mtimes = self.get_mtimes()
+        while not self.stopping:
+            self.reap_workers()
+            while len(self.workers) < self.num_workers:
+                self.spawn_worker()
+
+            new_mtimes = self.get_mtimes()
+            if new_mtimes != mtimes:
+                mtimes = new_mtimes
+                if self.hot_reload is not None:
+                    self.hot_reload_requested = True
+                else:
+                    self.reload_requested = True
+
+            if self.reload_requested:
+                self.reload_requested = False
+                self.hot_reload_requested = False
+                self.reload()
+            elif self.hot_reload_requested:
+                self.hot_reload_requested = False
+                self.reload_in_place()
+            time.sleep(self.check_interval)
+
+        logging.info("stopping workers")
+        for pid in list(self.workers):
+            self.stop_worker(pid)
+        self.socket.close()
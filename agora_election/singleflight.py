@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of agora-election.
+# Copyright (C) 2014  Eduardo Robles Elvira <edulix AT agoravoting DOT com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Single-flight coalescing of concurrent duplicated requests.
+
+Concurrent calls with the same key (for example, double clicks registering
+the same election, tlf and dni) execute the function only once, and the
+calls that were waiting while it ran get the same response. Threads of the
+same process wait for the first one in memory. Worker processes of the same
+host are coordinated with one lock file per key in SINGLE_FLIGHT_DIR, where
+the response of the first one is kept for SINGLE_FLIGHT_RESULT_TTL_SECS so
+that the processes that were waiting for it can reuse it.
+
+Only successful responses are shared: errors (overload, wrong captcha,
+invalid data...) may not happen again, so the waiting calls execute the
+function themselves, one after the other. Calls that arrive after the
+response was computed are not coalesced either, so a user that resubmits
+never gets a previous response.
+'''
+
+import os
+import json
+import time
+import fcntl
+import random
+import hashlib
+import logging
+import threading
+
+from flask import current_app, make_response
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+
+_calls = dict()
+_calls_lock = threading.Lock()
+
+def is_shareable(response):
+    return response.status_code < 400
+
+def serialize_response(response, started, finished):
+    return dict(
+        status=response.status_code,
+        data=response.get_data(as_text=True),
+        headers=[(k, v) for k, v in response.headers.items()
+                 if k.lower() not in ('content-length', 'date')],
+        started=started,
+        finished=finished)
+
+def deserialize_response(data):
+    response = make_response(data['data'], data['status'])
+    for key, value in data['headers']:
+        response.headers[key] = value
+    return response
+
+def read_result(path, ttl, arrived):
+    '''
+    Reads the result of a call that finished after the given arrival time
+    '''
+    try:
+        if time.time() - os.stat(path).st_mtime > ttl:
+            return None
+        with open(path, 'r', encoding="utf-8") as f:
+            data = json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+    if data.get('finished', 0) < arrived:
+        return None
+    return data
+
+def write_result(path, data):
+    tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'w', encoding="utf-8") as f:
+        f.write(json.dumps(data))
+    os.rename(tmp_path, path)
+
+def cleanup_files(dir_path, ttl):
+    '''
+    Removes the expired result files, and the old lock files not in use
+    '''
+    now = time.time()
+    for name in os.listdir(dir_path):
+        path = os.path.join(dir_path, name)
+        try:
+            if now - os.stat(path).st_mtime <= ttl:
+                continue
+            if name.endswith(".result"):
+                os.unlink(path)
+            elif name.endswith(".lock"):
+                with open(path, 'a') as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.unlink(path)
+        except OSError:
+            pass
+
+def lock_key(lock_path, deadline):
+    '''
+    Opens and locks the lock file of a key. Returns the open file, locked
+    unless the deadline passed.
+    '''
+    while True:
+        lock_file = open(lock_path, 'a')
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                if time.time() >= deadline:
+                    # fail open: better a duplicate than a stuck request
+                    logging.warn("single-flight: timeout waiting for lock")
+                    return lock_file
+                time.sleep(0.01)
+        # cleanup_files might have removed the file before we locked it
+        try:
+            if os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                return lock_file
+        except OSError:
+            pass
+        lock_file.close()
+
+def run_across_processes(digest, func, arrived):
+    '''
+    Executes func holding the lock file of the key, unless another process
+    finished it while this one was waiting and its response is shareable.
+    Returns (response, started, finished).
+    '''
+    from toolbox import ensure_private_dir
+
+    config = current_app.config
+    dir_path = config['SINGLE_FLIGHT_DIR']
+    ttl = config.get('SINGLE_FLIGHT_RESULT_TTL_SECS', 2)
+    timeout = config.get('SINGLE_FLIGHT_TIMEOUT_SECS', 30)
+    # the responses stored there are served as is
+    ensure_private_dir(dir_path)
+
+    result_path = os.path.join(dir_path, "%s.result" % digest)
+    lock_path = os.path.join(dir_path, "%s.lock" % digest)
+    with lock_key(lock_path, time.time() + timeout):
+        data = read_result(result_path, ttl, arrived)
+        if data is not None:
+            return deserialize_response(data), data['started'],\
+                data['finished']
+
+        started = time.time()
+        response = make_response(func())
+        finished = time.time()
+        if is_shareable(response):
+            write_result(result_path, serialize_response(response, started,
+                                                         finished))
+        if random.random() < 0.01:
+            cleanup_files(dir_path, ttl)
+        return response, started, finished
+
+def single_flight(key, func):
+    '''
+    Executes func() coalescing concurrent calls with the same key, and
+    returns its response.
+    '''
+    if not current_app.config.get('SINGLE_FLIGHT', True):
+        return func()
+
+    arrived = time.time()
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    with _calls_lock:
+        call = _calls.get(digest, None)
+        is_leader = call is None
+        if is_leader:
+            call = _calls[digest] = _Call()
+
+    if not is_leader:
+        timeout = current_app.config.get('SINGLE_FLIGHT_TIMEOUT_SECS', 30)
+        if call.event.wait(timeout) and call.response is not None:
+            return deserialize_response(call.response)
+        # not shareable: run it, but not at the same time as other processes
+        return run_across_processes(digest, func, arrived)[0]
+
+    try:
+        response, started, finished = run_across_processes(digest, func,
+                                                           arrived)
+        if is_shareable(response):
+            call.response = serialize_response(response, started, finished)
+        return response
+    finally:
+        with _calls_lock:
+            del _calls[digest]
+        call.event.set()
@@ -17,9 +17,12 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from app import app_flask
-import requests
+import time
 import logging
-import xmltodict
+import threading
+from collections import deque
+
+import requests
 
 class SMSProvider(object):
     '''
@@ -27,8 +30,26 @@ class SMSProvider(object):
     '''
     provider_name = ""
 
-    def __init__(self):
-        pass
+    def __init__(self, config=None):
+        self.config = config or dict()
+        # seconds to wait for the provider api, so that a hung provider does
+        # not block the worker
+        self.timeout = self.get_setting('SMS_TIMEOUT_SECS', 10)
+
+    def get_setting(self, key, default=''):
+        '''
+        Returns a setting of this provider: from its own config if it's set
+        there (see SMS_PROVIDERS_CONFIG), or from the app config otherwise
+        '''
+        if key in self.config:
+            return self.config[key]
+        return app_flask.config.get(key, default)
+
+    def is_error(self, response):
+        '''
+        Returns True if the response returned by send_sms is an error
+        '''
+        return False
 
     def send_sms(self, dest, msg, is_audio=False):
         '''
@@ -44,18 +65,30 @@ class SMSProvider(object):
         '''
         return 0
 
+    def parse_credit(self, response):
+        '''
+        Returns the remaining credit as a number from the response of
+        get_credit, or None if the provider does not report it
+        '''
+        return None
+
     @staticmethod
-    def get_instance():
+    def get_instance(provider=None):
         '''
         Instance the SMS provider specified in the app config
         '''
-        provider = app_flask.config.get('SMS_PROVIDER', '')
+        if provider is None:
+            provider = app_flask.config.get('SMS_PROVIDER', '')
+        config = app_flask.config.get('SMS_PROVIDERS_CONFIG', {}).get(
+            provider, None)
         if provider == "altiria":
-            return AltiriaSMSProvider()
+            return AltiriaSMSProvider(config)
         if provider == "esendex":
-            return EsendexSMSProvider()
+            return EsendexSMSProvider(config)
         if provider == "console":
-            return ConsoleSMSProvider()
+            return ConsoleSMSProvider(config)
+        if provider == "routing":
+            return RoutingSMSProvider(config)
         else:
             raise Exception("invalid SMS_PROVIDER='%s' in app config" % provider)
 
@@ -88,12 +121,17 @@ class AltiriaSMSProvider(SMSProvider):
         'Accept': 'text/plain'
     }
 
-    def __init__(self):
-        self.domain_id = app_flask.config.get('SMS_DOMAIN_ID', '')
-        self.login = app_flask.config.get('SMS_LOGIN', '')
-        self.password = app_flask.config.get('SMS_PASSWORD', '')
-        self.url = app_flask.config.get('SMS_URL', '')
-        self.sender_id = app_flask.config.get('SMS_SENDER_ID', '')
+    def __init__(self, config=None):
+        super(AltiriaSMSProvider, self).__init__(config)
+        self.domain_id = self.get_setting('SMS_DOMAIN_ID')
+        self.login = self.get_setting('SMS_LOGIN')
+        self.password = self.get_setting('SMS_PASSWORD')
+        self.url = self.get_setting('SMS_URL')
+        self.sender_id = self.get_setting('SMS_SENDER_ID')
+
+    def is_error(self, response):
+        return len(response['lines']) == 0 or\
+            any([line['error'] for line in response['lines']])
 
     def send_sms(self, receiver, content, is_audio):
 
@@ -108,7 +146,8 @@ class AltiriaSMSProvider(SMSProvider):
         }
 
         logging.debug("sending message.." + str(data))
-        r = requests.post(self.url, data=data, headers=self.headers)
+        r = requests.post(self.url, data=data, headers=self.headers,
+                          timeout=self.timeout)
 
         ret = self.parse_response(r)
         logging.debug(ret)
@@ -117,17 +156,28 @@ class AltiriaSMSProvider(SMSProvider):
     def get_credit(self):
         data = {
             'cmd': 'getcredit',
-            'domainId': self.domainId,
+            'domainId': self.domain_id,
             'login': self.login,
             'passwd': self.password,
 
         }
-        r = requests.post(self.url, data=data, headers=self.headers)
+        r = requests.post(self.url, data=data, headers=self.headers,
+                          timeout=self.timeout)
 
         ret = self.parse_response(r)
         logging.debug(ret)
         return ret
 
+    def parse_credit(self, response):
+        # "OK credit(0):1234.5"
+        for line in response['lines']:
+            if line['error']:
+                raise Exception("altiria getcredit error: %s" % str(line))
+            for key, value in line.items():
+                if key.startswith('credit'):
+                    return float(value)
+        raise Exception("altiria getcredit: no credit in response")
+
     def parse_response(self, response):
         '''
         parses responses in altiria format into dictionaries, one for each line
@@ -199,16 +249,22 @@ class EsendexSMSProvider(SMSProvider):
         </message>
         </messages>"""
 
-    def __init__(self):
-        self.domain_id = app_flask.config.get('SMS_DOMAIN_ID', '')
-        self.login = app_flask.config.get('SMS_LOGIN', '')
-        self.password = app_flask.config.get('SMS_PASSWORD', '')
-        self.url = app_flask.config.get('SMS_URL', '')
-        self.sender_id = app_flask.config.get('SMS_SENDER_ID', '')
-        self.lang_code = app_flask.config.get('SMS_VOICE_LANG_CODE', '')
+    def __init__(self, config=None):
+        super(EsendexSMSProvider, self).__init__(config)
+        self.domain_id = self.get_setting('SMS_DOMAIN_ID')
+        self.login = self.get_setting('SMS_LOGIN')
+        self.password = self.get_setting('SMS_PASSWORD')
+        self.url = self.get_setting('SMS_URL')
+        self.sender_id = self.get_setting('SMS_SENDER_ID')
+        self.lang_code = self.get_setting('SMS_VOICE_LANG_CODE')
+        self.accounts_url = self.get_setting(
+            'SMS_ACCOUNTS_URL', 'https://api.esendex.com/v1.0/accounts')
 
         self.auth = (self.login, self.password)
 
+    def is_error(self, response):
+        return 'error' in response
+
     def send_sms(self, receiver, content, is_audio):
         if is_audio:
             msg_type = 'Voice'
@@ -225,17 +281,38 @@ class EsendexSMSProvider(SMSProvider):
             sender=self.sender_id,
             extra=extra)
         logging.debug("sending message.." + str(data))
-        r = requests.post(self.url, data=data, headers=self.headers, auth=self.auth)
+        r = requests.post(self.url, data=data, headers=self.headers,
+                          auth=self.auth, timeout=self.timeout)
+
+        ret = self.parse_response(r)
+        logging.debug(ret)
+        return ret
 
+    def get_credit(self):
+        r = requests.get(self.accounts_url, headers=self.headers,
+                         auth=self.auth, timeout=self.timeout)
         ret = self.parse_response(r)
         logging.debug(ret)
         return ret
 
+    def parse_credit(self, response):
+        if 'error' in response:
+            raise Exception("esendex accounts error %s: %s" % (
+                response['code'], response['error']))
+        accounts = response['accounts']['account']
+        if not isinstance(accounts, list):
+            accounts = [accounts]
+        for account in accounts:
+            if account['reference'] == self.domain_id:
+                return float(account['messagesremaining'])
+        raise Exception("esendex account %s not found" % self.domain_id)
+
     def parse_response(self, response):
         '''
         parses responses in esendex format
         '''
         if response.status_code == self.HTTP_OK:
+            import xmltodict
             ret = xmltodict.parse(response.text)
         else:
             ret = {
@@ -244,3 +321,251 @@ class EsendexSMSProvider(SMSProvider):
             }
 
         return ret
+
+
+class ProviderStats(object):
+    '''
+    Rolling latency and error rate of a provider, over the last window_secs
+    '''
+
+    def __init__(self, window_secs):
+        self.window_secs = window_secs
+        self.samples = deque()
+        self.lock = threading.Lock()
+
+    def add(self, latency, is_error):
+        with self.lock:
+            self.samples.append((time.time(), latency, is_error))
+            self.expire()
+
+    def expire(self):
+        limit = time.time() - self.window_secs
+        while self.samples and self.samples[0][0] < limit:
+            self.samples.popleft()
+
+    def get(self):
+        '''
+        Returns (num_samples, error_rate, mean_latency)
+        '''
+        with self.lock:
+            self.expire()
+            n = len(self.samples)
+            if n == 0:
+                return 0, 0.0, 0.0
+            errors = sum([1 for t, l, e in self.samples if e])
+            latency = sum([l for t, l, e in self.samples]) / n
+            return n, errors / n, latency
+
+
+def failed_before_sending(e):
+    '''
+    Returns True if the exception raised by a provider shows that its api
+    could not even be connected to, so that the message was not sent
+    '''
+    from requests.packages.urllib3.exceptions import ConnectTimeoutError
+
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    if not isinstance(e, requests.ConnectionError) or\
+            isinstance(e, requests.Timeout):
+        return False
+    # connection refused, unknown host... are wrapped in a MaxRetryError
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(reason, ConnectTimeoutError)
+
+class RoutingSMSProvider(SMSProvider):
+    '''
+    Wraps several providers (SMS_ROUTING_PROVIDERS), sending each message
+    with the healthiest one according to its rolling error rate and latency,
+    and failing over to the next one when a provider rejects the message or
+    can't be connected to.
+
+    Other errors (a timeout waiting for the answer, a connection lost while
+    sending...) are raised without failing over: the provider might have
+    accepted the message, and sending it again with another one would send
+    it twice. The send_sms task retries it later instead.
+
+    After each send_sms, last_provider_name has the name of the provider
+    that sent the message (or might have, if it failed after sending) and
+    last_routing a log of the attempts.
+    '''
+
+    provider_name = "routing"
+
+    # rolling stats of each provider, shared by all the instances of the
+    # process
+    stats = dict()
+    stats_lock = threading.Lock()
+
+    def __init__(self, config=None):
+        super(RoutingSMSProvider, self).__init__(config)
+        self.provider_names = self.get_setting('SMS_ROUTING_PROVIDERS', [])
+        self.window_secs = self.get_setting('SMS_ROUTING_WINDOW_SECS', 300)
+        self.error_penalty_secs = self.get_setting(
+            'SMS_ROUTING_ERROR_PENALTY_SECS', 30)
+        self.providers = [SMSProvider.get_instance(name)
+                          for name in self.provider_names]
+        self.last_provider_name = None
+        self.last_routing = ""
+
+    def get_stats(self, name):
+        with self.stats_lock:
+            if name not in self.stats:
+                self.stats[name] = ProviderStats(self.window_secs)
+            return self.stats[name]
+
+    def score(self, provider):
+        '''
+        Lower is better: the mean latency plus a penalty proportional to the
+        error rate. The configured order breaks ties.
+        '''
+        n, error_rate, latency = self.get_stats(provider.provider_name).get()
+        return latency + error_rate * self.error_penalty_secs
+
+    def sorted_providers(self):
+        '''
+        Returns the providers sorted by preference. Providers whose credit is
+        below SMS_CREDIT_MIN according to the provider monitor are skipped
+        (unless all of them are), and the ones that failed their last check
+        go last.
+        '''
+        status = get_providers_status()
+
+        def check(provider, key, default):
+            return status.get(provider.provider_name, {}).get(key, default)
+
+        providers = [p for p in self.providers
+                     if not check(p, 'low_credit', False)]
+        if not providers:
+            logging.warn("all sms providers are low on credit")
+            providers = self.providers
+        return sorted(providers, key=lambda p: (
+            not check(p, 'healthy', True), self.score(p)))
+
+    def send_sms(self, receiver, content, is_audio):
+        attempts = []
+        ret = None
+        self.last_provider_name = None
+        for provider in self.sorted_providers():
+            start = time.time()
+            exception = None
+            try:
+                ret = provider.send_sms(receiver, content, is_audio)
+                is_error = provider.is_error(ret)
+            except Exception as e:
+                logging.exception("provider %s failed" % provider.provider_name)
+                ret = dict(error=str(e))
+                is_error = True
+                exception = e
+            latency = time.time() - start
+            self.get_stats(provider.provider_name).add(latency, is_error)
+            attempts.append("%s:%s(%.2fs)" % (
+                provider.provider_name, "error" if is_error else "ok", latency))
+
+            if not is_error:
+                self.last_provider_name = provider.provider_name
+                break
+            if exception is not None and not failed_before_sending(exception):
+                # it might have been sent: don't risk sending it twice
+                self.last_provider_name = provider.provider_name
+                self.last_routing = ",".join(attempts)
+                logging.warn("provider %s failed after sending, not failing "
+                             "over: %s" % (provider.provider_name,
+                                           self.last_routing))
+                raise exception
+            logging.warn("provider %s failed, failing over" %
+                         provider.provider_name)
+
+        self.last_routing = ",".join(attempts)
+        logging.info("sms routing: %s" % self.last_routing)
+        if self.last_provider_name is None:
+            raise Exception("all sms providers failed: %s" % self.last_routing)
+        return ret
+
+
+def get_monitored_providers():
+    '''
+    Returns the instances of the providers in use: the ones in
+    SMS_ROUTING_PROVIDERS when routing, or the SMS_PROVIDER otherwise
+    '''
+    provider = SMSProvider.get_instance()
+    if isinstance(provider, RoutingSMSProvider):
+        return provider.providers
+    return [provider]
+
+def check_provider(provider):
+    '''
+    Polls the credit of a provider, which also serves as a health check.
+    Returns a dict with the credit, healthy, low_credit and error keys.
+    '''
+    try:
+        credit = provider.parse_credit(provider.get_credit())
+    except Exception as e:
+        logging.exception("checking credit of provider %s" %
+                          provider.provider_name)
+        return dict(credit=None, healthy=False, low_credit=False,
+                    error=str(e)[:400])
+
+    min_credit = provider.get_setting('SMS_CREDIT_MIN', 0)
+    low_credit = credit is not None and credit < min_credit
+    if low_credit:
+        logging.warn("provider %s is low on credit: %s < %s" % (
+            provider.provider_name, credit, min_credit))
+    return dict(credit=credit, healthy=True, low_credit=low_credit, error="")
+
+def check_providers():
+    '''
+    Checks all the providers in use and stores the result in the
+    SMSProviderStatus table. Returns the list of stored statuses.
+    '''
+    from app import db
+    from models import SMSProviderStatus
+    from invalidation import publish, TOPIC_SMS_PROVIDERS
+    from datetime import datetime
+
+    ret = []
+    for provider in get_monitored_providers():
+        result = check_provider(provider)
+        status = db.session.query(SMSProviderStatus)\
+            .filter(SMSProviderStatus.provider == provider.provider_name)\
+            .first()
+        if status is None:
+            status = SMSProviderStatus(provider=provider.provider_name)
+        for key, value in result.items():
+            setattr(status, key, value)
+        status.checked = datetime.utcnow()
+        db.session.add(status)
+        ret.append(status)
+    publish(TOPIC_SMS_PROVIDERS)
+    db.session.commit()
+    _status_cache.clear()
+    return ret
+
+# providers status read from the database, cached per process:
+# 'time' -> timestamp, 'status' -> dict of provider name -> status dict
+_status_cache = dict()
+
+def get_providers_status():
+    '''
+    Returns the last stored status of each provider as a dictionary
+    provider name -> status dict, cached for SMS_MONITOR_CACHE_SECS
+    '''
+    from app import db
+    from models import SMSProviderStatus
+
+    cache_secs = app_flask.config.get('SMS_MONITOR_CACHE_SECS', 30)
+    now = time.time()
+    if 'time' in _status_cache and now - _status_cache['time'] < cache_secs:
+        return _status_cache['status']
+
+    try:
+        status = dict([(s.provider, s.to_dict())
+                       for s in db.session.query(SMSProviderStatus)])
+    except Exception:
+        # do not block sending messages because of the monitor
+        logging.exception("could not read the sms providers status")
+        db.session.rollback()
+        status = _status_cache.get('status', dict())
+    _status_cache['time'] = now
+    _status_cache['status'] = status
+    return status
@@ -188,15 +188,60 @@
     });
 
     AE.getCandidateCount = function(name, results) {
-        for(var i = 0; i < results.length; i++) {
-            if (results[i].value == name) {
-                return results[i];
-            }
+        // index the results by value once, instead of a linear scan per call
+        if (results._byValue === undefined) {
+            results._byValue = _.indexBy(results, "value");
+        }
+        if (_.has(results._byValue, name)) {
+            return results._byValue[name];
         }
         // console.log("name = " + name + ", not found");
         return null;
     };
 
+    /**
+     * Returns the url of an api call of the current election. The api base
+     * (which includes the election path prefix, if any) is rendered by the
+     * server in the page.
+     */
+    AE.apiUrl = function(path) {
+        return api_base + path;
+    };
+
+    /**
+     * Same as $.ajax, but when the server is overloaded (status 503) it
+     * retries transparently after the time given in the Retry-After header,
+     * up to max_retries times.
+     */
+    AE.ajaxRetryOverloaded = function(url, options, max_retries) {
+        if (max_retries === undefined) {
+            max_retries = 5;
+        }
+        var deferred = $.Deferred();
+        var attempt = function(retries_left) {
+            $.ajax(url, options)
+            .done(function(data, textStatus, jqXHR) {
+                deferred.resolve(data, textStatus, jqXHR);
+            })
+            .fail(function(jqXHR, textStatus, errorThrown) {
+                if (jqXHR.status == 503 && retries_left > 0) {
+                    var wait = parseInt(jqXHR.getResponseHeader("Retry-After"), 10);
+                    if (isNaN(wait)) {
+                        wait = 2;
+                    }
+                    // add some jitter so that clients don't retry all at once
+                    setTimeout(function() {
+                        attempt(retries_left - 1);
+                    }, (wait + Math.random()) * 1000);
+                    return;
+                }
+                deferred.reject(jqXHR, textStatus, errorThrown);
+            });
+        };
+        attempt(max_retries);
+        return deferred.promise();
+    };
+
     AE.getYoutubeEmbedUrl = function(urls) {
         var baseUrl = AE.findUrlByTitle(urls, "Youtube").url;
         var rx = /[^?]\?(.+\&)?v=([-a-zA-Z0-9_]+)(&.+)?/;
@@ -282,9 +327,26 @@
 
             this.$el.find("img.cand-img").lazyload();
             this.delegateEvents();
+            this.updateNumVotes();
             return this;
         },
 
+        /**
+         * updates the number of votes with the live stats
+         */
+        updateNumVotes: function() {
+            if (!app_data.live_num_votes) {
+                return;
+            }
+            var self = this;
+            $.ajax(AE.apiUrl("/stats/"), {
+                dataType: "json",
+                type: "GET"
+            }).done(function(data) {
+                self.$el.find(".num-votes").text(data.voted);
+            });
+        },
+
         /**
          *  shows a modal dialog with the details of the candidate option
          */
@@ -313,13 +375,23 @@
 
         render: function() {
             this.$el.html(this.template(app_data));
-            for (var i = 0; i < app_data.election.result.counts.length; i++) {
-                var question = app_data.election.result.counts[i];
+            var self = this;
+            // results are precomputed in the server
+            $.ajax(AE.apiUrl("/results/"), {
+                dataType: "json",
+                type: "GET"
+            }).done(function(results) {
+                self.renderResults(results);
+            });
+            this.delegateEvents();
+            return this;
+        },
+
+        renderResults: function(results) {
+            for (var i = 0; i < results.length; i++) {
+                var question = results[i];
                 if (question.tally_type == "APPROVAL")
                 {
-                    question.answers = _.sortBy(question.answers, function (a) {
-                        return -a.total_count;
-                    });
                     question.candidates = app_data.candidates;
                     question.election = null;
                     this.$el.find("#candidates-list").append(this.tmplApprovalTable(question));
@@ -327,13 +399,11 @@
                 {
                     var data = {
                         q: question,
-                        q_tally: app_data.election_extra_data.tally_log[i]
+                        q_tally: question
                     };
                     this.$el.find("#candidates-list").append(this.tmplSTVTable(data));
                 }
             }
-            this.delegateEvents();
-            return this;
         }
     });
 
@@ -547,7 +617,7 @@
             }
 
             var self = this;
-            var jqxhr = $.ajax("/api/v1/register/", {
+            var jqxhr = AE.ajaxRetryOverloaded(AE.apiUrl("/register/"), {
                 data: JSON.stringify(inputData),
                 contentType : 'application/json',
                 type: 'POST'
@@ -661,6 +731,10 @@
             } else if(data.error_codename == "not_in_census") {
                 self.showErrorMessage('Tu DNI no nos consta como votante ' +
                 '¿seguro que indicaste un número de DNI correcto?', true);
+            } else if(data.error_codename == "overloaded") {
+                self.showErrorMessage('¡Vaya! Ahora mismo estamos recibiendo ' +
+                'demasiadas peticiones. Por favor, inténtalo de nuevo en unos ' +
+                'minutos.', true);
             } else {
                 self.showErrorMessage('Ha ocurrido un error interno enviando el ' +
                 'formulario. Por favor, ponte en <a href="#contact">contacto ' +
@@ -777,7 +851,7 @@
             };
 
             var self = this;
-            var jqxhr = $.ajax("/api/v1/sms_auth/", {
+            var jqxhr = AE.ajaxRetryOverloaded(AE.apiUrl("/sms_auth/"), {
                 data: JSON.stringify(inputData),
                 contentType : 'application/json',
                 type: 'POST'
@@ -831,6 +905,10 @@
             } else if (data.error_codename == "invalid_token") {
                 self.showErrorMessage('¡Vaya! El código SMS que has ' +
                     'introducido es incorrecto, por favor compruébalo.', true);
+            } else if(data.error_codename == "overloaded") {
+                self.showErrorMessage('¡Vaya! Ahora mismo estamos recibiendo ' +
+                'demasiadas peticiones. Por favor, inténtalo de nuevo en unos ' +
+                'minutos.', true);
             } else {
                 self.showErrorMessage('Ha ocurrido un error interno enviando el ' +
                 'formulario. Por favor, ponte en <a href="#contact">contacto ' +
@@ -1004,7 +1082,7 @@
 
 
             var self = this;
-            var jqxhr = $.ajax("/api/v1/contact/", {
+            var jqxhr = $.ajax(AE.apiUrl("/contact/"), {
                 data: JSON.stringify(inputData),
                 contentType : 'application/json',
                 type: 'POST'
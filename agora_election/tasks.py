@@ -17,52 +17,209 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 from flask.ext.babel import gettext, ngettext
 
+from celery.signals import worker_process_init, task_postrun
+
 from app import app, app_flask
 from sms import SMSProvider
 
-@app.task
-def send_sms(msg_id, token, is_audio):
+@worker_process_init.connect
+def start_invalidation_listener(**kwargs):
+    '''
+    Listens to cache invalidations in each celery worker process
+    '''
+    from invalidation import ensure_listener
+    ensure_listener()
+
+@task_postrun.connect
+def clear_task_correlation_id(**kwargs):
+    from tracing import clear_correlation_id
+    clear_correlation_id()
+
+@app.task(bind=True)
+def send_sms(self, msg_id, token, is_audio, election_key=None,
+             idempotency_key=None):
     '''
-    Sends an sms with a given content to the receiver
+    Sends an sms with a given content to the receiver. election_key is the key
+    of the election in ELECTIONS settings, if any.
+
+    Provider errors are retried with exponential backoff, and messages that
+    can't be delivered are dead-lettered. See delivery.py.
     '''
     from app import db
-    from models import Message, Voter
+    from models import Message, Voter, VoterStatusCounter
+    from elections import get_config
+    from delivery import (claim_message, dead_letter, backoff_secs,
+                          REASON_EXPIRED, REASON_MAX_ATTEMPTS)
+    from tracing import start_task, task_headers, Span
 
     # get the msg
     msg = db.session.query(Message)\
         .filter(Message.id == msg_id).first()
     if msg is None:
         raise Exception("Message with id = %d not found" % msg_id)
-    if msg.status != Message.STATUS_QUEUED:
-        raise Exception("Message msg id = %d is not in "
-            "queued status (0), but '%d'" % (msg_id, msg.status))
+    start_task(self.request, msg.correlation_id)
+    if idempotency_key is None:
+        idempotency_key = msg.idempotency_key
+
+    # claim it, so that it's never sent twice
+    if not claim_message(msg_id, idempotency_key):
+        db.session.rollback()
+        logging.warn("not sending msg with id = %d because it's not queued "
+                     "anymore (status = %d)" % (msg_id, msg.status))
+        return
+    db.session.commit()
 
     voter = msg.voters.first()
-    if not voter.is_active:
+    if voter is None or not voter.is_active:
         logging.warn("not sending msg with id = %d because voter is not "
                      "active anymore" % msg_id)
+        msg.status = Message.STATUS_IGNORE
+        db.session.add(msg)
+        db.session.commit()
+        return
+
+    # do not send tokens that are not valid anymore
+    expire_secs = get_config("SMS_TOKEN_EXPIRE_SECS", 60*10, election_key)
+    if datetime.utcnow() - msg.created > timedelta(seconds=expire_secs):
+        dead_letter([msg], REASON_EXPIRED)
+        db.session.commit()
         return
 
     # forge the message using the token
-    site_name = app_flask.config.get("SITE_NAME", "")
+    site_name = get_config("SITE_NAME", "", election_key)
     content = gettext(
-        app_flask.config.get("SMS_MESSAGE", ""),
+        get_config("SMS_MESSAGE", "", election_key),
         token=token, server_name=site_name)
 
+    # actually send the sms
+    provider = SMSProvider.get_instance()
+    try:
+        with Span("provider", message_id=msg_id,
+                  attempt=(msg.attempts or 0) + 1) as span:
+            ret = provider.send_sms(msg.tlf, content, is_audio)
+            span.fields['provider'] = getattr(
+                provider, 'last_provider_name', provider.provider_name)
+            if ret is not None and provider.is_error(ret):
+                raise Exception("provider error: %s" % str(ret))
+    except Exception as e:
+        logging.exception("error sending msg with id = %d" % msg_id)
+        msg.sms_provider = getattr(provider, 'last_provider_name',
+                                   provider.provider_name)
+        msg.sms_routing = getattr(provider, 'last_routing', "")[:400]
+        msg.attempts = (msg.attempts or 0) + 1
+        msg.last_error = str(e)[:400]
+        msg.modified = datetime.utcnow()
+        max_attempts = get_config("SMS_MAX_ATTEMPTS", 5, election_key)
+        countdown = backoff_secs(msg.attempts)
+        if msg.attempts >= max_attempts or\
+                datetime.utcnow() + timedelta(seconds=countdown) - msg.created\
+                > timedelta(seconds=expire_secs):
+            db.session.add(msg)
+            dead_letter([msg], REASON_MAX_ATTEMPTS)
+            db.session.commit()
+            return
+
+        msg.status = Message.STATUS_QUEUED
+        msg.next_attempt = datetime.utcnow() + timedelta(seconds=countdown)
+        db.session.add(msg)
+        db.session.commit()
+        raise self.retry(exc=e, countdown=countdown, max_retries=max_attempts,
+                         headers=task_headers(countdown))
+
+    # record first that the provider accepted it, so that if the commit of
+    # the status update fails the message is not taken as lost and its voter
+    # is not deactivated (see delivery.reconcile_deliveries)
+    msg.sms_provider = getattr(provider, 'last_provider_name',
+                               provider.provider_name)
+    msg.sms_routing = getattr(provider, 'last_routing', "")[:400]
+    msg.sms_status = "sent"
+    msg.sms_response = str(ret)[:400] if ret is not None else ""
+    db.session.add(msg)
+    db.session.commit()
+
     # update status
     msg.status = Message.STATUS_SENT
     msg.content = content
     msg.modified = datetime.utcnow()
-    voter = msg.voters.first()
+    msg.next_attempt = None
     voter.status = Voter.STATUS_SENT
     voter.modified = datetime.utcnow()
     db.session.add(msg)
     db.session.add(voter)
+    VoterStatusCounter.increment(voter.election_id, Voter.STATUS_SENT)
     db.session.commit()
 
-    # actually send the sms
-    provider = SMSProvider.get_instance()
-    provider.send_sms(msg.tlf, content, is_audio)
+@app.task
+def process_dni_upload(file_path):
+    '''
+    Verifies that an uploaded dni file is a valid image and generates its
+    thumbnail next to it (<file_path>.thumb.jpg). Invalid files are removed.
+
+    NOTE: requires Pillow to be installed. If it's not available, the file is
+    kept unverified.
+    '''
+    import os
+    try:
+        from PIL import Image
+    except ImportError:
+        logging.warn("process_dni_upload: PIL not available, not verifying "
+                     "'%s'" % file_path)
+        return
+
+    if not os.path.exists(file_path):
+        logging.warn("process_dni_upload: file '%s' not found" % file_path)
+        return
+
+    try:
+        with Image.open(file_path) as img:
+            img.verify()
+    except Exception as e:
+        logging.warn("process_dni_upload: removing invalid image '%s': %s" % (
+            file_path, str(e)))
+        os.unlink(file_path)
+        return
+
+    # verify() leaves the image unusable, so we need to reopen it
+    size = app_flask.config.get('DNI_THUMBNAIL_SIZE', (256, 256))
+    with Image.open(file_path) as img:
+        img.thumbnail(size)
+        img.convert("RGB").save(file_path + ".thumb.jpg", "JPEG")
+
+@app.task
+def archive_stale_rows():
+    '''
+    Periodic task that archives stale voters and expired messages. See
+    archive.py and CELERYBEAT_SCHEDULE in settings.
+    '''
+    from archive import archive_all
+    archive_all()
+
+@app.task
+def check_sms_providers():
+    '''
+    Periodic task that polls the credit and health of the sms providers in
+    use. See sms.check_providers and CELERYBEAT_SCHEDULE in settings.
+    '''
+    from sms import check_providers
+    check_providers()
+
+@app.task
+def reconcile_sms_deliveries():
+    '''
+    Periodic task that dead-letters the sms messages whose delivery was lost.
+    See delivery.py and CELERYBEAT_SCHEDULE in settings.
+    '''
+    from delivery import reconcile_deliveries
+    reconcile_deliveries()
+
+@app.task
+def update_rollups():
+    '''
+    Periodic task that updates the per-minute rollups. See rollups.py and
+    CELERYBEAT_SCHEDULE in settings.
+    '''
+    from rollups import update_all_rollups
+    update_all_rollups()
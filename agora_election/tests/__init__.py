@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of agora-election.
+# Copyright (C) 2014  Eduardo Robles Elvira <edulix AT agoravoting DOT com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Tests. Run them from the agora_election directory with:
+
+    $ python -m unittest discover tests
+
+They use a temporary sqlite database and the settings in TEST_SETTINGS,
+loaded through AGORA_ELECTION_SETTINGS before the app is imported.
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+TEST_DIR = tempfile.mkdtemp(prefix="aelection-tests-")
+
+TEST_SETTINGS = '''
+SQLALCHEMY_DATABASE_URI = "sqlite:///%(dir)s/test.db"
+SERIALIZATION_MODE = "ROWLOCK"
+CELERY_ALWAYS_EAGER = True
+INVALIDATION_BACKEND = None
+SINGLE_FLIGHT = False
+AGORA_ELECTION_DATA_URL = "%(dir)s/election.json"
+DNI_FILE_PATH = "%(dir)s/dni/"
+DNI_MAX_UPLOAD_SIZE = 1024
+MAX_CONTENT_LENGTH = 256*1024
+ELECTIONS = dict(
+    other=dict(CURRENT_ELECTION_ID=2, PATH_PREFIX="/other",
+               DNI_MAX_UPLOAD_SIZE=1024*1024),
+)
+CURRENT_ELECTION_ID = 1
+''' % dict(dir=TEST_DIR)
+
+settings_path = os.path.join(TEST_DIR, "test_settings.py")
+with open(settings_path, 'w', encoding="utf-8") as f:
+    f.write(TEST_SETTINGS)
+os.environ['AGORA_ELECTION_SETTINGS'] = settings_path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app_flask, db
+
+
+class AppTestCase(unittest.TestCase):
+    '''
+    Creates the tables of the test database before each test, and drops them
+    afterwards
+    '''
+
+    def setUp(self):
+        self.ctx = app_flask.app_context()
+        self.ctx.push()
+        db.create_all(bind=None)
+        self.client = app_flask.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all(bind=None)
+        self.ctx.pop()
+
+
+def tearDownModule():
+    shutil.rmtree(TEST_DIR, ignore_errors=True)
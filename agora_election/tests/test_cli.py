@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of agora-election.
+# Copyright (C) 2014  Eduardo Robles Elvira <edulix AT agoravoting DOT com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import sys
+from contextlib import redirect_stdout
+from unittest import mock
+
+from tests import AppTestCase
+from app import db, main
+from models import Voter, Message, ColorList
+
+
+class ElectionScopedMessagesTestCase(AppTestCase):
+    '''
+    --list-messages and --remove scope the messages by --election through
+    the voters that reference them
+    '''
+
+    def setUp(self):
+        super(ElectionScopedMessagesTestCase, self).setUp()
+        for election_id, tlf in [(1, "+34600000001"), (2, "+34600000002")]:
+            msg = Message(tlf=tlf, ip="10.0.0.1", status=Message.STATUS_SENT,
+                          authenticated=False)
+            db.session.add(msg)
+            db.session.flush()
+            db.session.add(Voter(election_id=election_id, tlf=tlf,
+                                 ip="10.0.0.1", message_id=msg.id,
+                                 is_active=True,
+                                 status=Voter.STATUS_REQUESTED))
+        db.session.add(ColorList(action=ColorList.ACTION_BLACKLIST,
+                                 key=ColorList.KEY_IP, value="10.0.0.1"))
+        db.session.commit()
+
+    def run_main(self, *args):
+        out = io.StringIO()
+        with mock.patch.object(sys, 'argv', ["app.py"] + list(args)),\
+                redirect_stdout(out):
+            main()
+        return out.getvalue()
+
+    def test_list_messages_election(self):
+        out = self.run_main("--list-messages", "--election", "other",
+                            "--output-format", "json",
+                            "--output-fields", "tlf")
+        self.assertIn("+34600000002", out)
+        self.assertNotIn("+34600000001", out)
+
+    def test_remove_blacklist_election(self):
+        self.run_main("--remove", "--blacklist", "--ip", "10.0.0.1",
+                      "--election", "other")
+        db.session.expire_all()
+        statuses = dict((m.tlf, m.status) for m in db.session.query(Message))
+        self.assertEqual(statuses["+34600000002"], Message.STATUS_IGNORE)
+        self.assertEqual(statuses["+34600000001"], Message.STATUS_SENT)
+        voters = dict((v.tlf, v.status) for v in db.session.query(Voter))
+        self.assertEqual(voters["+34600000002"],
+                         Voter.STATUS_REQUESTED_IGNORE)
+        self.assertEqual(voters["+34600000001"], Voter.STATUS_REQUESTED)
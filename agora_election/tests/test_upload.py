@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of agora-election.
+# Copyright (C) 2014  Eduardo Robles Elvira <edulix AT agoravoting DOT com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+import json
+from unittest import mock
+
+from tests import AppTestCase, TEST_DIR
+from app import app_flask
+import tasks
+
+
+class UploadDniTestCase(AppTestCase):
+    '''
+    Oversized dni uploads are rejected before their body is spooled
+    '''
+
+    def upload(self, url, size):
+        return self.client.post(url, data=dict(
+            dni=(io.BytesIO(b"x" * size), "dni.jpg")))
+
+    def stored_files(self):
+        path = os.path.join(TEST_DIR, "dni")
+        return [name for _, _, names in os.walk(path) for name in names]
+
+    def test_upload(self):
+        with mock.patch.object(tasks.process_dni_upload, 'apply_async'):
+            ret = self.upload("/api/v1/upload-dni/", 512)
+        self.assertEqual(ret.status_code, 200)
+        self.assertEqual(json.loads(ret.data.decode('utf-8'))['size'], 512)
+        self.assertEqual(len(self.stored_files()), 1)
+
+    def test_bigger_than_dni_max_upload_size(self):
+        with mock.patch.object(app_flask.request_class,
+                               '_get_file_stream') as spool:
+            ret = self.upload("/api/v1/upload-dni/", 128*1024)
+        self.assertEqual(ret.status_code, 413)
+        self.assertFalse(spool.called)
+        self.assertEqual(self.stored_files(), [])
+
+    def test_bigger_than_max_content_length(self):
+        # the election allows 1MB files, but the request is bigger than
+        # MAX_CONTENT_LENGTH
+        with mock.patch.object(app_flask.request_class,
+                               '_get_file_stream') as spool:
+            ret = self.upload("/other/api/v1/upload-dni/", 512*1024)
+        self.assertEqual(ret.status_code, 413)
+        self.assertFalse(spool.called)
+        data = json.loads(ret.data.decode('utf-8'))
+        self.assertEqual(data['error_codename'], "file_too_big")
+        self.assertEqual(self.stored_files(), [])
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of agora-election.
+# Copyright (C) 2014  Eduardo Robles Elvira <edulix AT agoravoting DOT com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from types import SimpleNamespace
+from unittest import mock
+
+from sqlalchemy.exc import OperationalError
+
+from tests import AppTestCase
+from app import app_flask
+from writebehind import WriteBehindBuffer, VOTER_COLUMNS
+
+
+def make_voter(ip="10.0.0.1"):
+    voter = SimpleNamespace(**dict((col, None) for col in VOTER_COLUMNS))
+    voter.election_id = 1
+    voter.ip = ip
+    return voter
+
+
+class WriteBehindBufferTestCase(AppTestCase):
+    '''
+    The buffer keeps at most max_pending rows while the database is down
+    '''
+
+    def setUp(self):
+        super(WriteBehindBufferTestCase, self).setUp()
+        self.buffer = WriteBehindBuffer(app_flask, flush_interval=60,
+                                        max_size=100, max_attempts=5,
+                                        max_pending=3)
+
+    def test_add_over_max_pending(self):
+        for i in range(5):
+            self.buffer.add(make_voter())
+        self.assertEqual(len(self.buffer.rows), 3)
+        self.assertEqual(self.buffer.dropped, 2)
+        self.assertEqual(self.buffer.pending_requested_count(1, "10.0.0.1"), 3)
+
+    def test_database_unavailable(self):
+        for i in range(3):
+            self.buffer.add(make_voter("10.0.0.1"))
+
+        def insert(engine, rows):
+            # more voters arrive while the flush is failing
+            for i in range(2):
+                self.buffer.add(make_voter("10.0.0.2"))
+            raise OperationalError("INSERT", {}, Exception("database down"))
+
+        with mock.patch.object(self.buffer, 'insert', side_effect=insert):
+            self.buffer.flush()
+
+        # the retried rows are kept, the newest ones dropped
+        self.assertEqual(len(self.buffer.rows), 3)
+        self.assertEqual(self.buffer.dropped, 2)
+        self.assertEqual(self.buffer.pending_requested_count(1, "10.0.0.1"), 3)
+        self.assertEqual(self.buffer.pending_requested_count(1, "10.0.0.2"), 0)
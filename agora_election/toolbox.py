@@ -16,11 +16,15 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import json
 import re
 import random
 import time
 import codecs
+import hashlib
+import logging
+import tempfile
 from functools import partial
 
 from flask import Blueprint, request, make_response, render_template, url_for
@@ -30,9 +34,7 @@ from flask.ext.captcha.models import CaptchaStore
 from flask import current_app
 from jinja2 import Markup
 from sqlalchemy.exc import InvalidRequestError, DBAPIError
-from sqlalchemy.orm import exc as sa_exc
-
-from prettytable import PrettyTable
+from sqlalchemy.orm import exc as sa_exc, sessionmaker, scoped_session
 
 from checks import *
 from app import db, app_mail
@@ -136,6 +138,160 @@ def serializable_retry(func, max_num_retries=None):
 
     return partial(wrap, max_num_retries)
 
+def hashed_file_path(base_path, digest, depth=2, width=2):
+    '''
+    Returns the sharded path where a file with the given hex digest is stored,
+    so that we don't end up with a single flat directory with lots of files.
+
+    Example:
+    hashed_file_path("/tmp/dni", "ab12cd...") -> "/tmp/dni/ab/12/ab12cd..."
+    '''
+    shards = [digest[i*width:(i+1)*width] for i in range(depth)]
+    return os.path.join(base_path, *(shards + [digest]))
+
+def save_stream_by_hash(stream, base_path, max_size, chunk_size=64*1024):
+    '''
+    Streams the contents of a file-like object to disk in chunks while hashing
+    it with sha256, and stores it in a content-addressed sharded path (see
+    hashed_file_path), so that the same file uploaded twice is stored only
+    once.
+
+    The data is first written to a temporary file in base_path and then
+    renamed atomically to its final path. If the stream is bigger than
+    max_size bytes, the temporary file is removed and None is returned.
+
+    Returns a tuple (digest, full_path, size, is_new).
+    '''
+    if not os.path.exists(base_path):
+        os.makedirs(base_path)
+
+    sha = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=base_path, prefix=".upload-")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    os.unlink(tmp_path)
+                    return None
+                sha.update(chunk)
+                f.write(chunk)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    digest = sha.hexdigest()
+    full_path = hashed_file_path(base_path, digest)
+    if os.path.exists(full_path):
+        # dedup: we already have this exact file
+        os.unlink(tmp_path)
+        return digest, full_path, size, False
+
+    dir_path = os.path.dirname(full_path)
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path, exist_ok=True)
+    os.rename(tmp_path, full_path)
+    return digest, full_path, size, True
+
+# directories already checked by ensure_private_dir
+_private_dirs = set()
+
+def ensure_private_dir(path):
+    '''
+    Creates the directory with mode 0700 if it does not exist, and checks
+    that it's a directory owned by the user of the process, not accessible
+    by others. Used for the directories whose files are trusted (lock files,
+    shared responses, snapshots), so that other local users can't plant or
+    replace them.
+    '''
+    import stat
+    if path in _private_dirs:
+        return
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.geteuid():
+        raise PermissionError(
+            "%s is not a directory owned by the app user" % path)
+    if st.st_mode & 0o077:
+        os.chmod(path, 0o700)
+    _private_dirs.add(path)
+
+# cached result of the replica lag check: (timestamp, is_fresh)
+_replica_lag_check = [0, False]
+
+# scoped sessions for the read replica binds, by bind key
+_replica_sessions = dict()
+
+def replica_is_fresh(engine):
+    '''
+    Lag guard for the read replica. Returns True if the replica replication
+    lag is below REPLICA_MAX_LAG_SECS. Only postgresql replicas are checked,
+    and the result is cached for REPLICA_LAG_CHECK_SECS.
+    '''
+    from app import app_flask
+    check_secs = app_flask.config.get('REPLICA_LAG_CHECK_SECS', 5)
+    now = time.time()
+    if now - _replica_lag_check[0] < check_secs:
+        return _replica_lag_check[1]
+
+    is_fresh = True
+    if engine.dialect.name == "postgresql":
+        max_lag = app_flask.config.get('REPLICA_MAX_LAG_SECS', 10)
+        try:
+            lag = engine.execute(
+                "SELECT EXTRACT(EPOCH FROM now() - "
+                "pg_last_xact_replay_timestamp())").scalar()
+            # lag is null when the server is not a replica
+            is_fresh = lag is None or lag <= max_lag
+            if not is_fresh:
+                logging.warn("replica lag is %ss, using primary" % lag)
+        except DBAPIError as e:
+            logging.warn("replica lag check failed, using primary: %s" % e)
+            is_fresh = False
+
+    _replica_lag_check[:] = [now, is_fresh]
+    return is_fresh
+
+def get_read_session():
+    '''
+    Returns a session for non-critical reads (listings, reports, stats). If a
+    read replica is configured in SQLALCHEMY_BINDS with the REPLICA_BIND_KEY
+    key and it's not lagging behind too much, the session reads from it,
+    otherwise it's the default session of the primary database.
+
+    The replica session is a plain scoped session bound only to the replica
+    engine: the sessions of Flask-SQLAlchemy route each mapped table to its
+    own bind, which would send all the queries to the primary. It's removed
+    at the end of each request by remove_read_sessions.
+
+    NOTE: never use this session for writes or inside serializable_retry.
+    '''
+    from app import app_flask
+    bind_key = app_flask.config.get('REPLICA_BIND_KEY', 'replica')
+    if bind_key not in (app_flask.config.get('SQLALCHEMY_BINDS') or {}):
+        return db.session
+
+    engine = db.get_engine(app_flask, bind=bind_key)
+    if not replica_is_fresh(engine):
+        return db.session
+    if bind_key not in _replica_sessions:
+        _replica_sessions[bind_key] = scoped_session(
+            sessionmaker(bind=engine, autoflush=False))
+    return _replica_sessions[bind_key]
+
+def remove_read_sessions(exception=None):
+    '''
+    teardown_appcontext hook that removes the replica sessions of the current
+    thread, like Flask-SQLAlchemy does with db.session
+    '''
+    for session in _replica_sessions.values():
+        session.remove()
+
 def read_csv_to_dicts(path, sep=";", key_column=0):
     '''
     Given a file in CSV format, convert it to a dictionary.
@@ -203,8 +359,10 @@ def format_print_table_output(output_format, table_header, items, row_getter,
       format, for example (comma by default)
     '''
     if output_format == "table":
+        from prettytable import PrettyTable
         table = PrettyTable(table_header)
-        print("%d rows:" % items.count())
+        print("%d rows:" % (len(items) if isinstance(items, list)
+                            else items.count()))
         for item in items:
             table.add_row(row_getter(item))
         print(table)
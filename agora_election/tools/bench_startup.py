@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+'''
+Measures the startup time of agora-election, to track cold start
+regressions. Run it from the agora_election directory:
+
+    $ python tools/bench_startup.py -n 10
+
+Each command is run in a new python process, and the min, median and max
+wall times are printed. The first load of the election data fetches it from
+AGORA_ELECTION_DATA_URL, and the next ones use the snapshot stored in
+ELECTION_SNAPSHOT_DIR: compare its max and min times to see the difference
+(delete the files in ELECTION_SNAPSHOT_DIR first for a cold run).
+'''
+
+import sys
+import time
+import argparse
+import subprocess
+
+COMMANDS = (
+    ("import app", [sys.executable, "-c", "import app"]),
+    ("import tasks (celery worker)", [sys.executable, "-c", "import tasks"]),
+    ("--list-colors", [sys.executable, "app.py", "--list-colors", "-F", "json"]),
+    ("--count-captchas", [sys.executable, "app.py", "--count-captchas"]),
+    ("load election data", [sys.executable, "-c",
+        "import app, elections; "
+        "elections.load_all_election_data(app.app_flask)"]),
+)
+
+def bench(cmd, num_runs):
+    '''
+    Runs a command num_runs times and returns the sorted list of wall times
+    '''
+    times = []
+    for i in range(num_runs):
+        start = time.time()
+        subprocess.call(cmd, stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL)
+        times.append(time.time() - start)
+    return sorted(times)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--num-runs", type=int, default=5,
+                        help="number of runs per command")
+    pargs = parser.parse_args()
+
+    print("%-32s %8s %8s %8s" % ("command", "min", "median", "max"))
+    for name, cmd in COMMANDS:
+        times = bench(cmd, pargs.num_runs)
+        print("%-32s %7.3fs %7.3fs %7.3fs" % (
+            name, times[0], times[len(times) // 2], times[-1]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+'''
+Offline analysis of the registrations to find distributed abuse that the
+per ip/tlf checks of the register pipeline can't see: many /24 subnets (/48
+for ipv6) each staying under the limits, blocks of consecutive phone numbers,
+and bursts by subnet, tlf prefix and postal code per time bucket.
+
+Run it from the agora_election directory, with the same settings as the app:
+
+    $ python tools/fraud_clusters.py -o /tmp/fraud/ --since 2014-05-20
+
+The voter and message tables are streamed into numpy columnar arrays (values
+are stored as integer codes), and all the aggregations are vectorized. It
+writes in the output directory:
+
+  * report.json: the clusters and bursts found, with their stats
+  * blacklist.tsv: candidate blacklist entries ("ip<TAB>value<TAB>reason" or
+    "tlf<TAB>value<TAB>reason") of the flagged clusters that never
+    authenticated, to be reviewed and then imported with:
+
+        $ ./app.py --blacklist --import-colorlist /tmp/fraud/blacklist.tsv
+
+NOTE: requires numpy, which is not a dependency of the app itself.
+'''
+
+import os
+import sys
+import json
+import calendar
+import argparse
+from array import array
+from datetime import datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class Codes(object):
+    '''
+    Maps string values to consecutive integer codes
+    '''
+    def __init__(self):
+        self.codes = dict()
+        self.values = []
+
+    def get(self, value):
+        code = self.codes.get(value, None)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def __len__(self):
+        return len(self.values)
+
+def subnet_of(ip):
+    '''
+    Returns the /24 subnet of an ipv4 address or the /48 of an ipv6 one
+    '''
+    ip = ip or ""
+    if ':' in ip:
+        return ':'.join(ip.split(':')[:3]) + '::/48'
+    return '.'.join(ip.split('.')[:3]) + '.0/24'
+
+def load_voters(session, since, prefix_digits, batch_size=10000):
+    '''
+    Streams the voters created since the given date into columnar arrays.
+    Returns a dict of numpy arrays and the Codes of each string column.
+    '''
+    from models import Voter
+
+    cols = dict((name, array('q')) for name in
+                ('created', 'ip', 'subnet', 'tlf', 'prefix', 'postal_code',
+                 'confirmed'))
+    codes = dict((name, Codes()) for name in
+                 ('ip', 'subnet', 'tlf', 'prefix', 'postal_code'))
+    confirmed_status = (Voter.STATUS_AUTHENTICATED, Voter.STATUS_VOTED)
+
+    query = session.query(Voter.created, Voter.ip, Voter.tlf,
+                          Voter.postal_code, Voter.status)
+    if since is not None:
+        query = query.filter(Voter.created >= since)
+    for created, ip, tlf, postal_code, status in query.yield_per(batch_size):
+        tlf = tlf or ""
+        cols['created'].append(
+            calendar.timegm(created.utctimetuple()) if created else 0)
+        cols['ip'].append(codes['ip'].get(ip))
+        cols['subnet'].append(codes['subnet'].get(subnet_of(ip)))
+        cols['tlf'].append(codes['tlf'].get(tlf))
+        cols['prefix'].append(codes['prefix'].get(
+            tlf[:-prefix_digits] if len(tlf) > prefix_digits else tlf))
+        cols['postal_code'].append(codes['postal_code'].get(postal_code))
+        cols['confirmed'].append(1 if status in confirmed_status else 0)
+
+    return dict((name, np.frombuffer(col, dtype=np.int64))
+                for name, col in cols.items()), codes
+
+def load_sent_messages(session, since, subnet_codes, batch_size=10000):
+    '''
+    Returns the number of sms sent to each subnet (indexed by subnet code)
+    '''
+    from models import Message
+
+    subnets = array('q')
+    query = session.query(Message.ip)\
+        .filter(Message.status == Message.STATUS_SENT)
+    if since is not None:
+        query = query.filter(Message.created >= since)
+    for ip, in query.yield_per(batch_size):
+        code = subnet_codes.codes.get(subnet_of(ip), None)
+        if code is not None:
+            subnets.append(code)
+    return np.bincount(np.frombuffer(subnets, dtype=np.int64),
+                       minlength=len(subnet_codes))
+
+def distinct_per_group(group, member, num_groups):
+    '''
+    Number of distinct members of each group, e.g. distinct ips per subnet
+    '''
+    pairs = np.unique(group * (member.max() + 1) + member)
+    return np.bincount(pairs // (member.max() + 1), minlength=num_groups)
+
+def find_clusters(data, codes, group_name, member_name, min_members,
+                  max_confirmed_ratio):
+    '''
+    Finds the groups (subnets, tlf prefixes) with at least min_members
+    distinct members (ips, tlfs) and a ratio of confirmed (authenticated or
+    voted) registrations of at most max_confirmed_ratio
+    '''
+    group = data[group_name]
+    num_groups = len(codes[group_name])
+    total = np.bincount(group, minlength=num_groups)
+    confirmed = np.bincount(group, weights=data['confirmed'],
+                            minlength=num_groups)
+    members = distinct_per_group(group, data[member_name], num_groups)
+    ratio = confirmed / np.maximum(total, 1)
+
+    flagged = np.nonzero((members >= min_members) &
+                         (ratio <= max_confirmed_ratio))[0]
+    flagged = flagged[np.argsort(-total[flagged])]
+    return [dict(value=codes[group_name].values[g],
+                 registrations=int(total[g]),
+                 distinct=int(members[g]),
+                 confirmed_ratio=round(float(ratio[g]), 3))
+            for g in flagged]
+
+def find_bursts(data, codes, group_name, bucket_secs, min_count, factor):
+    '''
+    Finds the (group, time bucket) cells with at least min_count
+    registrations and factor times the median of the non empty cells. Only
+    the non empty cells are counted, and voters without creation date (0) are
+    skipped.
+    '''
+    known = data['created'] > 0
+    if not known.any():
+        return []
+    created = data['created'][known].astype(np.int64)
+    group = data[group_name][known].astype(np.int64)
+    start = created.min()
+    bucket = (created - start) // bucket_secs
+    num_buckets = int(bucket.max()) + 1
+    cells, counts = np.unique(group * num_buckets + bucket,
+                              return_counts=True)
+    threshold = max(min_count, float(np.median(counts)) * factor)
+
+    flagged = np.nonzero(counts >= threshold)[0]
+    flagged = flagged[np.argsort(-counts[flagged])]
+    return [dict(value=codes[group_name].values[cells[i] // num_buckets],
+                 start=datetime.utcfromtimestamp(
+                     int(start + (cells[i] % num_buckets) * bucket_secs))\
+                     .isoformat(),
+                 registrations=int(counts[i]))
+            for i in flagged]
+
+def unconfirmed_members(data, codes, group_name, member_name, clusters):
+    '''
+    Returns the (group value, member value) pairs of the distinct members
+    (ips, tlfs) of the given clusters that have never been confirmed
+    '''
+    if not clusters:
+        return []
+    group = data[group_name]
+    member = data[member_name]
+    group_codes = [codes[group_name].codes[c['value']] for c in clusters]
+    confirmed = np.bincount(member, weights=data['confirmed'],
+                            minlength=len(codes[member_name]))
+    mask = np.in1d(group, group_codes) & (confirmed[member] == 0)
+
+    base = member.max() + 1
+    pairs = np.unique(group[mask] * base + member[mask])
+    return [(codes[group_name].values[pair // base],
+             codes[member_name].values[pair % base]) for pair in pairs]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output-dir", required=True,
+                        help="directory where the report and the candidate "
+                        "blacklist are written")
+    parser.add_argument("--since", default=None,
+                        help="only analyze voters created since this date "
+                        "(YYYY-MM-DD)")
+    parser.add_argument("--prefix-digits", type=int, default=2,
+                        help="number of trailing digits removed from tlfs to "
+                        "group them in blocks of consecutive numbers")
+    parser.add_argument("--min-ips", type=int, default=5,
+                        help="minimum distinct ips of a flagged subnet")
+    parser.add_argument("--min-tlfs", type=int, default=5,
+                        help="minimum distinct tlfs of a flagged tlf prefix")
+    parser.add_argument("--max-confirmed-ratio", type=float, default=0.1,
+                        help="maximum ratio of confirmed registrations of a "
+                        "flagged cluster")
+    parser.add_argument("--bucket-secs", type=int, default=300,
+                        help="size of the time buckets for bursts")
+    parser.add_argument("--burst-min", type=int, default=20,
+                        help="minimum registrations of a burst")
+    parser.add_argument("--burst-factor", type=float, default=10,
+                        help="a burst has at least this times the median "
+                        "registrations per bucket")
+    pargs = parser.parse_args()
+
+    if np is None:
+        print("numpy is required: pip install numpy")
+        exit(1)
+
+    from app import db
+    since = datetime.strptime(pargs.since, "%Y-%m-%d") if pargs.since\
+        else None
+    data, codes = load_voters(db.session, since, pargs.prefix_digits)
+    if len(data['created']) == 0:
+        print("no voters found")
+        return
+    sent = load_sent_messages(db.session, since, codes['subnet'])
+
+    subnets = find_clusters(data, codes, 'subnet', 'ip', pargs.min_ips,
+                            pargs.max_confirmed_ratio)
+    for cluster in subnets:
+        cluster['sms_sent'] = int(sent[codes['subnet'].codes[cluster['value']]])
+    prefixes = find_clusters(data, codes, 'prefix', 'tlf', pargs.min_tlfs,
+                             pargs.max_confirmed_ratio)
+    report = dict(
+        num_voters=len(data['created']),
+        subnet_clusters=subnets,
+        tlf_prefix_clusters=prefixes,
+        bursts=dict(
+            (name, find_bursts(data, codes, name, pargs.bucket_secs,
+                               pargs.burst_min, pargs.burst_factor))
+            for name in ('subnet', 'prefix', 'postal_code')))
+
+    if not os.path.exists(pargs.output_dir):
+        os.makedirs(pargs.output_dir)
+    with open(os.path.join(pargs.output_dir, "report.json"), 'w',
+              encoding="utf-8") as f:
+        f.write(json.dumps(report, indent=4))
+
+    num_candidates = 0
+    with open(os.path.join(pargs.output_dir, "blacklist.tsv"), 'w',
+              encoding="utf-8") as f:
+        for key, group_name, member_name, clusters in [
+                ('ip', 'subnet', 'ip', subnets),
+                ('tlf', 'prefix', 'tlf', prefixes)]:
+            for group_value, value in unconfirmed_members(
+                    data, codes, group_name, member_name, clusters):
+                f.write("%s\t%s\t%s cluster %s\n" % (
+                    key, value, group_name, group_value))
+                num_candidates += 1
+
+    print("analyzed %d voters: %d subnet clusters, %d tlf prefix clusters, "
+          "%d candidate blacklist entries" % (
+              len(data['created']), len(subnets), len(prefixes),
+              num_candidates))
+
+if __name__ == "__main__":
+    main()
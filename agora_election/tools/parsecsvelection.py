@@ -4,32 +4,38 @@
 import sys
 import json
 import re
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
-def file_to_dict(fpath):
+def iter_tsv(fpath):
     '''
-    converts a TSV file with a header line with column names to a list of dicts
+    Parses a TSV file with a header line with column names as a stream,
+    yielding a dict for each line
     '''
     with open(fpath, 'r', encoding="utf-8") as f:
-        data = f.read()
+        keynames = f.readline().strip().split('\t')
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            yield dict(zip(keynames, line.split('\t')))
 
-    lines = data.split('\n')
-    keynames = []
-    ret = []
-
-    # first line specifies the columns
-    first = True
-    for line in lines:
-        line = line.strip()
-        if first:
-            keynames = line.split('\t')
-            first = False
-            continue
-
-        pairs = [(key, value) for key, value in zip(keynames, line.split('\t'))]
-        ret.append(dict(pairs))
+def file_to_dict(fpath):
+    '''
+    converts a TSV file with a header line with column names to a list of dicts
+    '''
+    return list(iter_tsv(fpath))
 
-    return ret
+def cand_hash(cand):
+    '''
+    Returns a hash of the contents of a candidate row, used to detect which
+    candidates changed between runs
+    '''
+    data = json.dumps(cand, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
 
 def get_details(cand):
     '''
@@ -85,26 +91,121 @@ def get_media_url(cand):
         'http://www.podemos.info/sites/default/files/',
         'https://primarias.podemos.info/static2/cands/')
 
+def check_media_url(url, timeout=10):
+    '''
+    Checks that the media url is reachable and is an image. Returns the url if
+    it's valid, or an empty string otherwise.
+    '''
+    if not url:
+        return url
+    try:
+        r = requests.head(url, allow_redirects=True, timeout=timeout)
+        ctype = r.headers.get('content-type', '')
+        if r.status_code == 200 and ctype.startswith('image/'):
+            return url
+        sys.stderr.write("invalid image %s: status %d, type '%s'\n" % (
+            url, r.status_code, ctype))
+    except requests.RequestException as e:
+        sys.stderr.write("invalid image %s: %s\n" % (url, str(e)))
+    return ""
+
+def sort_value(value):
+    '''
+    Sort key of a column value: numeric values are compared as numbers (and
+    go before the non numeric ones)
+    '''
+    try:
+        return (0, float(value.replace(",", ".")), "")
+    except (AttributeError, ValueError):
+        return (1, 0, value or "")
+
+def cand_to_answer(cand):
+    '''
+    Converts a candidate row into a ballot answer
+    '''
+    return dict(
+        a="ballot/answer",
+        value=cand['Nombre'],
+        details=get_details(cand),
+        details_title="Presentación y motivos",
+        media_url=get_media_url(cand),
+        urls=get_urls(cand)
+    )
+
 def main():
     '''
     Executes the main task
     '''
-    data = file_to_dict(sys.argv[1])
+    parser = argparse.ArgumentParser()
+    parser.add_argument("tsv", help="TSV file with the candidates")
+    parser.add_argument("-s", "--sort-by", default=None,
+                        help="name of the column used to sort the candidates")
+    parser.add_argument("-r", "--reverse", action="store_true",
+                        help="sort in descending order")
+    parser.add_argument("--state", default=None,
+                        help="json file where the content hash and output of "
+                        "each candidate is stored between runs, so that only "
+                        "changed candidates are processed again")
+    parser.add_argument("--changed-only", action="store_true",
+                        help="only output the candidates that changed since "
+                        "the last run (requires --state)")
+    parser.add_argument("--check-images", action="store_true",
+                        help="validate that each media_url is an image")
+    parser.add_argument("-j", "--jobs", type=int, default=8,
+                        help="number of parallel image checks")
+    pargs = parser.parse_args()
+
+    state = dict()
+    if pargs.state is not None:
+        try:
+            with open(pargs.state, 'r', encoding="utf-8") as f:
+                state = json.loads(f.read())
+        except FileNotFoundError:
+            pass
 
-    # iterate through the candidates
+    # iterate through the candidates, reusing the output of the unchanged ones
     ret = []
-    for cand in data:
-        cand_data = dict(
-            a="ballot/answer",
-            value=cand['Nombre'],
-            details=get_details(cand),
-            details_title="Presentación y motivos",
-            media_url=get_media_url(cand),
-            urls=get_urls(cand)
-        )
-        ret.append(cand_data)
+    new_state = dict()
+    for cand in iter_tsv(pargs.tsv):
+        digest = cand_hash(cand)
+        sort_key = cand.get(pargs.sort_by, '') if pargs.sort_by else None
+        prev = state.get(cand['Nombre'], None)
+        is_changed = prev is None or prev['hash'] != digest
+        if is_changed:
+            cand_state = dict(hash=digest, answer=cand_to_answer(cand))
+        else:
+            cand_state = prev
+        new_state[cand['Nombre']] = cand_state
+        ret.append((sort_key, cand_state, is_changed))
+
+    # check the images of the changed candidates, and of the unchanged ones
+    # whose image was not valid the last time. The state keeps the original
+    # url, so that invalid images are checked again in the next run.
+    if pargs.check_images:
+        to_check = [cand_state for sort_key, cand_state, is_changed in ret
+                    if is_changed or not cand_state.get('media_ok', False)]
+        with ThreadPoolExecutor(max_workers=pargs.jobs) as executor:
+            urls = executor.map(check_media_url,
+                                [c['answer']['media_url'] for c in to_check])
+            for cand_state, url in zip(to_check, urls):
+                cand_state['media_ok'] = bool(url) or\
+                    not cand_state['answer']['media_url']
+
+    if pargs.sort_by:
+        ret.sort(key=lambda item: sort_value(item[0]), reverse=pargs.reverse)
+
+    def output(cand_state):
+        cand_data = cand_state['answer']
+        if pargs.check_images and not cand_state['media_ok']:
+            cand_data = dict(cand_data, media_url="")
+        return cand_data
+
+    ret = [output(cand_state) for sort_key, cand_state, is_changed in ret
+           if is_changed or not pargs.changed_only]
 
-    # TODO: sort by a specified column
+    if pargs.state is not None:
+        with open(pargs.state, 'w', encoding="utf-8") as f:
+            f.write(json.dumps(new_state))
 
     print(json.dumps(ret, indent=4))
 
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of agora-election.
+# Copyright (C) 2014  Eduardo Robles Elvira <edulix AT agoravoting DOT com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Correlation ids and span timings of the sms flow.
+
+Each web request gets a correlation id: the X-Correlation-ID request header
+if it's valid (e.g. set by the load balancer), or a new random one. It's
+returned in the X-Correlation-ID response header and stored in the
+correlation_id column of the voters and messages created by the request. The
+send_sms task receives it in its headers (falling back to the one stored in
+the message), so that a registration request, its task and the provider call
+can be linked.
+
+The current correlation id is added to every log record as
+%(correlation_id)s ("-" if there's none), which is included in the log
+formats of the app and of the celery workers (CELERYD_LOG_FORMAT).
+
+Spans are logged as one json object per line in the "agora_election.spans"
+logger (and in SPANS_LOG_FILE, if set), with the correlation id, the span
+name, its duration in milliseconds and some extra fields:
+
+  * request_to_enqueue: from the start of the request to the enqueue of the
+    send_sms task
+  * queue_wait: from the enqueue of the task (plus its countdown) to the start
+    of its execution in a worker
+  * provider: round trip of the call to the sms provider
+'''
+
+import re
+import json
+import time
+import uuid
+import logging
+import threading
+
+HEADER = 'X-Correlation-ID'
+CORRELATION_ID_RX = re.compile("^[A-Za-z0-9_.-]{8,64}$")
+
+spans_logger = logging.getLogger("agora_election.spans")
+
+_local = threading.local()
+
+def new_correlation_id():
+    return uuid.uuid4().hex
+
+def get_correlation_id():
+    '''
+    Returns the correlation id of the current request or task, or None
+    '''
+    return getattr(_local, 'correlation_id', None)
+
+def set_correlation_id(correlation_id, started=None):
+    _local.correlation_id = correlation_id
+    _local.started = started
+
+def clear_correlation_id(*args, **kwargs):
+    _local.correlation_id = None
+    _local.started = None
+
+def start_request():
+    '''
+    before_request hook that sets the correlation id of the request
+    '''
+    from flask import request
+    correlation_id = request.headers.get(HEADER, '')
+    if not CORRELATION_ID_RX.match(correlation_id):
+        correlation_id = new_correlation_id()
+    set_correlation_id(correlation_id, time.time())
+
+def add_response_header(response):
+    '''
+    after_request hook that returns the correlation id to the client
+    '''
+    correlation_id = get_correlation_id()
+    if correlation_id is not None:
+        response.headers[HEADER] = correlation_id
+    return response
+
+def log_span(name, duration_secs, correlation_id=None, **fields):
+    '''
+    Logs a span as a json line
+    '''
+    span = dict(fields)
+    span['span'] = name
+    span['correlation_id'] = correlation_id or get_correlation_id()
+    span['duration_ms'] = round(duration_secs * 1000, 1)
+    span['time'] = time.time()
+    spans_logger.info(json.dumps(span, sort_keys=True))
+
+def log_request_span(name, **fields):
+    '''
+    Logs a span from the start of the current request until now
+    '''
+    started = getattr(_local, 'started', None)
+    if started is not None:
+        log_span(name, time.time() - started, **fields)
+
+def task_headers(countdown=None):
+    '''
+    Returns the headers that pass the current correlation id to a task
+    '''
+    return dict(correlation_id=get_correlation_id(),
+                enqueued_at=time.time(),
+                countdown=countdown or 0)
+
+def start_task(task_request, fallback_correlation_id=None):
+    '''
+    Sets the correlation id of a task from its headers (or the fallback),
+    logging the queue_wait span. Returns the correlation id.
+    '''
+    headers = getattr(task_request, 'headers', None) or dict()
+    correlation_id = headers.get('correlation_id', None) or\
+        fallback_correlation_id
+    set_correlation_id(correlation_id)
+    enqueued_at = headers.get('enqueued_at', None)
+    if enqueued_at is not None:
+        countdown = headers.get('countdown', 0) or 0
+        log_span("queue_wait", time.time() - enqueued_at - countdown,
+                 task=task_request.task, countdown=countdown,
+                 retries=task_request.retries)
+    return correlation_id
+
+class Span(object):
+    '''
+    Context manager that logs a span of the code it wraps, e.g.:
+
+        with Span("provider", provider="altiria") as s:
+            ...
+            s.fields['ok'] = True
+    '''
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.fields.setdefault('error', str(exc_value)[:200])
+        log_span(self.name, time.time() - self.start, **self.fields)
+        return False
+
+def install_log_record_factory():
+    '''
+    Adds the current correlation id to all the log records
+    '''
+    old_factory = logging.getLogRecordFactory()
+    if getattr(old_factory, 'adds_correlation_id', False):
+        return
+
+    def factory(*args, **kwargs):
+        record = old_factory(*args, **kwargs)
+        record.correlation_id = get_correlation_id() or "-"
+        return record
+    factory.adds_correlation_id = True
+    logging.setLogRecordFactory(factory)
+
+def configure_spans_log(log_file):
+    '''
+    Writes the spans to log_file, one json object per line
+    '''
+    for handler in spans_logger.handlers:
+        if getattr(handler, 'spans_log_file', None) == log_file:
+            return
+    handler = logging.FileHandler(log_file)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    handler.spans_log_file = log_file
+    spans_logger.addHandler(handler)
+    spans_logger.setLevel(logging.INFO)
@@ -33,6 +33,9 @@ from sqlalchemy.orm import exc as sa_exc
 from toolbox import *
 from checks import *
 from app import db, app_mail
+from elections import get_config
+from admission import admission_controlled
+from singleflight import single_flight
 from crypto import constant_time_compare, salted_hmac, get_random_string, hash_token
 
 api = Blueprint('api', __name__)
@@ -63,9 +66,9 @@ def post_register():
     '''
     from tasks import send_sms
     from models import Voter, Message
-    auth_method = current_app.config.get('AUTH_METHOD', None)
+    auth_method = get_config('AUTH_METHOD', None)
 
-    election = current_app.config.get('AGORA_ELECTION_DATA', '')['election']
+    election = get_config('AGORA_ELECTION_DATA', '')['election']
     if election['voting_ends_at_date'] is not None:
         return error("voting period ended", error_codename='voting_ended')
 
@@ -84,20 +87,20 @@ def post_register():
 
     if auth_method == 'sms':
         input_checks += (
-            ['tlf', lambda x: str_constraint(x, rx_pattern=current_app.config.get('ALLOWED_TLF_NUMS_RX', None))],
+            ['tlf', lambda x: str_constraint(x, rx_pattern=get_config('ALLOWED_TLF_NUMS_RX', None))],
         )
 
-    if current_app.config.get('SHOW_EMAIL', None):
+    if get_config('SHOW_EMAIL', None):
         input_checks += (
             ['email', email_constraint],
         )
 
-    if current_app.config.get('SHOW_POSTAL_CODE', None):
+    if get_config('SHOW_POSTAL_CODE', None):
         input_checks += (
             ['postal_code', lambda x: int_constraint(x, 1, 100000)],
         )
 
-    if current_app.config.get('REGISTER_SHOWS_CAPTCHA', None):
+    if get_config('REGISTER_SHOWS_CAPTCHA', None):
         input_checks += (
             ['captcha_key', lambda x: str_constraint(x, rx_pattern="[0-9a-z]{40}")],
             ['captcha_text', lambda x: CaptchaStore.validate(data['captcha_key'], x.lower())],
@@ -108,13 +111,18 @@ def post_register():
 
     # do a deeper input check: check that the ip is not blacklisted, or that
     # the tlf has already voted..
+    @admission_controlled
     @serializable_retry
     def critical_path():
         data['ip_addr'] = get_ip(request)
         return execute_pipeline(data,
-            current_app.config.get('REGISTER_CHECKS_PIPELINE', []))
+            get_config('REGISTER_CHECKS_PIPELINE', []))
 
-    return critical_path()
+    # concurrent duplicated registrations (double clicks, client retries)
+    # share the response of the first one
+    key = "register|%s|%s|%s" % (get_config("CURRENT_ELECTION_ID", 0),
+                                 data.get('tlf', ''), data['dni'].upper())
+    return single_flight(key, critical_path)
 
 @api.route('/sms_auth/', methods=['POST'])
 def post_sms_auth():
@@ -134,13 +142,13 @@ def post_sms_auth():
         "sha1_hmac": "<sha1 hash>",
     }
     '''
-    if current_app.config.get('AUTH_METHOD', None) != 'sms':
+    if get_config('AUTH_METHOD', None) != 'sms':
         return error("Invalid auth method", error_codename="unauthorized")
 
     from tasks import send_sms
-    from models import Voter, Message
+    from models import Voter, Message, VoterStatusCounter
 
-    election = current_app.config.get('AGORA_ELECTION_DATA', '')['election']
+    election = get_config('AGORA_ELECTION_DATA', '')['election']
     if election['voting_ends_at_date'] is not None:
         return error("voting period ended", error_codename='voting_ended')
 
@@ -155,7 +163,7 @@ def post_sms_auth():
     # initial input checking
     input_checks = (
         ['tlf', lambda x: str_constraint(
-            x, rx_pattern=current_app.config.get('ALLOWED_TLF_NUMS_RX', None))],
+            x, rx_pattern=get_config('ALLOWED_TLF_NUMS_RX', None))],
         ['token', lambda x: str_constraint(x, rx_pattern="[0-9A-Z]{8}")],
         ['dni', lambda x: dni_constraint(x)],
     )
@@ -164,7 +172,8 @@ def post_sms_auth():
         return check_status
 
     # check that voter has not voted
-    curr_eid = current_app.config.get("CURRENT_ELECTION_ID", 0)
+    curr_eid = get_config("CURRENT_ELECTION_ID", 0)
+    @admission_controlled
     @serializable_retry
     def critical_path():
         voters = db.session.query(Voter)\
@@ -176,7 +185,7 @@ def post_sms_auth():
         if voters.count() == 0:
             return error("Voter has not any sms", error_codename="sms_notsent")
 
-        is_rowlock = (current_app.config.get("SERIALIZATION_MODE",
+        is_rowlock = (get_config("SERIALIZATION_MODE",
             "SERIALIZED") == "ROWLOCK")
         if is_rowlock:
             voters = voters.with_lockmode("update").all()
@@ -185,10 +194,10 @@ def post_sms_auth():
             voter = voters.first()
 
         # check token has not too many guesses or has expired
-        expire_time = current_app.config.get('SMS_TOKEN_EXPIRE_SECS', 60*10)
+        expire_time = get_config('SMS_TOKEN_EXPIRE_SECS', 60*10)
         expire_dt = datetime.utcnow() - timedelta(seconds=expire_time)
 
-        if voter.token_guesses >= current_app.config.get("MAX_TOKEN_GUESSES", 3) or\
+        if voter.token_guesses >= get_config("MAX_TOKEN_GUESSES", 3) or\
                 voter.message.created <= expire_dt:
             db.session.commit()
             return error("Voter provided invalid token, please try a new one",
@@ -209,6 +218,7 @@ def post_sms_auth():
         voter.status = Voter.STATUS_AUTHENTICATED
         voter.modified = datetime.utcnow()
         db.session.add(voter)
+        VoterStatusCounter.increment(curr_eid, Voter.STATUS_AUTHENTICATED)
 
         # invalidate other voters with same tlf
         for v in voters[1:]:
@@ -225,7 +235,7 @@ def post_sms_auth():
         int(datetime.utcnow().timestamp()),
         voter.id
     )
-    key = current_app.config.get("AGORA_SHARED_SECRET_KEY", "")
+    key = get_config("AGORA_SHARED_SECRET_KEY", "")
 
     ret_data = dict(
         message=message,
@@ -253,7 +263,7 @@ def post_notify_vote():
     from tasks import send_sms
     from models import Voter, Message
 
-    election = current_app.config.get('AGORA_ELECTION_DATA', '')['election']
+    election = get_config('AGORA_ELECTION_DATA', '')['election']
     if election['voting_ends_at_date'] is not None:
         return error("voting period ended", error_codename='voting_ended')
 
@@ -272,11 +282,11 @@ def post_notify_vote():
         return check_status
 
     # check that voter has not voted
-    curr_eid = current_app.config.get("CURRENT_ELECTION_ID", 0)
+    curr_eid = get_config("CURRENT_ELECTION_ID", 0)
     @serializable_retry
     def critical_path():
         return execute_pipeline(data,
-            current_app.config.get('NOTIFY_VOTE_PIPELINE', []))
+            get_config('NOTIFY_VOTE_PIPELINE', []))
 
     ret = critical_path()
     if ret is not None:
@@ -320,19 +330,19 @@ def post_contact():
         ['captcha_text', captcha_validate],
         ['email', email_constraint],
         ['tlf', lambda x: len(x) == 0 or str_constraint(
-            x, rx_pattern=current_app.config.get('ALLOWED_TLF_NUMS_RX', None))],
+            x, rx_pattern=get_config('ALLOWED_TLF_NUMS_RX', None))],
     )
     check_status = constraints_checker(input_checks, data)
     if  check_status is not True:
         return check_status
 
     subject = gettext("[%(site)s] Contact msg from %(name)s",
-                       site=current_app.config.get('SERVER_NAME', ''),
+                       site=get_config('SERVER_NAME', ''),
                        name=data['name'])
     recipients = [mail_addr
-                  for name, mail_addr in current_app.config.get('ADMINS', [])]
+                  for name, mail_addr in get_config('ADMINS', [])]
     msg = MailMessage(subject=subject,
-                      sender=current_app.config.get('MAIL_DEFAULT_SENDER', []),
+                      sender=get_config('MAIL_DEFAULT_SENDER', []),
                       recipients=recipients)
     msg.body = gettext("Message from %(name)s <%(email)s> (tlf %(tlf)s, ip: "
                        "%(ip)s): \n%(body)s",
@@ -345,36 +355,245 @@ def post_contact():
 
     return make_response("", 200)
 	
-@api.route('/upload-dni/', methods=['POST'])
-def upload_dni():
+# cached stats per election id: election_id -> (timestamp, json string)
+_stats_cache = dict()
+
+@api.route('/stats/', methods=['GET'])
+def get_stats():
     '''
-    TODO Receives dni uploads
+    Returns the live participation stats of the election, i.e. the number of
+    voters that have reached each status. Served from the incrementally
+    maintained VoterStatusCounter table and cached for STATS_CACHE_SECS.
+
+    Example response:
+    {
+        "requested": 1200,
+        "created": 1000,
+        "sent": 990,
+        "authenticated": 800,
+        "voted": 750
+    }
     '''
-    from flask import request, jsonify
-    import os
-    import uuid
+    from models import Voter, VoterStatusCounter
+
+    curr_eid = get_config("CURRENT_ELECTION_ID", 0)
+    cache_secs = get_config("STATS_CACHE_SECS", 10)
+    now = time.time()
+    cached = _stats_cache.get(curr_eid, None)
+    if cached is None or now - cached[0] >= cache_secs:
+        status_names = {
+            Voter.STATUS_REQUESTED: "requested",
+            Voter.STATUS_CREATED: "created",
+            Voter.STATUS_SENT: "sent",
+            Voter.STATUS_AUTHENTICATED: "authenticated",
+            Voter.STATUS_VOTED: "voted",
+        }
+        stats = dict([(name, 0) for name in status_names.values()])
+        counts = VoterStatusCounter.sum_counts(get_read_session(), curr_eid)
+        for status, count in counts.items():
+            if status in status_names:
+                stats[status_names[status]] = count
+        cached = (now, json.dumps(stats))
+        _stats_cache[curr_eid] = cached
+
+    response = make_response(cached[1], 200)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Cache-Control'] = 'public, max-age=%d' % cache_secs
+    return response
+
+@api.route('/stats/rollups/', methods=['GET'])
+def get_rollups():
+    '''
+    Returns the per-minute rollups of the current election (see rollups.py),
+    for dashboards. Only available from METRICS_ALLOWED_IPS.
+
+    Query parameters: since and until (ISO dates or relative like -2h, by
+    default the last hour), transition (optional).
+
+    Example response:
+    [
+        {
+            "minute": "2014-05-21T10:00:00",
+            "transition": "requested",
+            "error_codename": "wait_expire",
+            "count": 12
+        }
+    ]
+    '''
+    from models import RollupMinute
+    from queryfilters import coerce_date
+
+    if get_ip(request) not in current_app.config.get('METRICS_ALLOWED_IPS', []):
+        return error("Forbidden", status=403, error_codename="forbidden")
+
+    try:
+        since = coerce_date(request.args.get('since', '-1h'))
+        until = coerce_date(request.args['until'])\
+            if 'until' in request.args else None
+    except ValueError as e:
+        return error(str(e), error_codename="invalid_date")
+
+    curr_eid = get_config("CURRENT_ELECTION_ID", 0)
+    query = get_read_session().query(RollupMinute)\
+        .filter(RollupMinute.election_id == curr_eid,
+                RollupMinute.minute >= since)
+    if until is not None:
+        query = query.filter(RollupMinute.minute < until)
+    if 'transition' in request.args:
+        query = query.filter(
+            RollupMinute.transition == request.args['transition'])
+
+    rollups = [dict(minute=r.minute.isoformat(), transition=r.transition,
+                    error_codename=r.error_codename, count=r.count)
+               for r in query.order_by(RollupMinute.minute)]
+    response = make_response(json.dumps(rollups), 200)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@api.route('/stats/sms-providers/', methods=['GET'])
+def get_sms_providers_stats():
+    '''
+    Returns the last credit and health check of each sms provider, as stored
+    by the check_sms_providers periodic task. Only available from
+    METRICS_ALLOWED_IPS.
+
+    Example response:
+    [
+        {
+            "provider": "altiria",
+            "checked": "2014-05-21T10:00:00",
+            "credit": 1234.5,
+            "healthy": true,
+            "low_credit": false,
+            "error": ""
+        }
+    ]
+    '''
+    from sms import get_providers_status
 
-    path = current_app.config.get('DNI_FILE_PATH', '/tmp/aelection-dni/')
-    if not os.path.exists(path):
-        os.makedirs(path)
+    if get_ip(request) not in current_app.config.get('METRICS_ALLOWED_IPS', []):
+        return error("Forbidden", status=403, error_codename="forbidden")
 
-    data_file = request.files.get('dni')
-    file_name = data_file.filename
-    unique_filename = str(uuid.uuid4())
-    full_path = os.path.join(path, unique_filename)
-    data_file.save(full_path)
-    file_size = os.path.getsize(full_path)
+    status = get_providers_status()
+    response = make_response(json.dumps(
+        [status[name] for name in sorted(status.keys())]), 200)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
-    return jsonify(name=unique_filename, size=file_size)
+@api.route('/results/', methods=['GET'])
+def get_results():
+    '''
+    Returns the released results of the election, precomputed once per
+    election data version. Returns 404 if the tally has not been released.
+
+    Example response:
+    [
+        {
+            "tally_type": "APPROVAL",
+            "question": "Who should be the candidate?",
+            "total_votes": 100,
+            "blank_votes": 2,
+            "invalid_votes": 1,
+            "winners": ["John Doe"],
+            "answers": [{"value": "John Doe", "total_count": 60}, ...]
+        },
+        {
+            "tally_type": "MEEK-STV",
+            "question": "Who should be in the council?",
+            "winners": ["Jane Doe"],
+            "answers": [{"value": "Jane Doe"}, ...],
+            "iterations": [{"round_stage": 1, "candidates": [
+                {"count": "30.0", "status": "won"}, ...]}, ...]
+        }
+    ]
+    '''
+    from elections import get_election_key
+    from results import get_results_json
+
+    edata = get_config('AGORA_ELECTION_DATA', {})
+    version = get_config('AGORA_ELECTION_DATA_VERSION', '')
+    if edata['election'].get('tally_released_at_date', None) is None:
+        return error("tally not released", status=404,
+                     error_codename="tally_not_released")
+
+    if request.headers.get('If-None-Match', None) == version:
+        return make_response("", 304)
+
+    response = make_response(
+        get_results_json(get_election_key(), edata, version), 200)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['ETag'] = version
+    response.headers['Cache-Control'] = 'public, max-age=%d' % get_config(
+        'RESULTS_CACHE_SECS', 300)
+    return response
+
+@api.route('/upload-dni/', methods=['POST'])
+def upload_dni():
+    '''
+    Receives dni uploads. The file is streamed to disk in chunks while being
+    hashed, and stored by content hash in a sharded directory layout under
+    DNI_FILE_PATH, so that repeated uploads of the same file are stored only
+    once. Files bigger than DNI_MAX_UPLOAD_SIZE are rejected, and so are the
+    requests bigger than MAX_CONTENT_LENGTH, before reading their body.
+
+    Thumbnailing and verification of the image are done in background by the
+    process_dni_upload task.
+
+    Successful response:
+    {
+        "name": "<sha256 hex digest>",
+        "size": 123456
+    }
+    '''
+    from flask import request, jsonify
+    from werkzeug.exceptions import RequestEntityTooLarge
+    from tasks import process_dni_upload
+
+    path = get_config('DNI_FILE_PATH', '/tmp/aelection-dni/')
+    max_size = get_config('DNI_MAX_UPLOAD_SIZE', 5*1024*1024)
+    chunk_size = get_config('DNI_UPLOAD_CHUNK_SIZE', 64*1024)
+
+    # fail fast without reading the body if the client tells us its size
+    if request.content_length is not None and\
+            request.content_length > max_size + 64*1024:
+        return error("File too big", field="dni", status=413,
+                     error_codename="file_too_big")
+
+    try:
+        # fails without reading the body if it's bigger than MAX_CONTENT_LENGTH
+        data_file = request.files.get('dni')
+    except RequestEntityTooLarge:
+        return error("File too big", field="dni", status=413,
+                     error_codename="file_too_big")
+    if data_file is None:
+        return error("No file uploaded", field="dni",
+                     error_codename="invalid_key_constraint")
+
+    ret = save_stream_by_hash(data_file.stream, path, max_size, chunk_size)
+    if ret is None:
+        return error("File too big", field="dni", status=413,
+                     error_codename="file_too_big")
+
+    digest, full_path, file_size, is_new = ret
+    if is_new:
+        process_dni_upload.apply_async(kwargs=dict(file_path=full_path))
+
+    return jsonify(name=digest, size=file_size)
 
 @index.route('/', methods=['GET'])
 def get_index():
     '''
     Returns the index page
     '''
-    data_str = current_app.config.get('AGORA_ELECTION_DATA_STR', '')
-    static_path = current_app.config.get('STATIC_PATH', '/static')
-    custom_js = current_app.config.get('CUSTOM_JAVASCRIPT', '')
-    custom_css = current_app.config.get('CUSTOM_CSS', '')
+    data_str = get_config('AGORA_ELECTION_DATA_STR', '')
+    static_path = get_config('STATIC_PATH', '/static')
+    theme = get_config('THEME', 'current')
+    custom_js = get_config('CUSTOM_JAVASCRIPT', '')
+    custom_css = get_config('CUSTOM_CSS', '')
+    # includes the PATH_PREFIX of the election, see elections.ElectionDispatcher
+    api_base = request.script_root + '/api/v1'
     return render_template('index.html', data=data_str, static_path=static_path,
-                           custom_js=custom_js, custom_css=custom_css)
+                           theme=theme, custom_js=custom_js,
+                           custom_css=custom_css, api_base=api_base)
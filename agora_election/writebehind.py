@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of agora-election.
+# Copyright (C) 2014  Eduardo Robles Elvira <edulix AT agoravoting DOT com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Write-behind buffer for the registration attempts rejected by the register
+pipeline (see register_request with write_behind=True).
+
+Rejected requests are kept in memory and bulk inserted in the voter table by
+a background thread every WRITE_BEHIND_FLUSH_SECS (or as soon as
+WRITE_BEHIND_MAX_SIZE rows are buffered), instead of doing one synchronous
+insert per request. The inserts use their own connection, never the session
+of a request.
+
+If a bulk insert fails because of the data, the rows are inserted one by one,
+and the rows that fail in WRITE_BEHIND_MAX_ATTEMPTS flushes are logged and
+dropped. If the database is unavailable, the rows are kept for the next flush,
+but at most WRITE_BEHIND_MAX_PENDING of them: the rest are dropped and counted
+in the log, so that the buffer doesn't grow without bound.
+
+Buffered STATUS_REQUESTED voters are still taken into account by
+check_ip_total_unconfirmed_requests_max through pending_requested_count, but
+only those of the same process: the buffers of the other worker processes are
+not visible until they are flushed.
+'''
+
+import atexit
+import logging
+import threading
+
+from sqlalchemy.exc import OperationalError
+
+# voter columns written by the buffer
+VOTER_COLUMNS = ('election_id', 'created', 'modified', 'ip', 'tlf',
+                 'first_name', 'last_name', 'email', 'dni', 'postal_code',
+                 'lang_code', 'receive_mail_updates', 'token_guesses',
+                 'message_id', 'is_active', 'status', 'error_codename',
+                 'correlation_id')
+
+class WriteBehindBuffer(object):
+    '''
+    In-memory buffer of voter rows pending to be inserted
+    '''
+
+    def __init__(self, app, flush_interval, max_size, max_attempts,
+                 max_pending):
+        self.app = app
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.max_attempts = max_attempts
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        # list of [failed attempts, row]
+        self.rows = []
+        # (election_id, ip) -> number of buffered STATUS_REQUESTED voters,
+        # including the ones being flushed but not committed yet
+        self.pending = dict()
+        # number of rows dropped because the buffer was full, and how many of
+        # them have been logged
+        self.dropped = 0
+        self.logged_dropped = 0
+        self.thread = None
+        self.stopped = threading.Event()
+        self.wakeup = threading.Event()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        self.flush()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("write-behind: error flushing voters")
+
+    def add(self, voter):
+        '''
+        Adds a (not persisted) Voter to the buffer. When the buffer is full,
+        the flush thread is woken up: the request never flushes it itself.
+        If max_pending rows are already waiting (the database is down or not
+        keeping up), the voter is dropped.
+        '''
+        row = dict((col, getattr(voter, col)) for col in VOTER_COLUMNS)
+        key = (row['election_id'], row['ip'])
+        with self.lock:
+            if len(self.rows) >= self.max_pending:
+                self.dropped += 1
+                full = True
+            else:
+                self.rows.append([0, row])
+                self.pending[key] = self.pending.get(key, 0) + 1
+                full = len(self.rows) >= self.max_size
+        if full:
+            self.wakeup.set()
+
+    def pending_requested_count(self, election_id, ip):
+        with self.lock:
+            return self.pending.get((election_id, ip), 0)
+
+    def forget(self, entries):
+        '''
+        Removes the entries from the pending counts. Must be called with the
+        lock held.
+        '''
+        for attempts, row in entries:
+            key = (row['election_id'], row['ip'])
+            self.pending[key] -= 1
+            if self.pending[key] <= 0:
+                del self.pending[key]
+
+    def insert(self, engine, rows):
+        '''
+        Inserts the rows in one transaction of a dedicated connection
+        '''
+        from models import Voter
+
+        with engine.connect() as conn:
+            if engine.dialect.name == 'postgresql':
+                conn = conn.execution_options(isolation_level="READ COMMITTED")
+            with conn.begin():
+                conn.execute(Voter.__table__.insert(), rows)
+
+    def flush(self):
+        '''
+        Bulk inserts the buffered rows
+        '''
+        from app import db
+        from models import Voter, VoterStatusCounter
+
+        with self.flush_lock:
+            with self.lock:
+                entries, self.rows = self.rows, []
+            if not entries:
+                return
+
+            engine = db.get_engine(self.app)
+            done = []
+            retry = []
+            try:
+                self.insert(engine, [row for attempts, row in entries])
+                done = entries
+            except OperationalError:
+                logging.exception("write-behind: database unavailable, "
+                                  "keeping %d voters" % len(entries))
+                retry = entries
+            except Exception:
+                logging.exception("write-behind: bulk insert failed, "
+                                  "inserting the voters one by one")
+                for entry in entries:
+                    try:
+                        self.insert(engine, [entry[1]])
+                        done.append(entry)
+                    except Exception as e:
+                        entry[0] += 1
+                        if entry[0] < self.max_attempts:
+                            retry.append(entry)
+                            continue
+                        logging.error("write-behind: dropping voter after %d "
+                                      "attempts: %r (%s)" % (entry[0],
+                                                             entry[1], e))
+                        done.append(entry)
+
+            with self.lock:
+                # retried rows go first, to keep the insertion order, and the
+                # newest ones are dropped if they don't fit
+                rows = retry + self.rows
+                self.rows = rows[:self.max_pending]
+                overflow = rows[self.max_pending:]
+                self.dropped += len(overflow)
+                self.forget(done + overflow)
+                dropped = self.dropped - self.logged_dropped
+                self.logged_dropped = self.dropped
+
+            if dropped:
+                logging.error("write-behind: buffer full, dropped %d voters "
+                              "(%d in total)" % (dropped, self.logged_dropped))
+
+            inserted = [row for attempts, row in done
+                        if attempts < self.max_attempts]
+            if inserted:
+                counts = dict()
+                for row in inserted:
+                    key = (row['election_id'], Voter.STATUS_REQUESTED)
+                    counts[key] = counts.get(key, 0) + 1
+                VoterStatusCounter.apply_increments(
+                    engine, counts,
+                    self.app.config.get('VOTER_STATUS_COUNTER_SHARDS', 16))
+                logging.debug("write-behind: flushed %d voters" % len(inserted))
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+def get_buffer():
+    '''
+    Returns the write-behind buffer of this process, starting its flush
+    thread the first time
+    '''
+    global _buffer
+    from app import app_flask
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = WriteBehindBuffer(
+                app_flask,
+                flush_interval=app_flask.config.get(
+                    'WRITE_BEHIND_FLUSH_SECS', 0.3),
+                max_size=app_flask.config.get('WRITE_BEHIND_MAX_SIZE', 5000),
+                max_attempts=app_flask.config.get(
+                    'WRITE_BEHIND_MAX_ATTEMPTS', 5),
+                max_pending=app_flask.config.get(
+                    'WRITE_BEHIND_MAX_PENDING', 50000))
+            _buffer.start()
+        return _buffer
+
+def pending_requested_count(election_id, ip):
+    '''
+    Number of buffered STATUS_REQUESTED voters for the election and ip, not
+    yet visible in the database
+    '''
+    if _buffer is None:
+        return 0
+    return _buffer.pending_requested_count(election_id, ip)